@@ -0,0 +1,441 @@
+"""
+Benchmarks for geoprocessing hot paths.  Run from this directory:
+
+    python benchmark.py suite [--size 10000] [--out results.json]
+        [--compare baseline.json]
+    python benchmark.py encode [--raster path/to/tile_layer.tif]
+
+The suite generates synthetic categorical rasters, runs each operation over
+areas of interest from city to state sized and over tiles at several zooms,
+and reports latency percentiles, throughput and peak memory.  Results are
+saved as JSON to compare between commits.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import datetime
+import json
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import timeit
+
+import numpy as np
+import rasterio
+
+from multiprocessing import Pool
+from PIL import Image
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+
+import geoprocessing
+import settings
+import tiles
+
+from geo_utils import mask_geom_on_raster, tile_read, tile_to_bbox
+
+# NLCD-like class values used to build synthetic categorical tiles
+NLCD_CLASSES = [11, 21, 22, 23, 24, 31, 41, 42, 43, 52, 71, 81, 82, 90, 95]
+
+# Hydrologic soil group values
+SOIL_CLASSES = [1, 2, 3, 4, 5, 6, 7]
+
+# Synthetic rasters are 30m cells, placed in EPSG:5070 for analysis and in
+# EPSG:3857 for tiles, around Philadelphia
+CELL_SIZE = 30
+ALBERS_ORIGIN = (1600000, 2200000)
+MERCATOR_ORIGIN = (-8500000, 4950000)
+WEB_MERCATOR_EXTENT = 20037508.34789244
+
+# Areas of interest as (name, radius in meters)
+AOIS = [
+    ('city', 5000),
+    ('county', 25000),
+    ('region', 75000),
+    ('state', 150000),
+]
+
+TILE_ZOOMS = [8, 10, 12, 14]
+
+# Reclassification and weights of the /priority endpoint
+NLCD_RECLASS = [[11, 0], [(21, 24), 10], [31, 7], [(41, 43), 1],
+                [(51, 52), 6], [(71, 74), 4], [(81, 82), 5], [(90, 95), 2]]
+SOIL_RECLASS = [[3, 8], [4, 10], [(6, 7), 8], [5, 6], [2, 5]]
+
+# Encoder configurations compared by the `encode` benchmark as
+# (label, format, png compress level, png compress type)
+ENCODINGS = [
+    ('png default', 'png', -1, -1),
+    ('png level 1', 'png', 1, -1),
+    ('png level 6', 'png', 6, -1),
+    ('png level 9', 'png', 9, -1),
+    ('png level 1 rle', 'png', 1, 3),
+    ('png level 6 rle', 'png', 6, 3),
+    ('png level 6 filtered', 'png', 6, 1),
+    ('png huffman', 'png', 6, 2),
+    ('webp lossless', 'webp', None, None),
+]
+
+
+def synthetic_tile(tile_size=256, patch_size=8, seed=0):
+    """
+    Build a categorical tile of square patches of NLCD class values, which
+    compresses similarly to a real land cover tile
+    """
+    rng = np.random.RandomState(seed)
+    patches = tile_size // patch_size
+    classes = rng.choice(NLCD_CLASSES, size=(patches, patches))
+    tile = np.repeat(np.repeat(classes, patch_size, 0), patch_size, 1)
+    return tile.astype(np.uint8)
+
+
+def synthetic_raster(path, size, classes, crs, origin, dtype='uint8',
+                     block_size=512, tiled=True, compress='lzw', seed=0):
+    """
+    Write a `size` x `size` categorical raster of random patches of
+    `classes`, one block at a time so large rasters fit in memory
+    """
+    profile = {
+        'driver': 'GTiff',
+        'width': size,
+        'height': size,
+        'count': 1,
+        'dtype': dtype,
+        'crs': crs,
+        'transform': from_origin(origin[0], origin[1], CELL_SIZE, CELL_SIZE),
+        'nodata': 0,
+        'compress': compress,
+    }
+    if tiled:
+        profile.update(tiled=True, blockxsize=block_size,
+                       blockysize=block_size)
+
+    patch_size = 16
+    with rasterio.open(path, 'w', **profile) as dst:
+        for idx, (_, window) in enumerate(dst.block_windows(1)):
+            height, width = int(window.height), int(window.width)
+
+            rng = np.random.RandomState(seed + idx)
+            patches = rng.choice(classes, size=(height // patch_size + 1,
+                                                width // patch_size + 1))
+            block = np.repeat(np.repeat(patches, patch_size, 0),
+                              patch_size, 1)[:height, :width]
+            dst.write(block.astype(dtype), 1, window=window)
+
+    return path
+
+
+def center_tile(raster_path, zoom):
+    """
+    The z/x/y of the tile at the center of an EPSG:3857 raster
+    """
+    with rasterio.open(raster_path) as src:
+        x_mid = (src.bounds.left + src.bounds.right) / 2
+        y_mid = (src.bounds.bottom + src.bounds.top) / 2
+
+    size = WEB_MERCATOR_EXTENT * 2 / 2**zoom
+    x = int((x_mid + WEB_MERCATOR_EXTENT) / size)
+    y = int((WEB_MERCATOR_EXTENT - y_mid) / size)
+    return x, y
+
+
+def sample_tiles(raster_path=None, count=16):
+    if raster_path is None:
+        return [synthetic_tile(seed=seed) for seed in range(count)]
+
+    # Read tiles from a band of a tile layer at a fixed zoom
+    zoom = 12
+    x, y = center_tile(raster_path, zoom)
+    side = int(np.ceil(np.sqrt(count)))
+
+    return [tile_read(tile_to_bbox(zoom, x + dx, y + dy), raster_path)[0]
+            for dx in range(side) for dy in range(side)][:count]
+
+
+def bench_encode(args):
+    sample = sample_tiles(args.raster, args.tiles)
+    palette = tiles.make_palette(np.arange(768) % 256)
+    images = [Image.fromarray(tile, mode='P') for tile in sample]
+    for img in images:
+        img.putpalette(palette)
+
+    print('{0:<22} {1:>10} {2:>12} {3:>12}'.format(
+        'encoding', 'ms/tile', 'tiles/s', 'bytes/tile'))
+
+    for label, img_format, level, strategy in ENCODINGS:
+        if level is not None:
+            settings.TILE_PNG_COMPRESS_LEVEL = level
+            settings.TILE_PNG_COMPRESS_TYPE = strategy
+
+        try:
+            sizes = [len(tiles.encode_tile(img, img_format, 0).getvalue())
+                     for img in images]
+        except (IOError, KeyError):
+            print('{0:<22} not supported by this PIL build'.format(label))
+            continue
+
+        elapsed = min(timeit.repeat(
+            lambda: [tiles.encode_tile(img, img_format, 0) for img in images],
+            repeat=args.repeat, number=1))
+
+        per_tile = elapsed / len(images)
+        print('{0:<22} {1:>10.3f} {2:>12.1f} {3:>12.0f}'.format(
+            label, per_tile * 1000, 1 / per_tile, np.mean(sizes)))
+
+
+def aoi_cases(size, nlcd_path, soil_path):
+    """
+    Analysis cases for every area of interest which fits in the raster, as
+    (operation, area name, function to run, number of cells)
+    """
+    center = Point(ALBERS_ORIGIN[0] + size * CELL_SIZE / 2,
+                   ALBERS_ORIGIN[1] - size * CELL_SIZE / 2)
+
+    def weighted_overlay(geom):
+        nlcd = mask_geom_on_raster(geom, nlcd_path)[0]
+        soil = mask_geom_on_raster(geom, soil_path)[0]
+        layers = [geoprocessing.reclassify_from_data(nlcd, NLCD_RECLASS),
+                  geoprocessing.reclassify_from_data(soil, SOIL_RECLASS)]
+        return geoprocessing.weighted_overlay_from_data(layers, [0.65, 0.35])
+
+    operations = [
+        ('count', lambda geom: geoprocessing.count(geom, nlcd_path)),
+        ('count_pairs', lambda geom: geoprocessing.count_pairs(
+            geom, [nlcd_path, soil_path])),
+        ('stats_mean', lambda geom: geoprocessing.statistics(
+            geom, nlcd_path, 'mean')),
+        ('reclassify', lambda geom: geoprocessing.reclassify(
+            geom, nlcd_path, NLCD_RECLASS)),
+        ('weighted_overlay', weighted_overlay),
+    ]
+
+    for aoi, radius in AOIS:
+        if radius * 2 > size * CELL_SIZE:
+            continue
+
+        geom = center.buffer(radius)
+        cells = int(geom.area / CELL_SIZE**2)
+        for operation, func in operations:
+            yield operation, aoi, (lambda func=func, geom=geom: func(geom)), \
+                cells
+
+
+def tile_cases(tile_path):
+    """
+    Tile cases at each zoom, as (operation, zoom, function to run, cells)
+    """
+    palette = tiles.make_palette(np.arange(768) % 256)
+    data = {}
+
+    for zoom in TILE_ZOOMS:
+        x, y = center_tile(tile_path, zoom)
+        bbox = tile_to_bbox(zoom, x, y)
+        cells = tiles.TILE_SIZE**2
+
+        def read(bbox=bbox, zoom=zoom):
+            data[zoom] = tile_read(bbox, tile_path)[0]
+            return data[zoom]
+
+        def render(bbox=bbox, zoom=zoom):
+            if zoom not in data:
+                read(bbox, zoom)
+            return tiles.render_tile_from_data(data[zoom], palette, 'png')
+
+        yield 'tile_read', 'z{}'.format(zoom), read, cells
+        yield 'render_tile_from_data', 'z{}'.format(zoom), render, cells
+
+
+def run_case(case):
+    """
+    Time a case in a fresh worker process, so its peak memory can be
+    measured on its own
+    """
+    operation, name, func, cells, repeat = case
+
+    with open('/proc/self/statm') as statm:
+        baseline_kb = int(statm.read().split()[1]) * \
+            resource.getpagesize() // 1024
+
+    func()  # warm up: open datasets, initialize projections
+    latencies = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        latencies.append(time.time() - start)
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    p50 = np.percentile(latencies, 50)
+
+    return {
+        'operation': operation,
+        'case': name,
+        'cells': cells,
+        'mean_ms': np.mean(latencies) * 1000,
+        'p50_ms': p50 * 1000,
+        'p90_ms': np.percentile(latencies, 90) * 1000,
+        'p99_ms': np.percentile(latencies, 99) * 1000,
+        'cells_per_s': cells / p50 if p50 else None,
+        'peak_mem_mb': max(peak_kb - baseline_kb, 0) / 1024,
+    }
+
+
+# Cases hold closures, which can't be pickled, so workers look them up by
+# index after forking
+CASES = []
+
+
+def run_case_by_index(idx):
+    return run_case(CASES[idx])
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip().decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    """
+    Run the suite on rasters kept in --data-dir, or generated into a
+    temporary directory which is removed afterwards
+    """
+    data_dir = args.data_dir or tempfile.mkdtemp()
+    try:
+        run_suite(args, data_dir)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def run_suite(args, data_dir):
+    name = 'synthetic_{}_{}_{}_{}'.format(
+        args.size, args.dtype, args.block, 'tiled' if args.tiled else 'strip')
+
+    paths = {}
+    for layer, classes, crs, origin in (
+            ('nlcd', NLCD_CLASSES, 'epsg:5070', ALBERS_ORIGIN),
+            ('soil', SOIL_CLASSES, 'epsg:5070', ALBERS_ORIGIN),
+            ('tiles', NLCD_CLASSES, 'epsg:3857', MERCATOR_ORIGIN)):
+        path = os.path.join(data_dir, '{}_{}.tif'.format(name, layer))
+        if not os.path.isfile(path):
+            print('Generating {}'.format(path))
+            synthetic_raster(path, args.size, classes, crs, origin,
+                             args.dtype, args.block, args.tiled,
+                             args.compress)
+        paths[layer] = path
+
+    del CASES[:]
+    for operation, case, func, cells in aoi_cases(
+            args.size, paths['nlcd'], paths['soil']):
+        CASES.append((operation, case, func, cells, args.repeat))
+    for operation, case, func, cells in tile_cases(paths['tiles']):
+        CASES.append((operation, case, func, cells, args.repeat * 5))
+
+    print('{0:<22} {1:<8} {2:>10} {3:>10} {4:>10} {5:>14} {6:>10}'.format(
+        'operation', 'case', 'p50 ms', 'p90 ms', 'p99 ms', 'cells/s',
+        'peak MB'))
+
+    results = []
+    for idx in range(len(CASES)):
+        pool = Pool(1)
+        result = pool.apply(run_case_by_index, (idx,))
+        pool.close()
+        pool.join()
+
+        results.append(result)
+        print('{operation:<22} {case:<8} {p50_ms:>10.2f} {p90_ms:>10.2f} '
+              '{p99_ms:>10.2f} {cells_per_s:>14,.0f} {peak_mem_mb:>10.1f}'
+              .format(**result))
+
+    report = {
+        'revision': git_revision(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'raster': {
+            'size': args.size,
+            'dtype': args.dtype,
+            'block': args.block,
+            'tiled': args.tiled,
+            'compress': args.compress,
+        },
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Results saved to {}'.format(args.out))
+
+    if args.compare:
+        compare(args.compare, report)
+
+
+def compare(baseline_path, report):
+    """
+    Print the change in p50 latency and peak memory of each case against a
+    previously saved report
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    previous = {(result['operation'], result['case']): result
+                for result in baseline['results']}
+
+    print('\nCompared to {} ({})'.format(baseline_path, baseline['revision']))
+    print('{0:<22} {1:<8} {2:>12} {3:>12}'.format(
+        'operation', 'case', 'p50 change', 'mem change'))
+
+    for result in report['results']:
+        old = previous.get((result['operation'], result['case']))
+        if old is None:
+            continue
+
+        print('{0:<22} {1:<8} {2:>+11.1f}% {3:>+11.1f}MB'.format(
+            result['operation'], result['case'],
+            (result['p50_ms'] / old['p50_ms'] - 1) * 100,
+            result['peak_mem_mb'] - old['peak_mem_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    suite = subparsers.add_parser(
+        'suite', help='Time geoprocessing operations on synthetic rasters')
+    suite.add_argument('--size', type=int, default=10000,
+                       help='Width and height of the rasters in cells')
+    suite.add_argument('--dtype', default='uint8')
+    suite.add_argument('--block', type=int, default=512,
+                       help='Block width and height of tiled rasters')
+    suite.add_argument('--striped', dest='tiled', action='store_false',
+                       help='Write striped rather than tiled rasters')
+    suite.add_argument('--compress', default='lzw')
+    suite.add_argument('--repeat', type=int, default=5)
+    suite.add_argument('--data-dir', help='Directory to keep generated '
+                       'rasters in between runs, defaults to a temp dir '
+                       'which is removed after the run')
+    suite.add_argument('--out', help='Path to save results as JSON')
+    suite.add_argument('--compare', help='Results JSON to compare against')
+    suite.set_defaults(func=bench_suite)
+
+    encode = subparsers.add_parser(
+        'encode', help='Compare tile encoding throughput and size')
+    encode.add_argument('--raster', help='EPSG:3857 tile layer to sample, '
+                        'defaults to synthetic tiles')
+    encode.add_argument('--tiles', type=int, default=16)
+    encode.add_argument('--repeat', type=int, default=5)
+    encode.set_defaults(func=bench_encode)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
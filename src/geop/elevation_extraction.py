@@ -2,31 +2,44 @@ from __future__ import division
 
 import json
 import itertools
+import logging
 import math
+import os
 
 import numpy as np
 import rasterio
 
 from affine import Affine
 from multiprocessing import Process, Queue, cpu_count
+from Queue import Empty
 from shapely.geometry import shape, mapping, MultiPolygon
 
+
 from geo_utils import mask_geom_on_raster
 
-# Iniialized globaly to share with multiple processes
-SHARED_LAYER = None
+LOG = logging.getLogger(__name__)
+
+OUT_DIR = '/usr/data/out/'
+
+# Seconds to wait for an increment before checking the processes extracting
+# them are still running
+POLL_SECONDS = 1
 
 
-def save_features(cnt, features):
+def save_features(cnt, features, out_dir=OUT_DIR):
         s = MultiPolygon(features)
 
-        with open('/usr/data/out/pa-{}.json'.format(cnt), 'w') as f:
+        path = os.path.join(out_dir, 'pa-{}.json'.format(cnt))
+        with open(path, 'w') as f:
             f.write(json.dumps(mapping(s)))
-        print(cnt, 'saved')
+        LOG.info('%d saved', cnt)
+        return path
 
 
-def setup_processes(queue):
-    shape_handler = Process(target=extract_between, args=((queue),))
+def setup_processes(layer, queue, saved, out_dir=OUT_DIR):
+    # The layer is inherited by the forked process rather than pickled
+    shape_handler = Process(target=extract_between,
+                            args=(layer, queue, saved, out_dir))
 
     # Allow the main process to block until the spawned processes terminate
     shape_handler.daemon = False
@@ -34,23 +47,33 @@ def setup_processes(queue):
     return shape_handler
 
 
-def process_increments(geom, raster_path):
+def process_increments(geom, raster_path, out_dir=OUT_DIR, progress=None):
+    """
+    Extract the area of `geom` between each half foot increment of elevation
+    into a GeoJSON file in `out_dir`, on a process per cpu.  If given,
+    `progress` is called with the increments saved and the total increments
+    as each is saved, and the processes are terminated if it raises, as it
+    does once a job is cancelled, or if one of them fails.
+
+    Returns:
+        The paths of the files, in order of elevation
+    """
 
     # Get min/max of masked area
-    print('start')
+    LOG.info('start')
     layer, transform = mask_geom_on_raster(geom, raster_path)
-    print('read in')
+    LOG.info('read in')
     min_el = layer.min()
     max_el = layer.max()
 
-    # Make shared_layer a a module level variable that can be
-    # shared between processes on a posix system.  Treat as readonly.
-    # Then create a queue and processes to consume from it, based on
-    # the system cpu count
-    global SHARED_LAYER
-    SHARED_LAYER = layer
+    # Pass the layer to the processes, which share it on a posix system,
+    # rather than through a module level variable which concurrent
+    # extractions would overwrite.  Treat as readonly.  Then create a queue
+    # and processes to consume from it, based on the system cpu count
     queue = Queue()
-    processes = [setup_processes(queue) for i in range(cpu_count())]
+    saved = Queue()
+    processes = [setup_processes(layer, queue, saved, out_dir)
+                 for i in range(cpu_count())]
 
     inc = .1524  # Half foot in meters
     cnt = 0
@@ -58,8 +81,8 @@ def process_increments(geom, raster_path):
     upper = min_el + inc
     runs = math.ceil((max_el - min_el)/inc)
 
-    print('{} to {}'.format(min_el, max_el))
-    print('Generating {} levels using {} cores'.format(runs, cpu_count()))
+    LOG.info('%s to %s', min_el, max_el)
+    LOG.info('Generating %d levels using %d cores', runs, cpu_count())
 
     level = lower
     while level <= max_el:
@@ -73,13 +96,45 @@ def process_increments(geom, raster_path):
     for p in processes:
         queue.put([None] * 4)
 
-
-def extract_between(queue):
+    paths = [None] * cnt
+    done = 0
+    try:
+        while done < cnt:
+            if progress:
+                progress(done, cnt)
+
+            # Processes which had exited before the wait began can't save
+            # an increment during it
+            failed = any(p.exitcode for p in processes)
+            running = any(p.is_alive() for p in processes)
+            try:
+                level, path = saved.get(timeout=POLL_SECONDS)
+            except Empty:
+                if failed or not running:
+                    raise RuntimeError(
+                        'Extracting increments failed, {} of {} were '
+                        'saved'.format(done, cnt))
+                continue
+
+            paths[level] = path
+            done += 1
+    except Exception:
+        for p in processes:
+            p.terminate()
+        raise
+    finally:
+        for p in processes:
+            p.join()
+
+    return paths
+
+
+def extract_between(layer, queue, saved, out_dir=OUT_DIR):
 
     while True:
         cnt, transform, lower, upper = queue.get()
         if cnt is not None:
-            max_rows = SHARED_LAYER.shape[0]
+            max_rows = layer.shape[0]
             start = 0
 
             # These numbers have an impact on speed, memory use and output
@@ -91,9 +146,9 @@ def extract_between(queue):
             increment_vectors = []
             while start < max_rows:
                 # Create array bool from mask and extract on it.
-                layer_chunk = SHARED_LAYER[start:end]
+                layer_chunk = layer[start:end]
                 chunk = np.ones(shape=layer_chunk.shape, dtype=np.uint8)
-                layer_mask_chunk = SHARED_LAYER.mask[start:end]
+                layer_mask_chunk = layer.mask[start:end]
 
                 mask = ((layer_chunk >= lower) & (layer_chunk <= upper) &
                         ~layer_mask_chunk)
@@ -118,7 +173,8 @@ def extract_between(queue):
                 start = end
                 end = end + inc
 
-            save_features(cnt, list(itertools.chain(*increment_vectors)))
+            saved.put((cnt, save_features(
+                cnt, list(itertools.chain(*increment_vectors)), out_dir)))
         else:
             # When the queue sends a kill message, exit the read loop
             break
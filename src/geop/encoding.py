@@ -0,0 +1,105 @@
+"""
+Encodings of analysis responses, negotiated from the Accept header of each
+request.  JSON is written compactly, with numpy values converted natively
+rather than through Flask's generic encoder.  MessagePack is available when
+the `msgpack` package is installed, and array shaped results, such as the
+samples along a line, can also be fetched as NPY, or as an Arrow stream when
+`pyarrow` is installed.
+"""
+import json
+
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+NPY = 'application/x-npy'
+ARROW = 'application/vnd.apache.arrow.stream'
+
+
+def native(value):
+    """
+    Convert numpy scalars and arrays which the encoders don't handle into
+    Python values
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+
+    raise TypeError('{!r} is not serializable'.format(value))
+
+
+def encode_json(data, array_key=None):
+    return json.dumps(data, default=native, separators=(',', ':'))
+
+
+def encode_msgpack(data, array_key=None):
+    return msgpack.packb(data, default=native, use_bin_type=True)
+
+
+def encode_npy(data, array_key):
+    f = BytesIO()
+    np.save(f, np.asarray(data[array_key]), allow_pickle=False)
+    return f.getvalue()
+
+
+def encode_arrow(data, array_key):
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array(np.asarray(data[array_key]))], names=[array_key])
+
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(sink, table.schema)
+    writer.write_table(table)
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+def encoders(array_key=None):
+    """
+    The mimetypes a response can be encoded as and the encoder of each,
+    JSON first.  Array encodings are only available for responses with an
+    array at `array_key`.
+    """
+    available = [(JSON, encode_json)]
+    if msgpack is not None:
+        available.append((MSGPACK, encode_msgpack))
+
+    if array_key is not None:
+        available.append((NPY, encode_npy))
+        if pyarrow is not None:
+            available.append((ARROW, encode_arrow))
+
+    return OrderedDict(available)
+
+
+def negotiate(accept, array_key=None):
+    """
+    Choose the encoding of a response which best matches the request's
+    Accept header, or JSON if none of them do
+
+    Args:
+        accept (MIMEAccept): The `accept_mimetypes` of a Flask request
+
+        array_key (optional string): Key of the array in an array shaped
+            response
+
+    Returns:
+        The mimetype, and a function of the response data and `array_key`
+        which encodes it
+    """
+    available = encoders(array_key)
+    mimetype = accept.best_match(list(available), default=JSON)
+    return mimetype, available[mimetype]
@@ -2,3 +2,15 @@ class UserInputError(ValueError):
     def __init__(self, message):
         self.message = message
         self.status_code = 400
+
+
+class RequestTooLargeError(UserInputError):
+    def __init__(self, message):
+        super(RequestTooLargeError, self).__init__(message)
+        self.status_code = 413
+
+
+class JobNotFinishedError(UserInputError):
+    def __init__(self, message):
+        super(JobNotFinishedError, self).__init__(message)
+        self.status_code = 409
@@ -3,15 +3,37 @@ from __future__ import division
 from affine import Affine
 from functools import partial
 from rasterio import features
+from rasterio.enums import MaskFlags
+from rasterio.errors import RasterBlockError
 from shapely.ops import transform
 from shapely.geometry import shape, mapping, Polygon
 from shapely.geometry.collection import GeometryCollection
 from shapely.geometry.geo import box
+from shapely.prepared import prep
 
 import json
+import math
 import numpy as np
 import pyproj
-import rasterio
+
+import memmap_io
+import raster_io
+import scenario_store
+import settings
+import timing
+
+from errors import UserInputError
+
+# Coordinate transformations, keyed by (from_srs, to_srs)
+PROJECTIONS = {}
+
+# ColorTables converted to palettes, keyed by raster path.  Tile layers are
+# static, so each table only needs to be converted once per process
+PALETTES = {}
+
+# The fixed cost of a rasterization is about that of rasterizing a window
+# of this many cells
+RASTERIZE_OVERHEAD_CELLS = 2**20
 
 
 def mask_geom_on_raster(geom, raster_path, mods=None, all_touched=True):
@@ -48,39 +70,571 @@ def mask_geom_on_raster(geom, raster_path, mods=None, all_touched=True):
        supplied geometry does not intersect are masked.
 
     """
-    # Read a chunk of the raster that contains the bounding box of the
-    # input geometry.  This has memory implications if that rectangle
-    # is large. The affine transformation maps geom coordinates to the
-    # image mask below.
-    with rasterio.open(raster_path) as src:
-        window, shifted_affine = get_window_and_affine(geom, src)
-        data = src.read(1, window=window)
+    # The window only depends on the bounds of geom, so concurrent requests
+    # for the same extent share a read of remote rasters.  When only the
+    # blocks intersecting geom are read, the read depends on its shape.
+    key = ('window', geom.bounds)
+    if settings.MASK_BLOCK_SIZE:
+        key = ('blocks', geom.wkb)
+    window_data = raster_io.read(raster_path, partial(read_geom_window, geom),
+                                 key=key)
+
+    return mask_window(geom, window_data, mods, all_touched)
+
+
+def mask_geom_parts(geom, raster_path, mods=None, all_touched=True):
+    """
+    Mask a geometry on a raster like `mask_geom_on_raster`, but read the
+    parts of a multi-part geometry which are far apart in separate windows,
+    so a geometry whose parts are 200km apart doesn't read and hold the
+    whole rectangle between them.
+
+    Returns:
+        A list of (masked array, affine transformation) pairs, one for each
+        cluster of parts.  Their windows don't overlap, so each cell of the
+        raster is in at most one of them.
+    """
+    parts = raster_io.read(raster_path, partial(read_geom_parts, geom),
+                           key=('parts', geom.wkb))
+
+    return [mask_window(part, window_data, mods, all_touched)
+            for part, window_data in parts]
+
+
+def geom_values(geom, raster_path, mods=None, all_touched=True):
+    """
+    The values of the cells of a raster which intersect a geometry, as a
+    1-D array, with any modifications applied.  Cells are gathered from the
+    window of each cluster of parts of `geom` with plain array indexing, so
+    analyses of the values don't need masked arrays.
+
+    Returns:
+        A 1-D array of the values of each cell in `geom` which isn't nodata
+    """
+    parts = raster_io.read(raster_path, partial(read_geom_parts, geom),
+                           key=('parts', geom.wkb))
+
+    values = []
+    for part, window_data in parts:
+        with timing.stage('mask'):
+            window_data = apply_mods(window_data, mods, all_touched)
+
+            # Nodata cells are excluded in the same mask as the geometry
+            geom_mask = geom_window_mask(part, window_data, all_touched)
+            invalid = invalid_cells(window_data)
+            if invalid is not None:
+                geom_mask |= invalid
+
+            values.append(AOI(geom_mask).values(window_data[0]))
+
+    return values[0] if len(values) == 1 else np.concatenate(values)
+
+
+def geom_values_on_rasters(geom, raster_paths, all_touched=True):
+    """
+    The values of the cells of each of several rasters which intersect a
+    geometry, as `geom_values` gives for one.  Each raster is read once,
+    and the mask of each cluster of parts is only rasterized once for all
+    rasters on the same grid.
+
+    Returns:
+        A dict of each raster path to the 1-D array of its values, in the
+        same order, cell by cell, for rasters on the same grid, and a 1-D
+        boolean array of which values are nodata, or None if the raster has
+        no nodata
+    """
+    aois = {}
+    layers = {}
+    for raster_path in raster_paths:
+        if raster_path in layers:
+            continue
+
+        parts = raster_io.read(raster_path, partial(read_geom_parts, geom),
+                               key=('parts', geom.wkb))
+
+        values = []
+        nodata = []
+        for part, window_data in parts:
+            data, shifted_affine, window, _, _ = window_data
+
+            aoi_key = (part.wkb, window, tuple(shifted_affine))
+            with timing.stage('mask'):
+                if aoi_key not in aois:
+                    aois[aoi_key] = AOI(geom_window_mask(part, window_data,
+                                                         all_touched))
+                values.append(aois[aoi_key].values(data))
+
+                invalid = invalid_cells(window_data)
+                if invalid is not None:
+                    nodata.append(aois[aoi_key].values(invalid))
+
+        layers[raster_path] = (
+            values[0] if len(values) == 1 else np.concatenate(values),
+            None if not nodata else
+            nodata[0] if len(nodata) == 1 else np.concatenate(nodata))
+
+    return layers
+
+
+def stream_geom_values(geom, raster_paths, strip_rows, mods=None,
+                       all_touched=True, progress=None):
+    """
+    The values of the cells of several rasters on the same grid which
+    intersect a geometry, as `geom_values_on_rasters` gives them, but read a
+    strip of `strip_rows` rows of each window at a time, so the memory held
+    is bounded by the size of a strip rather than of the window.
+
+    If given, `progress` is called with the strips done and the total
+    strips before each strip is read, so a job can report its progress and
+    be cancelled between strips.
+
+    Yields:
+        For each strip, a list of the (values, nodata) of each raster, in
+        the order of `raster_paths`
+    """
+    raster_info = raster_io.info(raster_paths[0])
+
+    # Cells one cell beyond a strip are enough to rasterize its cells the
+    # same as the whole polygon would, as in `mask_regions`
+    margin = max(abs(raster_info.transform.a), abs(raster_info.transform.e))
+
+    # Windows are clipped to the raster, as strips are read without cells
+    # beyond its edges
+    parts = []
+    for part in cluster_parts(geom, raster_info):
+        window, shifted_affine = clip_window(
+            get_window_and_affine(part, raster_info), raster_info)
+        (row_start, row_stop), (col_start, col_stop) = window
+        if row_start < row_stop and col_start < col_stop:
+            parts.append((part, (window, shifted_affine)))
+    strips = sum(len(range(window[0][0], window[0][1], strip_rows))
+                 for _, (window, _) in parts)
+    done = 0
+
+    for part, (window, shifted_affine) in parts:
+        (row_start, row_stop), cols = window
+
+        for strip_start in range(row_start, row_stop, strip_rows):
+            if progress:
+                progress(done, strips)
+            done += 1
+
+            strip_stop = min(strip_start + strip_rows, row_stop)
+            strip = ((strip_start, strip_stop), cols)
+            strip_affine = shifted_affine * Affine.translation(
+                0, strip_start - row_start)
+            strip_geom = part.intersection(window_box(
+                strip, raster_info.transform).buffer(margin, join_style=2))
+            if strip_geom.is_empty:
+                continue
+
+            with timing.stage('mask'):
+                aoi = AOI(features.geometry_mask(
+                    [strip_geom],
+                    out_shape=(strip_stop - strip_start, cols[1] - cols[0]),
+                    transform=strip_affine, all_touched=all_touched))
+            if not len(aoi.cells):
+                continue
+
+            layers = []
+            for raster_path in raster_paths:
+                data, nodata = raster_io.read(raster_path,
+                                              partial(read_strip, strip))
+
+                with timing.stage('mask'):
+                    window_data = apply_mods(
+                        (data, strip_affine, strip, None, nodata), mods,
+                        all_touched)
+                    invalid = invalid_cells(window_data)
+                    layers.append((aoi.values(window_data[0]),
+                                   None if invalid is None
+                                   else aoi.values(invalid)))
+
+            yield layers
+
+
+def read_strip(strip, src):
+    """
+    Read a window of a raster, and its nodata as `read_geom_window` gives it
+    """
+    nodata = src.nodata
+    if nodata is None and MaskFlags.per_dataset in src.mask_flag_enums[0]:
+        nodata = src.read_masks(1, window=strip) == 0
+
+    return memmap_io.read(src, strip), nodata
+
+
+def geom_values_decimated(geom, raster_path, factor, mods=None):
+    """
+    The values of the cells of a raster which intersect a geometry, as
+    `geom_values` gives them, but read at 1/`factor` of the raster's
+    resolution.  GDAL reads from overviews of the raster when it has them,
+    so far fewer cells are read and held.
+
+    Returns:
+        For the window of each cluster of parts of `geom`, a 1-D array of
+        the values of each cell of the decimated raster in `geom` which
+        isn't nodata, and the number of cells of the raster each stands
+        for, about `factor`**2
+    """
+    def read_decimated(src):
+        parts = []
+        for part in cluster_parts(geom, src):
+            # Cells beyond the edges of the raster would otherwise be
+            # resampled from the cells within it
+            window, shifted_affine = clip_window(
+                get_window_and_affine(part, src), src)
+            (row_start, row_stop), (col_start, col_stop) = window
+            if row_start >= row_stop or col_start >= col_stop:
+                continue
+            shape = (max((row_stop - row_start) // factor, 1),
+                     max((col_stop - col_start) // factor, 1))
+
+            data = src.read(1, window=window, out_shape=shape)
+            nodata = src.nodata
+            if nodata is None and \
+                    MaskFlags.per_dataset in src.mask_flag_enums[0]:
+                nodata = src.read_masks(1, window=window,
+                                        out_shape=shape) == 0
+
+            decimated_affine = shifted_affine * Affine.scale(
+                (col_stop - col_start) / shape[1],
+                (row_stop - row_start) / shape[0])
+            parts.append((part, (data, decimated_affine, window, None,
+                                 nodata)))
+        return parts
+
+    parts = raster_io.read(raster_path, read_decimated,
+                           key=('decimated', factor, geom.wkb))
+
+    values = []
+    for part, window_data in parts:
+        with timing.stage('mask'):
+            # Touched cells of a coarse grid would overstate the area of
+            # geom, so only cells whose center is in it are counted
+            window_data = apply_mods(window_data, mods, all_touched=False)
+            geom_mask = geom_window_mask(part, window_data, all_touched=False)
+            invalid = invalid_cells(window_data)
+            if invalid is not None:
+                geom_mask |= invalid
+
+            # Windows aren't always a multiple of `factor` cells across
+            data, window = window_data[0], window_data[2]
+            values.append((AOI(geom_mask).values(data),
+                           window_cells(window) / data.size))
+
+    return values
+
+
+class AOI(object):
+    """
+    The cells of a window which intersect a geometry, as flat indices into
+    the window.  The values of each layer read for the window are gathered
+    into a compact 1-D array of just those cells, rather than masking the
+    whole window.
+    """
+    def __init__(self, geom_mask):
+        self.shape = geom_mask.shape
+        self.cells = np.flatnonzero(~geom_mask)
+
+    def values(self, data):
+        return data.take(self.cells)
+
+
+def read_geom_parts(geom, src):
+    """
+    Read the window of each cluster of parts of `geom` with
+    `read_geom_window`
+
+    Returns:
+        A list of (cluster geometry, window data) pairs
+    """
+    return [(part, read_geom_window(part, src))
+            for part in cluster_parts(geom, src)]
+
+
+def read_geom_window(geom, src, indexes=1):
+    """
+    Read the window of a raster which contains the bounding box of `geom`.
+    This has memory implications if that rectangle is large.
+
+    Args:
+        indexes (optional int|None): The band to read, or None to read every
+            band into a 3-D array of (band, row, col)
+
+    Returns:
+        The data of the window, the affine transformation which maps geom
+        coordinates onto it, the window, the regions of the window
+        classified by `classify_window`, if it was split, and the nodata
+        value of the raster.  Rasters without a nodata value but with an
+        internal mask give a boolean array of the cells it excludes.
+    """
+    window, shifted_affine = get_window_and_affine(geom, src)
+    regions = classify_window(geom, window, src)
+
+    nodata = src.nodata
+    internal_mask = nodata is None and \
+        MaskFlags.per_dataset in src.mask_flag_enums[0]
+
+    if regions is None:
+        data = memmap_io.read(src, window) if indexes == 1 else \
+            src.read(indexes, window=window)
+        if internal_mask:
+            nodata = src.read_masks(1, window=window) == 0
+        return data, shifted_affine, window, None, nodata
+
+    # Only blocks of the window which intersect the polygon are read, the
+    # rest are left as nodata and masked
+    (row_start, row_stop), (col_start, col_stop) = window
+    shape = (row_stop - row_start, col_stop - col_start)
+    if internal_mask:
+        nodata = np.ones(shape, dtype=bool)
+    if indexes is None:
+        shape = (src.count,) + shape
+
+    data = np.zeros(shape, dtype=src.dtypes[0])
+    if nodata is not None and not internal_mask:
+        data.fill(nodata)
+
+    for region in regions[0] + regions[1]:
+        # Empty tiles of sparse rasters would only be read as nodata
+        if sparse_region(src, region):
+            continue
+
+        slices = relative_slices(region, window)
+        data[(Ellipsis,) + slices] = memmap_io.read(src, region) \
+            if indexes == 1 else src.read(indexes, window=region)
+        if internal_mask:
+            nodata[slices] = src.read_masks(1, window=region) == 0
+
+    return data, shifted_affine, window, regions, nodata
+
+
+def sparse_region(src, region):
+    """
+    Whether none of the tiles of a region of a GeoTIFF with a nodata value
+    are stored in the file, as in sparse GeoTIFFs.  Missing tiles read as
+    nodata, so the region doesn't need to be read or decoded.
+    """
+    if src.driver != 'GTiff' or src.nodata is None:
+        return False
+
+    tile_rows, tile_cols = src.block_shapes[0]
+    (row_start, row_stop), (col_start, col_stop) = region
+    for row in range(row_start // tile_rows, (row_stop - 1) // tile_rows + 1):
+        for col in range(col_start // tile_cols,
+                         (col_stop - 1) // tile_cols + 1):
+            # The size of a tile which isn't in the file can't be determined
+            try:
+                src.block_size(1, row, col)
+                return False
+            except RasterBlockError:
+                pass
+
+    return True
+
+
+def mask_window(geom, window_data, mods=None, all_touched=True):
+    """
+    Apply modifications to a window read by `read_geom_window` and mask the
+    cells which don't intersect `geom`
+    """
+    with timing.stage('mask'):
+        window_data = apply_mods(window_data, mods, all_touched)
+        data, shifted_affine, _, _, _ = window_data
+        geom_mask = geom_window_mask(geom, window_data, all_touched)
+
+        # Nodata cells are masked along with cells outside the geometry
+        invalid = invalid_cells(window_data)
+        if invalid is not None:
+            geom_mask |= invalid
+
+    # Mask the data array, with modifications applied, by the query polygon
+    return np.ma.array(data=data, mask=geom_mask), shifted_affine
+
+
+def apply_mods(window_data, mods, all_touched=True):
+    """
+    Burn new raster values in from provided vector modifications.  Mods are
+    applied in order, so later polygons will overwrite previous ones if they
+    overlap.  This copies over the data of the window in place, on every
+    band of a stack.  The modifications of a stored Scenario are burned in
+    from the cells they were rasterized to for the raster's grid.
+
+    Returns:
+        The window data, with a copy of a read-only window such as a view of
+        a memory mapped raster
+    """
+    data, shifted_affine, _, _, _ = window_data
+    if not mods:
+        return window_data
+
+    if not data.flags.writeable:
+        data = data.copy()
+        window_data = (data,) + window_data[1:]
+
+    for band in (data if data.ndim == 3 else [data]):
+        if isinstance(mods, scenario_store.Scenario):
+            mods.burn(band, shifted_affine, all_touched)
+            continue
 
-    # Burn new raster values in from provided vector modifications. Mods
-    # are applied in order, so later polygons will overwrite previous ones
-    # if they overlap
-    if mods:
-        # This copies over `data` in place.
         for mod in mods:
             features.rasterize(
                 [(mod['geom'], mod['newValue'])],
-                out=data,
+                out=band,
                 transform=shifted_affine,
                 all_touched=all_touched,
             )
 
-    # Create a numpy array to mask cells which don't intersect with the
-    # polygon. Cells that intersect will have value of 0 (unmasked), the
-    # rest are filled with 1s (masked)
-    geom_mask = features.geometry_mask(
-        [geom],
-        out_shape=data.shape,
-        transform=shifted_affine,
-        all_touched=all_touched
-    )
+    return window_data
 
-    # Mask the data array, with modifications applied, by the query polygon
-    return np.ma.array(data=data, mask=geom_mask), shifted_affine
+
+def geom_window_mask(geom, window_data, all_touched=True):
+    """
+    Create a numpy array to mask cells of a window read by
+    `read_geom_window` which don't intersect with the polygon.  Cells that
+    intersect will have value of 0 (unmasked), the rest are filled with 1s
+    (masked).
+    """
+    data, shifted_affine, window, regions, _ = window_data
+
+    if regions is None:
+        geom_mask = features.geometry_mask(
+            [geom],
+            out_shape=data.shape[-2:],
+            transform=shifted_affine,
+            all_touched=all_touched
+        )
+    else:
+        # Each rasterize call outside of an environment starts one
+        with raster_io.env():
+            geom_mask = mask_regions(geom, window, shifted_affine,
+                                     regions[0], regions[1], all_touched)
+
+    # Every band of a stack shares the mask of the geometry
+    if data.ndim == 3:
+        geom_mask = np.repeat(geom_mask[np.newaxis], data.shape[0], axis=0)
+
+    return geom_mask
+
+
+def invalid_cells(window_data):
+    """
+    A boolean array of the cells of a window read by `read_geom_window`
+    which are nodata, or None if the raster has no nodata.  Cells of a
+    stack are invalid where any of its bands is nodata.
+    """
+    data, _, _, _, nodata = window_data
+    if nodata is None:
+        return None
+
+    if isinstance(nodata, np.ndarray):
+        invalid = nodata
+    elif np.isnan(nodata):
+        invalid = np.isnan(data)
+    else:
+        invalid = data == nodata
+
+    if invalid.ndim == 3:
+        invalid = invalid.any(axis=0)
+
+    return invalid
+
+
+def mask_geom_on_stack(geom, raster_paths, all_touched=True):
+    """
+    Mask a geometry on every band of a stack of aligned rasters, such as land
+    cover of several years, as separate single band rasters or as bands of
+    one raster.  All bands of each raster are read for the window of `geom`
+    in a single read.
+
+    Returns:
+        A 3-D masked array of (band, row, col), with the bands of each
+        raster in order and the same mask on each band, and the affine
+        transformation of the window
+    """
+    read_bands = partial(read_geom_window, geom, indexes=None)
+    reads = [raster_io.read(raster_path, read_bands, key=('stack', geom.wkb))
+             for raster_path in raster_paths]
+
+    _, shifted_affine, window, regions, _ = reads[0]
+    for raster_path, (_, other_affine, other_window, _, _) in zip(
+            raster_paths, reads):
+        if other_window != window or other_affine != shifted_affine:
+            raise UserInputError(
+                '{} is not aligned with {}'.format(raster_path,
+                                                   raster_paths[0]))
+
+    # Blocks which weren't read are outside the geometry on every raster,
+    # so the regions of the first raster mask the whole stack.  Cells are
+    # masked on every band where any raster is nodata.
+    data = np.concatenate([read[0] for read in reads])
+    invalid = [cells for cells in map(invalid_cells, reads)
+               if cells is not None]
+    nodata = np.logical_or.reduce(invalid) if invalid else None
+
+    return mask_window(geom, (data, shifted_affine, window, regions, nodata),
+                       all_touched=all_touched)
+
+
+def cluster_parts(geom, raster_src):
+    """
+    Group the parts of a multi-part geometry into clusters which are read
+    in a window each.  Parts are clustered when their windows overlap, or
+    when a window around both of them would be no more than twice the size
+    of their separate windows.
+
+    Returns:
+        A list of geometries, which is just `geom` if its parts are close
+    """
+    parts = getattr(geom, 'geoms', None)
+    if parts is None or len(parts) < 2:
+        return [geom]
+
+    clusters = [([part], get_window_and_affine(part, raster_src)[0])
+                for part in parts]
+
+    # Merge clusters in passes until no more can be merged
+    merged = True
+    while merged:
+        merged = False
+        remaining = []
+        for cluster_parts_, window in clusters:
+            for idx, (other_parts, other_window) in enumerate(remaining):
+                union = union_window(window, other_window)
+                if windows_overlap(window, other_window) or \
+                        window_cells(union) <= 2 * (
+                            window_cells(window) + window_cells(other_window)):
+                    remaining[idx] = (other_parts + cluster_parts_, union)
+                    merged = True
+                    break
+            else:
+                remaining.append((cluster_parts_, window))
+        clusters = remaining
+
+    if len(clusters) == 1:
+        return [geom]
+
+    return [cluster[0] if len(cluster) == 1 else type(geom)(cluster)
+            for cluster, _ in clusters]
+
+
+def windows_overlap(window, other):
+    (row_start, row_stop), (col_start, col_stop) = window
+    (other_row_start, other_row_stop), (other_col_start, other_col_stop) = \
+        other
+    return row_start < other_row_stop and other_row_start < row_stop and \
+        col_start < other_col_stop and other_col_start < col_stop
+
+
+def union_window(window, other):
+    return ((min(window[0][0], other[0][0]), max(window[0][1], other[0][1])),
+            (min(window[1][0], other[1][0]), max(window[1][1], other[1][1])))
+
+
+def window_cells(window):
+    (row_start, row_stop), (col_start, col_stop) = window
+    return (row_stop - row_start) * (col_stop - col_start)
 
 
 def get_window_and_affine(geom, raster_src):
@@ -108,7 +662,7 @@ def get_window_and_affine(geom, raster_src):
     # Create a window range from the bounds
     ul = raster_src.index(*geom.bounds[0:2])
     lr = raster_src.index(*geom.bounds[2:4])
-    window = ((lr[0], ul[0]+1), (ul[1], lr[1]+1))
+    window = ((int(lr[0]), int(ul[0])+1), (int(ul[1]), int(lr[1])+1))
 
     # Create an affine transformation relative to that window.  Still a little
     # opaque to me and lifted from:
@@ -121,6 +675,176 @@ def get_window_and_affine(geom, raster_src):
     return window, shifted_affine
 
 
+def clip_window(window_and_affine, raster_src):
+    """
+    Clip a window given by `get_window_and_affine` to the extent of a
+    raster, and shift its affine transformation to match
+
+    Returns:
+        The clipped window, which is empty if the window is entirely beyond
+        the raster, and its affine transformation
+    """
+    window, shifted_affine = window_and_affine
+    (row_start, row_stop), (col_start, col_stop) = window
+
+    clipped = ((max(row_start, 0), min(row_stop, raster_src.height)),
+               (max(col_start, 0), min(col_stop, raster_src.width)))
+    clipped_affine = shifted_affine * Affine.translation(
+        clipped[1][0] - col_start, clipped[0][0] - row_start)
+
+    return clipped, clipped_affine
+
+
+def classify_window(geom, window, raster_src):
+    """
+    Split a window of a tiled raster into regions inside `geom` and blocks on
+    its boundary, dropping blocks outside of it.  Blocks are about
+    settings.MASK_BLOCK_SIZE cells square and aligned to the raster's tiles,
+    and the window is split in quarters until each part is entirely inside,
+    entirely outside, or a single block.  Long, skinny or multi-part
+    polygons, whose windows are mostly empty, then only read and mask a
+    fraction of them.
+
+    Returns:
+        Lists of the windows of regions inside `geom` and of blocks on its
+        boundary, or None when the raster isn't tiled, or the window is too
+        small to be worth splitting or isn't within the raster
+    """
+    # Cells of a striped raster are read a whole row at a time, so only
+    # skipping tiles saves any reading.  Blocks are whole tiles, so no tile
+    # is read twice.
+    size = settings.MASK_BLOCK_SIZE
+    if not size or not raster_src.is_tiled:
+        return None
+
+    tile_size = raster_src.block_shapes[0][0]
+    size = max(size // tile_size, 1) * tile_size
+
+    (row_start, row_stop), (col_start, col_stop) = window
+    if (row_stop - row_start) * (col_stop - col_start) <= 4 * size**2:
+        return None
+    if row_start < 0 or col_start < 0 or row_stop > raster_src.height or \
+            col_stop > raster_src.width:
+        return None
+
+    prepared = prepare(geom)
+    inside = []
+    boundary = []
+
+    # Ranges of block rows and columns still to be classified
+    pending = [(row_start // size, (row_stop - 1) // size + 1,
+                col_start // size, (col_stop - 1) // size + 1)]
+
+    while pending:
+        block_rows, block_rows_stop, block_cols, block_cols_stop = \
+            pending.pop()
+        region = ((max(block_rows * size, row_start),
+                   min(block_rows_stop * size, row_stop)),
+                  (max(block_cols * size, col_start),
+                   min(block_cols_stop * size, col_stop)))
+
+        region_box = window_box(region, raster_src.transform)
+        if not prepared.intersects(region_box):
+            continue
+
+        if prepared.contains(region_box):
+            inside.append(region)
+            continue
+
+        rows = block_rows_stop - block_rows
+        cols = block_cols_stop - block_cols
+        if rows == 1 and cols == 1:
+            boundary.append(region)
+            continue
+
+        row_splits = [(block_rows, block_rows + rows // 2),
+                      (block_rows + rows // 2, block_rows_stop)] \
+            if rows > 1 else [(block_rows, block_rows_stop)]
+        col_splits = [(block_cols, block_cols + cols // 2),
+                      (block_cols + cols // 2, block_cols_stop)] \
+            if cols > 1 else [(block_cols, block_cols_stop)]
+
+        pending.extend(row_split + col_split for row_split in row_splits
+                       for col_split in col_splits)
+
+    return inside, boundary
+
+
+def mask_regions(geom, window, shifted_affine, inside, boundary,
+                 all_touched=True):
+    """
+    Build the mask of `geom` over a window from its classified regions.
+    Regions inside `geom` are unmasked and it is only rasterized over the
+    boundary blocks, everything else is masked.
+    """
+    (row_start, row_stop), (col_start, col_stop) = window
+    shape = (row_stop - row_start, col_stop - col_start)
+
+    # Each rasterization has a fixed cost, so when there are many boundary
+    # blocks a single rasterization of the window is faster
+    if len(boundary) * RASTERIZE_OVERHEAD_CELLS > shape[0] * shape[1]:
+        return features.geometry_mask([geom], out_shape=shape,
+                                      transform=shifted_affine,
+                                      all_touched=all_touched)
+
+    geom_mask = np.ones(shape, dtype=bool)
+
+    for region in inside:
+        geom_mask[relative_slices(region, window)] = False
+
+    # Cells one cell beyond a block are enough to rasterize its cells the
+    # same as the whole polygon would, and all touched rasterization walks
+    # every edge of the polygon, so each block only rasterizes its part
+    margin = max(abs(shifted_affine.a), abs(shifted_affine.e))
+
+    for region in boundary:
+        (region_row, region_row_stop), (region_col, region_col_stop) = region
+        region_affine = shifted_affine * Affine.translation(
+            region_col - col_start, region_row - row_start)
+        region_box = window_box(
+            ((0, region_row_stop - region_row),
+             (0, region_col_stop - region_col)), region_affine)
+
+        geom_mask[relative_slices(region, window)] = features.geometry_mask(
+            [geom.intersection(region_box.buffer(margin, join_style=2))],
+            out_shape=(region_row_stop - region_row,
+                       region_col_stop - region_col),
+            transform=region_affine,
+            all_touched=all_touched
+        )
+
+    return geom_mask
+
+
+def prepare(geom):
+    """
+    The prepared geometry of `geom`, which is kept on geometries cached
+    across requests, such as registered query polygons
+    """
+    prepared = getattr(geom, 'prepared', None)
+    return prepared if prepared is not None else prep(geom)
+
+
+def window_box(window, transform):
+    """
+    The extent of a window of cells as a Shapely box
+    """
+    (row_start, row_stop), (col_start, col_stop) = window
+    return box(transform.c + col_start * transform.a,
+               transform.f + row_stop * transform.e,
+               transform.c + col_stop * transform.a,
+               transform.f + row_start * transform.e)
+
+
+def relative_slices(region, window):
+    """
+    Slices of an array read for `window` which hold the cells of `region`
+    """
+    (row_start, row_stop), (col_start, col_stop) = region
+    return (slice(row_start - window[0][0], row_stop - window[0][0]),
+            slice(col_start - window[1][0], col_stop - window[1][0]))
+
+
 def reproject(geom, to_srs='epsg:5070', from_srs='epsg:4326'):
     """"
     Reproject `geom` from one spatial ref to another
@@ -137,13 +861,25 @@ def reproject(geom, to_srs='epsg:5070', from_srs='epsg:4326'):
         Shapely Geometry with coordinates transformed to the desired srs
 
     """
-    projection = partial(
-        pyproj.transform,
-        pyproj.Proj(init=from_srs),
-        pyproj.Proj(init=to_srs),
-    )
+    return transform(get_projection(from_srs, to_srs), geom)
 
-    return transform(projection, geom)
+
+def get_projection(from_srs, to_srs):
+    """
+    Get a function which transforms coordinates between two spatial refs.
+    Initializing a pyproj projection parses its definition, so they are
+    kept for the life of the process.
+    """
+    key = (from_srs, to_srs)
+    projection = PROJECTIONS.get(key)
+    if projection is None:
+        projection = PROJECTIONS[key] = partial(
+            pyproj.transform,
+            pyproj.Proj(init=from_srs),
+            pyproj.Proj(init=to_srs),
+        )
+
+    return projection
 
 
 def color_table_to_palette(src):
@@ -172,7 +908,7 @@ def color_table_to_palette(src):
         return None
 
 
-def tile_read(geom, raster_path):
+def tile_read(geom, raster_path, tile_size=256):
     """
     Decimated read against raster_path to fit into a 256x256 ndarry tile.
     Resampling method is NEAREST NEIGHBOR and is not configurable.  This allows
@@ -187,19 +923,28 @@ def tile_read(geom, raster_path):
             EPSG:3857.  If raster contains and integer ColorTable, a PIL
             palette will be returned with those values
 
+        tile_size (optional int): Width and height of the returned array,
+            larger sizes are used to read a metatile of several tiles
+
     Returns:
         ndarray of decimated read of source raster in a EPSG:3857 transformed
             grid
 
         palette (ndarray uint8) of RGB colors defined in raster ColorTable
     """
-    tile_size = 256
-    with rasterio.open(raster_path) as src:
+    def read_tile(src):
         window, _ = get_window_and_affine(geom, src)
-        tile = src.read(1, window=window, out_shape=(1, tile_size, tile_size))
+        tile = memmap_io.read(src, window,
+                              out_shape=(1, tile_size, tile_size))
+
+        if raster_path not in PALETTES:
+            PALETTES[raster_path] = color_table_to_palette(src)
+
+        return tile
 
-        palette = color_table_to_palette(src)
-        return tile, palette
+    tile = raster_io.read(raster_path, read_tile,
+                          key=('tile', geom.bounds, tile_size))
+    return tile, PALETTES[raster_path]
 
 
 def tile_to_bbox(zoom, x, y):
@@ -232,6 +977,65 @@ def tile_to_bbox(zoom, x, y):
     return box(min_x, min_y, max_x, max_y, ccw=False)
 
 
+def lnglat_to_tile(lng, lat, zoom):
+    """
+    Find the Slippy Map style tile (z/x/y) which contains a geographic
+    coordinate
+
+    Args:
+        lng (float): Longitude in EPSG:4326
+        lat (float): Latitude in EPSG:4326
+        zoom (int): Zoom level for the tile
+
+    Returns:
+        x and y coordinate of the tile, clamped to the tiles at that zoom
+    """
+    tile_count = 2**zoom
+    lat_rad = math.radians(max(min(lat, 85.0511), -85.0511))
+    x = (lng + 180.0) / 360.0 * tile_count
+    y = (1.0 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) \
+        / 2.0 * tile_count
+
+    def clamp(val):
+        return min(max(int(val), 0), tile_count - 1)
+
+    return clamp(x), clamp(y)
+
+
+def metatile_origin(zoom, x, y, size):
+    """
+    Find the metatile which contains a tile.  Metatiles are aligned to
+    multiples of `size` tiles, and are smaller at zooms with fewer tiles.
+
+    Args:
+        zoom (int): Zoom level for the tile
+        x (int): x coordinate of tile origin
+        y (int): y coordinate of tile origin
+        size (int): Number of tiles along each side of a metatile
+
+    Returns:
+        The x and y coordinate of the upper left tile of the metatile and the
+        number of tiles along each of its sides
+    """
+    size = min(size, 2**zoom)
+    return x - x % size, y - y % size, size
+
+
+def metatile_to_bbox(zoom, x, y, size):
+    """
+    Web mercator bounding box of a `size` x `size` block of tiles whose upper
+    left tile is z/x/y
+
+    Returns:
+        A Shapely geometry in EPSG:3857 defining the bounding box of the
+        metatile
+    """
+    min_x, _, _, max_y = tile_to_bbox(zoom, x, y).bounds
+    _, min_y, max_x, _ = tile_to_bbox(zoom, x + size - 1, y + size - 1).bounds
+
+    return box(min_x, min_y, max_x, max_y, ccw=False)
+
+
 def interpolate_points(line):
     """
     Break a line into linear points
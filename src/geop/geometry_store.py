@@ -0,0 +1,162 @@
+"""
+Query geometries sent as WKB or registered ahead of time.  A registered
+geometry is reprojected into the SRS of the rasters once, when it's POSTed
+to /geometries, and kept in a SQLite file at settings.GEOMETRY_STORE_PATH,
+so analyses reference it by id without sending, parsing or reprojecting its
+vertices.  Recently used geometries, registered or sent as WKB, are cached
+in memory along with their prepared geometry.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+
+from shapely import wkb
+from shapely.prepared import prep
+
+import settings
+
+from cache import LRUCache
+from geo_utils import reproject
+
+# Open stores, keyed by file path
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+# Recently used geometries, keyed by id
+GEOMETRIES = LRUCache(settings.GEOMETRY_CACHE_SIZE)
+
+
+def geometry_id(data, srs):
+    """
+    A hash of the WKB of a geometry and its SRS, so the same geometry is
+    always registered and cached with the same id
+    """
+    digest = hashlib.sha1(srs.encode('utf-8') + b':')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def cache_geometry(key, geom, srs):
+    """
+    Cache a geometry in the SRS of the rasters, with its prepared geometry
+    for the tests of which blocks it covers, and its id, which identifies it
+    in result cache keys in place of its WKB
+    """
+    geom.geometry_id = key
+    geom.srs = srs
+    geom.prepared = prep(geom)
+
+    GEOMETRIES.set(key, geom)
+    return geom
+
+
+def from_wkb(data, to_srs, from_srs='epsg:4326'):
+    """
+    Parse and reproject WKB, or take the geometry from the cache when the
+    same WKB was parsed before
+
+    Raises:
+        ValueError: If `data` isn't valid WKB
+    """
+    key = geometry_id(data, from_srs + ':' + to_srs)
+    geom = GEOMETRIES.get(key)
+    if geom is None:
+        try:
+            geom = wkb.loads(data)
+        except Exception:
+            raise ValueError('Invalid WKB')
+
+        if from_srs != to_srs:
+            geom = reproject(geom, to_srs, from_srs)
+        geom = cache_geometry(key, geom, to_srs)
+
+    return geom
+
+
+class GeometryStore(object):
+    """
+    Registered geometries, as WKB in the SRS they were reprojected to
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS geometries (
+                id TEXT PRIMARY KEY,
+                srs TEXT,
+                geom BLOB)
+        """)
+
+    def get_geometry(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT srs, geom FROM geometries WHERE id = ?',
+                (key,)).fetchone()
+        if not row:
+            return None
+
+        return wkb.loads(bytes(row[1])), row[0]
+
+    def put_geometry(self, key, geom, srs):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO geometries VALUES (?, ?, ?)',
+                (key, srs, sqlite3.Binary(geom.wkb)))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def get_store():
+    """
+    The geometry store at settings.GEOMETRY_STORE_PATH, created if it
+    doesn't exist yet, or None if there's no path or its directory is
+    missing
+    """
+    path = settings.GEOMETRY_STORE_PATH
+    store = STORES.get(path)
+    if store is None:
+        if not path or not os.path.isdir(os.path.dirname(path) or '.'):
+            return None
+
+        with STORES_LOCK:
+            store = STORES.get(path)
+            if store is None:
+                store = STORES[path] = GeometryStore(path)
+
+    return store
+
+
+def register_geometry(geom, srs):
+    """
+    Store a geometry which has been reprojected into `srs`
+
+    Returns:
+        The id of the geometry
+    """
+    key = geometry_id(geom.wkb, srs)
+    store = get_store()
+    if store:
+        store.put_geometry(key, geom, srs)
+
+    cache_geometry(key, geom, srs)
+    return key
+
+
+def get_geometry(key):
+    """
+    A registered geometry, with its `srs`, or None if there isn't one with
+    the id
+    """
+    geom = GEOMETRIES.get(key)
+    if geom is None:
+        store = get_store()
+        stored = store.get_geometry(key) if store else None
+        if stored is not None:
+            geom = cache_geometry(key, *stored)
+
+    return geom
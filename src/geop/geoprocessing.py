@@ -4,11 +4,20 @@ import collections
 import itertools
 import numpy as np
 import rasterio
+import histogram_index
+import planner
+import raster_io
+import settings
+import timing
 
-from geo_utils import mask_geom_on_raster, interpolate_points
+from geo_utils import (geom_values, geom_values_decimated,
+                       geom_values_on_rasters, mask_geom_on_raster,
+                       mask_geom_on_stack, mask_geom_parts,
+                       interpolate_points, stream_geom_values)
 
 
-def count(geom, raster_path, modifications=None):
+def count(geom, raster_path, modifications=None, approximate=False,
+          progress=None):
     """
     Perform a cell count analysis on a portion of a provided raster.
 
@@ -29,6 +38,17 @@ def count(geom, raster_path, modifications=None):
                 in areas where it intersects geom.  Modifications are applied
                 in order, meaning subsequent items can overwrite earlier ones.
 
+        approximate (optional bool): Count from the block histogram index of
+            the raster without reading it, weighting blocks on the boundary
+            of `geom` by the fraction of them it covers.  Rasters without an
+            index are counted exactly, unless the window of `geom` is too
+            large to hold in memory, when they're counted at a lower
+            resolution.
+
+        progress (optional function): Called with the strips counted and
+            the total strips, when the window of `geom` is counted a strip
+            at a time.
+
     Returns:
         total (int): total number of cells included in census
 
@@ -37,23 +57,106 @@ def count(geom, raster_path, modifications=None):
 
     """
 
-    masked_data, _ = mask_geom_on_raster(geom, raster_path, modifications)
-    return masked_array_count(masked_data)
+    if not modifications:
+        counts = index_count(geom, raster_path, approximate)
+        if counts is not None:
+            return counts
+
+    run = planner.plan(geom, [raster_path], approximate=approximate)
+    if run.mode == planner.STREAM:
+        return stream_count(geom, raster_path, run.strip_rows, modifications,
+                            progress)
+    if run.mode == planner.DECIMATE:
+        return decimated_count(geom, raster_path, run.factor, modifications)
+
+    values = geom_values(geom, raster_path, modifications)
+    return count_values(values)
+
+
+def stream_count(geom, raster_path, strip_rows, modifications=None,
+                 progress=None):
+    """
+    Counts of the cells of a raster in `geom`, as `count` gives them, from
+    a strip of the window of `geom` at a time
+    """
+    total = 0
+    count_map = collections.Counter()
+    for layers in stream_geom_values(geom, [raster_path], strip_rows,
+                                     modifications, progress=progress):
+        strip_total, strip_counts = count_values(valid_values(layers)[0])
+        total += strip_total
+        count_map.update(strip_counts)
+
+    return total, dict(count_map)
+
+
+def decimated_count(geom, raster_path, factor, modifications=None):
+    """
+    Approximate counts of the cells of a raster in `geom`, from the raster
+    read at 1/`factor` of its resolution.  Each cell read is counted as the
+    cells of the raster it stands for, about `factor`**2 of them.
+    """
+    total = 0
+    count_map = collections.Counter()
+    for values, cells in geom_values_decimated(geom, raster_path, factor,
+                                               modifications):
+        part_total, part_counts = count_values(values)
+        total += part_total * cells
+        count_map.update({value: count * cells
+                          for value, count in part_counts.items()})
+
+    return int(round(total)), {value: int(round(count))
+                               for value, count in count_map.items()}
+
+
+def index_count(geom, raster_path, approximate=False):
+    """
+    Counts from the block histogram index of a raster, or None if it has no
+    index or `geom` is too small to benefit from it
+    """
+    # Large polygons over an indexed raster sum the histograms of interior
+    # blocks and only read blocks on their boundary
+    index = histogram_index.get_index(raster_path)
+    if index is not None:
+        if approximate:
+            return index.approximate_count(geom)
+        if index.window_cells(geom) >= settings.HISTOGRAM_MIN_CELLS:
+            return index.count(geom, raster_path)
+
+    return None
 
 
 def masked_array_count(masked_data):
-    # Perform count using numpy built-ins.  Compressing the masked array
-    # creates a 1D array of just unmasked values.  May be able to speed up
-    # by using scipy count_tier_group, but this is working well for now
-    values, counts = np.unique(masked_data.compressed(), return_counts=True)
+    """
+    Counts of the unmasked cells of a whole window, as masked by
+    `mask_geom_on_raster`.  Analyses count the flat arrays of
+    `geom_values` instead; this is kept for callers which mask a window
+    themselves, such as the tests of modifications, and as the reference
+    the clustered, streamed and indexed counts are checked against.
+    """
+    # Compressing the masked array creates a 1D array of just unmasked values
+    return count_values(masked_data.compressed())
+
+
+@timing.timed('compute')
+def count_values(values):
+    # Small non-negative integers, such as land cover classes, are counted
+    # in a single pass.  Anything else is sorted by np.unique.
+    if small_classes(values):
+        counts = np.bincount(values)
+        classes = np.flatnonzero(counts)
+        counts = counts[classes]
+        classes = classes.astype(values.dtype)
+    else:
+        classes, counts = np.unique(values, return_counts=True)
 
     # Make dict of val: count with string keys for valid json
-    count_map = dict(zip(map(str, values), counts))
+    count_map = dict(zip(map(str, classes), counts))
 
-    return masked_data.count(), count_map
+    return values.size, count_map
 
 
-def count_pairs(geom, raster_paths):
+def count_pairs(geom, raster_paths, progress=None):
     """
     Perform a cell count analysis on groupings of cells from 2 rasters stacked
     on top of each other.
@@ -65,64 +168,289 @@ def count_pairs(geom, raster_paths):
         raster_paths (list<string>): Two local file paths to geographic rasters
             containing values to group and count.
 
+        progress (optional function): Called with the strips counted and
+            the total strips, when the rasters are read a strip at a time.
+
     Returns:
         pairs (dict): Grouped pairs as key with count of number of occurrences
             within the two rasters masked by geom
             ex:  { cell1_rastA::cell1_rastB: 42 }
     """
 
-    # Read in two rasters and mask geom on both of them
-    layers = tuple(mask_geom_on_raster(geom, raster_path)[0]
-                   for raster_path in raster_paths)
+    run = planner.plan(geom, raster_paths)
+    if run.mode == planner.STREAM:
+        pairs = collections.Counter()
+        for layers in stream_geom_values(geom, raster_paths, run.strip_rows,
+                                         progress=progress):
+            pairs.update(count_pairs_from_values(valid_values(layers)))
+        return dict(pairs)
 
-    # Take the two masked arrays, and stack them along the third axis
-    # Effectively: [[cell_1a, cell_1b], [cell_2a, cell_2b], ..],[[...]]
-    pairs = np.ma.dstack(layers)
+    # Read the cells of geom on both rasters, and count the cells which
+    # aren't nodata on either
+    layers = geom_values_on_rasters(geom, raster_paths)
+    return count_pairs_from_values(valid_values([layers[raster_path]
+                                                 for raster_path
+                                                 in raster_paths]))
 
-    # Get the array in 2D form
-    arr = pairs.reshape(-1, pairs.shape[-1])
 
-    # Remove Rows which have masked values
-    trim_arr = np.ma.compress_rowcols(arr, 0)
+def valid_values(layers):
+    """
+    The values of each of several layers given by `geom_values_on_rasters`
+    at the cells which aren't nodata on any of them
+    """
+    invalid = [nodata for _, nodata in layers if nodata is not None]
+    if not invalid:
+        return [values for values, _ in layers]
+
+    valid = ~np.logical_or.reduce(invalid)
+    return [values[valid] for values, _ in layers]
 
-    # Lexicographically sort so that repeated pairs follow one another
-    sorted_arr = trim_arr[np.lexsort(trim_arr.T), :]
 
-    # The difference between index n and n+1 in sorted_arr, for each index.
-    # Since it's sorted, repeated entries will have a value of 0 at that index
-    diff_sort = np.diff(sorted_arr, axis=0)
+@timing.timed('compute')
+def count_pairs_from_values(layers):
+    # Values of both layers are formatted in a common type, as when stacked
+    dtype = np.result_type(*layers)
 
-    # True or False value for each index of diff_sort based on a diff_sort
-    # having truthy or falsey values.  Indexes with no change (0 values) will
-    # be represented as False in this array
-    indexes_changed_mask = np.any(diff_sort, 1)
+    # Index the values of each layer in its distinct classes, and number
+    # each pair of classes so every pair is counted by a single bincount
+    classes_a, idx_a = value_classes(layers[0].astype(dtype))
+    classes_b, idx_b = value_classes(layers[1].astype(dtype))
+    counts = np.bincount(idx_a * len(classes_b) + idx_b)
 
-    # Get the indexes that are True, indicating an index of sorted_arr that has
-    # a difference with its preceding value - ie, it represents a new
-    # occurrence of a value
-    diff_indexes = np.where(indexes_changed_mask)[0]
+    # Map the pairs to the count, compressing values to keys in this format:
+    #   cell_r1::cell_r2
+    pairs = np.flatnonzero(counts)
+    return {
+        str(classes_a[pair // len(classes_b)]) + '::' +
+        str(classes_b[pair % len(classes_b)]): counts[pair]
+        for pair in pairs
+    }
 
-    # Get the rows at the diff indexes, these are unique at each index
-    unique_rows = [sorted_arr[i] for i in diff_indexes] + [sorted_arr[-1]]
 
-    # Prepend a -1 on the list of diff_indexes and append the index of the last
-    # unique row, resulting in an array of index changes with fenceposts on
-    # both sides.  ie, `[-1, ...list of diff indexes..., <idx of last sorted>]`
-    idx_of_last_val = sorted_arr.shape[0] - 1
-    diff_idx_with_start = np.insert(diff_indexes, 0, -1)
-    fencepost_diff_indexes = np.append(diff_idx_with_start, idx_of_last_val)
+def small_classes(values):
+    """
+    Whether values are non-negative integers small enough to be counted by
+    np.bincount rather than sorted
+    """
+    return np.can_cast(values.dtype, np.int64) and \
+        values.dtype.kind in 'ui' and values.size and \
+        values.min() >= 0 and values.max() < 65536
 
-    # Get the number of occurrences of each unique row based on the difference
-    # between the indexes at which they change.  Since we put fenceposts up,
-    # we'll get a count for the first and last elements of the diff indexes
-    counts = np.diff(fencepost_diff_indexes)
 
-    # Map the pairs to the count, compressing values to keys in this format:
-    #   cell_r1::cell_r2
-    pair_counts = zip(unique_rows, counts)
-    pair_map = {str(k[0]) + '::' + str(k[1]): cnt for k, cnt in pair_counts}
+def value_classes(values):
+    """
+    The distinct values of an array, and the index of each value in them,
+    as returned by np.unique with `return_inverse`
+    """
+    if not small_classes(values):
+        return np.unique(values, return_inverse=True)
+
+    present = np.bincount(values) > 0
+    classes = np.flatnonzero(present).astype(values.dtype)
+    lookup = np.cumsum(present) - 1
+
+    return classes, lookup[values]
+
+
+def analyze(geom, analyses):
+    """
+    Run several analyses over the same area of interest, reading the window
+    of each raster once and rasterizing the mask once for every raster on
+    the same grid.
+
+    Args:
+        geom (Shapley Geometry): A polygon in the same SRS as the rasters
+            which will define the area of analysis.
+
+        analyses (list): (operation, raster paths, stat) tuples, where
+            operation is `counts` or `stats` of one raster, or `pair-counts`
+            of two, and stat is the statistic of `stats`
+
+    Returns:
+        List of the result of each analysis, as returned by its endpoint
+    """
+    # Counts of rasters with a histogram index may not need a read
+    counts = {}
+    for operation, raster_paths, _ in analyses:
+        if operation == 'counts' and raster_paths[0] not in counts:
+            counts[raster_paths[0]] = index_count(geom, raster_paths[0])
+
+    read_paths = []
+    for operation, raster_paths, _ in analyses:
+        read_paths.extend(raster_path for raster_path in raster_paths
+                          if raster_path not in read_paths and
+                          (operation != 'counts' or
+                           counts[raster_path] is None))
+
+    # When the rasters can't all be held at once, each analysis is planned
+    # and run on its own
+    if read_paths and planner.plan(geom, read_paths).mode != planner.MEMORY:
+        layers = None
+    else:
+        layers = geom_values_on_rasters(geom, read_paths)
+
+    results = []
+    for operation, raster_paths, stat in analyses:
+        if operation == 'counts':
+            if counts[raster_paths[0]]:
+                total, count_map = counts[raster_paths[0]]
+            elif layers is None:
+                total, count_map = count(geom, raster_paths[0])
+            else:
+                total, count_map = count_values(
+                    valid_values([layers[raster_paths[0]]])[0])
+            results.append({
+                'cellCount': total,
+                'counts': count_map,
+            })
+        elif operation == 'pair-counts':
+            results.append({
+                'pairs': count_pairs(geom, raster_paths) if layers is None
+                else count_pairs_from_values(valid_values(
+                    [layers[raster_path] for raster_path in raster_paths])),
+            })
+        else:
+            results.append({
+                'stat': stat,
+                'value': statistics(geom, raster_paths[0], stat)
+                if layers is None else statistics_from_data(
+                    valid_values([layers[raster_paths[0]]])[0], stat),
+            })
+
+    return results
+
+
+def count_bands(geom, raster_paths):
+    """
+    Perform a cell count analysis on each band of a stack of aligned
+    rasters, such as land cover of several years, from a single read of
+    each raster.
+
+    Args:
+        geom (Shapley Geometry): A polygon in the same SRS as `raster_paths`
+            which will define the area of analysis to count cell values.
+
+        raster_paths (list<string>): Local file paths to aligned rasters,
+            each of one or more bands.
+
+    Returns:
+        List of (total, count_map) of each band, in the order of the bands
+        of each raster in turn
+    """
+    stack, _ = mask_geom_on_stack(geom, raster_paths)
+
+    return count_bands_from_data(stack)
+
+
+@timing.timed('compute')
+def count_bands_from_data(stack):
+    values = stack_values(stack)
+    classes, idx = stack_classes(values)
+
+    # Offset the class index of each band, so a single bincount counts every
+    # band at once
+    bands = len(values)
+    offsets = np.arange(bands)[:, np.newaxis] * len(classes)
+    counts = np.bincount((idx + offsets).ravel(),
+                         minlength=bands * len(classes))
+
+    return [(values.shape[1], {str(value): int(count) for value, count
+                               in zip(classes, band_counts) if count})
+            for band_counts in counts.reshape(bands, len(classes))]
+
+
+def change_matrix(geom, raster_paths):
+    """
+    Count the transitions of cell values between consecutive bands of a
+    stack of aligned rasters, such as land cover changes between years.
+
+    Args:
+        geom (Shapley Geometry): A polygon in the same SRS as `raster_paths`
+            which will define the area of analysis.
+
+        raster_paths (list<string>): Local file paths to aligned rasters,
+            each of one or more bands.
+
+    Returns:
+        List of dicts of each pair of consecutive bands, with from and to
+        values as keys and the number of cells which changed from one to
+        the other as values
+            ex:  [{ from_value::to_value: 42 }, ...]
+    """
+    stack, _ = mask_geom_on_stack(geom, raster_paths)
+
+    return change_matrix_from_data(stack)
+
 
-    return pair_map
+@timing.timed('compute')
+def change_matrix_from_data(stack):
+    values = stack_values(stack)
+    classes, idx = stack_classes(values)
+
+    # Number each from, to pair of classes of each pair of bands, and count
+    # them all in a single bincount
+    size = len(classes) ** 2
+    steps = len(values) - 1
+    offsets = np.arange(steps)[:, np.newaxis] * size
+    codes = idx[:-1] * len(classes) + idx[1:] + offsets
+    counts = np.bincount(codes.ravel(), minlength=steps * size)
+
+    changes = []
+    for step_counts in counts.reshape(steps, size):
+        pairs = np.nonzero(step_counts)[0]
+        changes.append({
+            '{}::{}'.format(classes[pair // len(classes)],
+                            classes[pair % len(classes)]):
+            int(step_counts[pair])
+            for pair in pairs
+        })
+
+    return changes
+
+
+def stack_statistics(geom, raster_paths, stat):
+    """
+    Computes the specified statistic of each band of a stack of aligned
+    rasters over the cells that intersect with geom
+
+    Returns
+        List of the value of the statistic for each band
+    """
+    stack, _ = mask_geom_on_stack(geom, raster_paths)
+
+    return stack_statistics_from_data(stack, stat)
+
+
+@timing.timed('compute')
+def stack_statistics_from_data(stack, stat):
+    values = stack_values(stack)
+    if stat == 'max':
+        return values.max(axis=1).tolist()
+    elif stat == 'min':
+        return values.min(axis=1).tolist()
+    elif stat == 'mean':
+        return values.mean(axis=1).tolist()
+    elif stat == 'stddev':
+        return values.std(axis=1).tolist()
+    else:
+        raise Exception("{0} has not been implemented".format(stat))
+
+
+def stack_values(stack):
+    """
+    The unmasked cells of each band of a stack, as a 2-D array of
+    (band, cell)
+    """
+    return stack.data[:, ~np.ma.getmaskarray(stack)[0]]
+
+
+def stack_classes(values):
+    """
+    The distinct values of a stack, and the index of each cell's value in
+    them, in the shape of `values`
+    """
+    classes, idx = value_classes(values.ravel())
+    return classes, idx.reshape(values.shape)
 
 
 def sample_at_point(geom, raster_path):
@@ -142,12 +470,12 @@ def sample_at_point(geom, raster_path):
 
     """
 
-    with rasterio.open(raster_path) as src:
+    def sample(src):
         # Sample the raster at the given coordinates
         value_gen = src.sample([(geom.x, geom.y)], indexes=[1])
-        value = value_gen.next().item(0)
+        return value_gen.next().item(0)
 
-    return value
+    return raster_io.read(raster_path, sample, key=('point', geom.coords[0]))
 
 
 def sample_along_line(line, raster_path):
@@ -168,13 +496,14 @@ def sample_along_line(line, raster_path):
 
     """
 
-    with rasterio.open(raster_path) as src:
-        points = list(itertools.chain(*interpolate_points(line)))
+    points = list(itertools.chain(*interpolate_points(line)))
 
+    def sample(src):
         # Sample the raster at the given coordinates
         values = list(src.sample(points, indexes=[1]))
-        samples = [value.item(0) for value in values]
-        return samples
+        return [value.item(0) for value in values]
+
+    return raster_io.read(raster_path, sample)
 
 
 def weighted_overlay(geom, raster_paths, weights):
@@ -202,6 +531,9 @@ def weighted_overlay(geom, raster_paths, weights):
         the input rasters
 
     """
+    # Refuse polygons too large to hold the window of every raster
+    planner.plan(geom, raster_paths, streamable=False)
+
     # Read in rasters and mask geom on them
     layers = [mask_geom_on_raster(geom, raster_path)[0]
               for raster_path in raster_paths]
@@ -209,6 +541,7 @@ def weighted_overlay(geom, raster_paths, weights):
     return weighted_overlay_from_data(layers, weights)
 
 
+@timing.timed('compute')
 def weighted_overlay_from_data(layers, weights):
     # Multiply the weight for each layer across all cell values
     weighted = [layer * weights[idx] for idx, layer in enumerate(layers)]
@@ -242,27 +575,41 @@ def reclassify(geom, raster_path, substitutions):
         all cells represented by `substitutions`
     """
     # Read in the raster and mask geom on it
+    planner.plan(geom, [raster_path], streamable=False)
     layer, transform = mask_geom_on_raster(geom, raster_path)
-    return reclassify_from_data(layer, substitutions)
+    if not layer.data.flags.writeable:
+        layer = layer.copy()
 
+    # Only the cells in geom are reclassified, as a 1-D array
+    cells = np.flatnonzero(~np.ma.getmaskarray(layer))
+    values = reclassify_from_data(layer.data.take(cells), substitutions)
+    np.put(layer.data, cells, values)
 
+    return layer
+
+
+@timing.timed('compute')
 def reclassify_from_data(layer, substitutions):
+    # Masked cells are reclassified along with the rest, which is cheaper
+    # than comparing masked arrays and leaves them masked
+    data = np.ma.getdata(layer)
+
     # For every range or direct replacement, copy over existing values
     for reclass in substitutions:
         old, new = reclass
 
         if isinstance(old, collections.Iterable):
             low, high = old
-            expression = np.ma.where((low <= layer) & (layer <= high))
+            expression = (low <= data) & (data <= high)
         else:
-            expression = np.ma.where(old == layer)
+            expression = data == old
 
-        layer[expression] = new
+        data[expression] = new
 
     return layer
 
 
-def statistics(geom, raster_path, stat):
+def statistics(geom, raster_path, stat, progress=None):
     """
     Computes the specified statistic over the values in raster_path that
     intersect with geom
@@ -278,11 +625,30 @@ def statistics(geom, raster_path, stat):
         stat (string): The statistic to be calculated. Valid values:
             mean, min, max, stddev
 
+        progress (optional function): Called with the strips read and the
+            total strips, when the raster is read a strip at a time.
+
     Returns
-        The single value of the statistical operation
+        The single value of the statistical operation, or None if `geom`
+        covers no cells which aren't nodata
     """
-    # Read in the raster and mask geom on it
-    layer, _ = mask_geom_on_raster(geom, raster_path)
+    run = planner.plan(geom, [raster_path])
+    if run.mode == planner.STREAM:
+        return stream_statistics(
+            (valid_values(layers)[0] for layers
+             in stream_geom_values(geom, [raster_path], run.strip_rows,
+                                   progress=progress)),
+            stat)
+
+    # Read in the values of the cells of the raster in geom
+    return statistics_from_data(geom_values(geom, raster_path), stat)
+
+
+@timing.timed('compute')
+def statistics_from_data(layer, stat):
+    # There is no statistic of a polygon which covers no valid cells
+    if not np.ma.count(layer):
+        return None
 
     # Determine the correct statistic requested
     if stat == 'max':
@@ -297,9 +663,61 @@ def statistics(geom, raster_path, stat):
         raise Exception("{0} has not been implemented".format(stat))
 
 
+def stream_statistics(strips, stat):
+    """
+    A statistic of the values of several strips, as `statistics_from_data`
+    gives it for all of them.  The count, mean and sum of squared
+    deviations of each strip are combined (Chan et al.), so values are only
+    held a strip at a time.
+    """
+    total = 0
+    mean = m2 = 0.0
+    low = high = None
+
+    for values in strips:
+        if not values.size:
+            continue
+
+        with timing.stage('compute'):
+            strip_mean = values.mean(dtype=np.float64)
+            strip_m2 = np.square(values - strip_mean).sum()
+            delta = strip_mean - mean
+            combined = total + values.size
+
+            mean += delta * values.size / combined
+            m2 += strip_m2 + delta**2 * total * values.size / combined
+            total = combined
+
+            low = values.min() if low is None else min(low, values.min())
+            high = values.max() if high is None else max(high, values.max())
+
+    # Without any values, there is no statistic
+    if not total:
+        return None
+
+    if stat == 'max':
+        return high.item(0)
+    elif stat == 'min':
+        return low.item(0)
+    elif stat == 'mean':
+        return mean
+    elif stat == 'stddev':
+        return np.sqrt(m2 / total)
+    else:
+        raise Exception("{0} has not been implemented".format(stat))
+
+
 def extract(geom, raster_path, value):
-    layer, transform = mask_geom_on_raster(geom, raster_path)
-    mask = layer == value
-    features = rasterio.features.shapes(layer, mask=mask, transform=transform)
+    # Refuse polygons too large to hold in memory
+    planner.plan(geom, [raster_path], streamable=False)
+
+    shapes = []
+    for layer, transform in mask_geom_parts(geom, raster_path):
+        with timing.stage('compute'):
+            mask = layer == value
+            features = rasterio.features.shapes(layer, mask=mask,
+                                                transform=transform)
+
+            shapes.extend(feature[0] for feature in features)
 
-    return [feature[0] for feature in features]
+    return shapes
@@ -0,0 +1,362 @@
+"""
+Precomputed class histograms of the blocks of a categorical raster, for
+counts over large areas of interest.  The histograms of fully interior
+blocks are summed without reading them, so only blocks on the boundary of
+the polygon are read and masked at full resolution, and reads are
+proportional to the perimeter of the polygon rather than its area.
+
+Histograms are kept in a pyramid: each level sums 2 x 2 blocks of the level
+below, so large interior areas are covered by a few coarse blocks.  Build
+an index for a raster from this directory with:
+
+    python histogram_index.py /usr/data/nlcd/nlcd_2011_landcover.img
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import rasterio
+
+from affine import Affine
+from rasterio import features
+
+import raster_io
+import settings
+import timing
+
+from geo_utils import get_window_and_affine, prepare, window_box
+
+LOG = logging.getLogger(__name__)
+
+# Loaded indexes, keyed by raster path, with the version of the raster they
+# were loaded for.  A path without an up to date index is kept as None, so
+# the index directory is only checked again once the raster changes.
+INDEXES = {}
+INDEXES_LOCK = threading.Lock()
+
+
+class HistogramIndex(object):
+    """
+    Class histograms of `block_size` x `block_size` cell blocks of a raster.
+    `levels[0][row, col]` holds the count of each of `classes` in the block
+    at row, col; each later level sums 2 x 2 blocks of the previous one.
+    Cells of the `nodata` class are left out of counts.  `version` is the
+    modification time and size of the raster the index was built from.
+    """
+    def __init__(self, classes, levels, block_size, transform, width,
+                 height, nodata=None, version=None):
+        self.classes = classes
+        self.levels = levels
+        self.block_size = block_size
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.nodata = nodata
+        self.version = version
+
+    def window_cells(self, geom):
+        """
+        The number of cells in the bounding box of `geom`
+        """
+        minx, miny, maxx, maxy = geom.bounds
+        return (maxx - minx) / abs(self.transform.a) * \
+            (maxy - miny) / abs(self.transform.e)
+
+    def approximate_level(self, geom):
+        """
+        The coarsest level of the pyramid whose blocks span at least
+        settings.HISTOGRAM_APPROXIMATE_BLOCKS across `geom`, so the number
+        of boundary blocks, and the error of weighting them, stays about the
+        same however large `geom` is
+        """
+        minx, miny, maxx, maxy = geom.bounds
+        cells = max((maxx - minx) / abs(self.transform.a),
+                    (maxy - miny) / abs(self.transform.e))
+        blocks = cells / (self.block_size *
+                          max(settings.HISTOGRAM_APPROXIMATE_BLOCKS, 1))
+        if blocks < 2:
+            return 0
+
+        return min(int(np.log2(blocks)), len(self.levels) - 1)
+
+    def block_window(self, level, row, col):
+        """
+        The cell window of a block as ((row_start, row_stop),
+        (col_start, col_stop)), clipped to the raster
+        """
+        size = self.block_size * 2**level
+        return ((row * size, min((row + 1) * size, self.height)),
+                (col * size, min((col + 1) * size, self.width)))
+
+    def block_box(self, level, row, col):
+        return window_box(self.block_window(level, row, col), self.transform)
+
+    def classify(self, geom, max_level=None):
+        """
+        Walk the pyramid down from its top level, splitting blocks which are
+        on the boundary of `geom` into their children
+
+        Returns:
+            The summed histogram of every block inside `geom`, and a list of
+            (level, row, col) of boundary blocks, at level 0 unless
+            `max_level` stops the walk at a coarser level
+        """
+        prepared = prepare(geom)
+        interior = np.zeros(len(self.classes), dtype=np.int64)
+        boundary = []
+
+        top = len(self.levels) - 1
+        stop = min(max_level or 0, top)
+        pending = [(top, row, col)
+                   for row in range(self.levels[top].shape[0])
+                   for col in range(self.levels[top].shape[1])]
+
+        while pending:
+            level, row, col = pending.pop()
+            if row >= self.levels[level].shape[0] or \
+                    col >= self.levels[level].shape[1]:
+                continue
+
+            block = self.block_box(level, row, col)
+            if not prepared.intersects(block):
+                continue
+
+            if prepared.contains(block):
+                interior += self.levels[level][row, col]
+            elif level == stop:
+                boundary.append((level, row, col))
+            else:
+                pending.extend((level - 1, row * 2 + dy, col * 2 + dx)
+                               for dy in (0, 1) for dx in (0, 1))
+
+        return interior, boundary
+
+    def count(self, geom, raster_path):
+        """
+        Exact counts of the cells of `raster_path` intersecting `geom`.  The
+        same cells are counted as by masking the whole window of `geom`.
+        """
+        histogram, boundary = self.classify(geom)
+        windows = [self.block_window(*block) for block in boundary]
+
+        def read_boundary(src):
+            # Boundary blocks are clipped to the window which would be read
+            # for the whole polygon, so tiny polygons read no more than that
+            (row_min, row_max), (col_min, col_max) = \
+                get_window_and_affine(geom, src)[0]
+
+            blocks = []
+            for (row_start, row_stop), (col_start, col_stop) in windows:
+                window = ((max(row_start, row_min), min(row_stop, row_max)),
+                          (max(col_start, col_min), min(col_stop, col_max)))
+                (r0, r1), (c0, c1) = window
+                if r0 < r1 and c0 < c1:
+                    blocks.append((window, src.read(1, window=window)))
+            return blocks
+
+        blocks = raster_io.read(raster_path, read_boundary)
+
+        with timing.stage('mask'):
+            t = self.transform
+            for ((row_start, _), (col_start, _)), data in blocks:
+                block_affine = Affine(t.a, t.b, t.c + col_start * t.a,
+                                      t.d, t.e, t.f + row_start * t.e)
+                geom_mask = features.geometry_mask(
+                    [geom], out_shape=data.shape, transform=block_affine,
+                    all_touched=True)
+                histogram += self.histogram(data[~geom_mask])
+
+        return self.count_map(histogram)
+
+    def approximate_count(self, geom, level=None):
+        """
+        Counts without reading the raster.  Boundary blocks of `level`,
+        chosen by `approximate_level` by default, contribute their histogram
+        weighted by the fraction of the block covered by `geom`.
+        """
+        if level is None:
+            level = self.approximate_level(geom)
+
+        histogram, boundary = self.classify(geom, max_level=level)
+        histogram = histogram.astype(np.float64)
+
+        for block in boundary:
+            block_box = self.block_box(*block)
+            coverage = geom.intersection(block_box).area / block_box.area
+            histogram += self.levels[block[0]][block[1:]] * coverage
+
+        return self.count_map(np.round(histogram).astype(np.int64))
+
+    def histogram(self, values):
+        """
+        Counts of each of the index's classes in an array of cell values.
+        Values which aren't one of the classes can't be counted in the
+        histogram and are left out.
+        """
+        values = np.ravel(values)
+        idx = np.searchsorted(self.classes, values)
+        known = idx < len(self.classes)
+        known[known] = self.classes[idx[known]] == values[known]
+        if not known.all():
+            LOG.warning('%d cells of classes missing from the histogram '
+                        'index were left out', (~known).sum())
+
+        return np.bincount(idx[known], minlength=len(self.classes))
+
+    def count_map(self, histogram):
+        # Matches the results of masked_array_count, which only includes
+        # classes which occur and aren't nodata
+        if self.nodata is not None:
+            histogram = np.where(self.classes == self.nodata, 0, histogram)
+
+        return int(histogram.sum()), {
+            str(value): int(count)
+            for value, count in zip(self.classes, histogram) if count
+        }
+
+
+def build_index(raster_path, block_size=None):
+    """
+    Compute the histogram pyramid of a raster, reading a row of blocks at a
+    time.  The block size defaults to that of the raster if it is tiled.
+    """
+    with rasterio.open(raster_path) as src:
+        if block_size is None:
+            block_height, block_width = src.block_shapes[0]
+            block_size = block_height if block_height == block_width \
+                else settings.HISTOGRAM_BLOCK_SIZE
+
+        rows = int(np.ceil(src.height / block_size))
+        cols = int(np.ceil(src.width / block_size))
+        blocks = {}
+
+        for row in range(rows):
+            row_window = ((row * block_size,
+                           min((row + 1) * block_size, src.height)),
+                          (0, src.width))
+            data = src.read(1, window=row_window)
+
+            for col in range(cols):
+                block = data[:, col * block_size:(col + 1) * block_size]
+                blocks[row, col] = np.unique(block, return_counts=True)
+
+        transform, width, height = src.transform, src.width, src.height
+        nodata = src.nodata
+
+    version = raster_io.raster_version(raster_path)
+
+    classes = np.unique(np.concatenate([values for values, _
+                                        in blocks.values()]))
+    level = np.zeros((rows, cols, len(classes)), dtype=np.int64)
+    for (row, col), (values, counts) in blocks.items():
+        level[row, col, np.searchsorted(classes, values)] = counts
+
+    levels = [level]
+    while level.shape[0] > 1 or level.shape[1] > 1:
+        # Pad to an even number of blocks and sum each 2 x 2 group
+        level = np.pad(level, ((0, level.shape[0] % 2),
+                               (0, level.shape[1] % 2), (0, 0)), 'constant')
+        level = level.reshape(level.shape[0] // 2, 2, level.shape[1] // 2, 2,
+                              -1).sum(axis=(1, 3))
+        levels.append(level)
+
+    return HistogramIndex(classes, levels, block_size, transform, width,
+                          height, nodata, version)
+
+
+def index_path(raster_path):
+    """
+    The path of a raster's index in settings.HISTOGRAM_INDEX_PATH, named
+    after the raster and distinguished by a hash of its full path
+    """
+    digest = hashlib.sha1(raster_path.encode('utf-8')).hexdigest()[:10]
+    return os.path.join(settings.HISTOGRAM_INDEX_PATH, '{0}.{1}.npz'.format(
+        os.path.basename(raster_path), digest))
+
+
+def save_index(index, path):
+    arrays = {'level_{}'.format(idx): level
+              for idx, level in enumerate(index.levels)}
+    np.savez_compressed(
+        path, classes=index.classes, block_size=index.block_size,
+        transform=np.array(index.transform[:6]),
+        shape=np.array([index.height, index.width]),
+        nodata=np.array([] if index.nodata is None else [index.nodata]),
+        version=np.array([] if index.version is None else index.version,
+                         dtype=np.float64),
+        **arrays)
+
+
+def load_index(path):
+    with np.load(path) as npz:
+        level_count = sum(1 for name in npz.files
+                          if name.startswith('level_'))
+        height, width = npz['shape']
+        nodata = npz['nodata'] if 'nodata' in npz.files else []
+        version = npz['version'] if 'version' in npz.files else []
+        return HistogramIndex(
+            npz['classes'],
+            [npz['level_{}'.format(idx)] for idx in range(level_count)],
+            int(npz['block_size']), Affine(*npz['transform']),
+            int(width), int(height), nodata[0] if len(nodata) else None,
+            (float(version[0]), int(version[1])) if len(version) else None)
+
+
+def get_index(raster_path):
+    """
+    The histogram index of a raster, or None if one hasn't been built, or
+    was built before the raster was last modified
+    """
+    if not settings.HISTOGRAM_INDEX_PATH:
+        return None
+
+    version = raster_io.raster_version(raster_path)
+    loaded = INDEXES.get(raster_path)
+    if loaded is not None and loaded[0] == version:
+        return loaded[1]
+
+    with INDEXES_LOCK:
+        loaded = INDEXES.get(raster_path)
+        if loaded is None or loaded[0] != version:
+            path = index_path(raster_path)
+            index = load_index(path) if os.path.isfile(path) else None
+            if index is not None and index.version != version:
+                LOG.warning('Ignoring the histogram index of %s, which was '
+                            'built before the raster last changed',
+                            raster_path)
+                index = None
+
+            loaded = INDEXES[raster_path] = (version, index)
+
+    return loaded[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('raster', help='Full path to the raster')
+    parser.add_argument('--block-size', type=int,
+                        help='Defaults to the block size of a tiled raster')
+    args = parser.parse_args()
+
+    start = time.time()
+    index = build_index(args.raster, args.block_size)
+
+    path = index_path(args.raster)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    save_index(index, path)
+
+    print('{} levels of {} classes written to {} in {:.1f}s'.format(
+        len(index.levels), len(index.classes), path, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+Analyses run as jobs, outside the request which submits them, for areas too
+large to answer within gunicorn's timeout.  A job runs on a pool of
+settings.JOB_WORKERS threads in the worker process which accepted it.  It
+is given a `progress` callback, which it calls as it starts each strip or
+chunk of its work, and which stops it there once cancellation is requested.
+
+The status, progress and result of each job are kept in a SQLite file at
+settings.JOB_STORE_PATH, so a job can be polled and cancelled through any
+worker, and its result fetched after the worker which ran it has exited.
+"""
+import errno
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from multiprocessing.pool import ThreadPool
+
+import encoding
+import settings
+
+LOG = logging.getLogger(__name__)
+
+# Statuses of a job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Open stores, keyed by file path
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    """
+    The status of a job, the chunks of its work which are `done` out of its
+    `total` chunks, and its result as JSON once it's done
+    """
+    def __init__(self, job_id, operation, status=QUEUED, done=0, total=0,
+                 result=None, error=None, created=None, updated=None,
+                 pid=None):
+        self.id = job_id
+        self.operation = operation
+        self.status = status
+        self.done = done
+        self.total = total
+        self.result = result
+        self.error = error
+        self.created = created or time.time()
+        self.updated = updated or self.created
+        self.pid = pid or os.getpid()
+
+    def as_dict(self):
+        job = {
+            'jobId': self.id,
+            'operation': self.operation,
+            'status': self.status,
+            'progress': {
+                'done': self.done,
+                'total': self.total,
+            },
+            'created': self.created,
+            'updated': self.updated,
+        }
+        if self.error:
+            job['error'] = self.error
+
+        return job
+
+
+class JobStore(object):
+    """
+    Jobs, their progress and results, and whether their cancellation has
+    been requested
+    """
+    COLUMNS = ('id', 'operation', 'status', 'done', 'total', 'result',
+               'error', 'created', 'updated', 'pid')
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                operation TEXT,
+                status TEXT,
+                done INTEGER,
+                total INTEGER,
+                result TEXT,
+                error TEXT,
+                created REAL,
+                updated REAL,
+                pid INTEGER,
+                cancel INTEGER DEFAULT 0)
+        """)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            self.conn.commit()
+            return cursor.rowcount
+
+    def get_job(self, job_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT {} FROM jobs WHERE id = ?'.format(
+                    ', '.join(self.COLUMNS)), (job_id,)).fetchone()
+
+        return Job(*row) if row else None
+
+    def put_job(self, job):
+        self.execute(
+            'INSERT INTO jobs ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, '
+            '?)'.format(', '.join(self.COLUMNS)),
+            (job.id, job.operation, job.status, job.done, job.total,
+             job.result, job.error, job.created, job.updated, job.pid))
+
+    def start(self, job_id):
+        """
+        Mark a queued job as running
+
+        Returns:
+            Whether the job was still queued, rather than cancelled
+        """
+        return self.execute(
+            'UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND '
+            'status = ?', (RUNNING, time.time(), job_id, QUEUED)) > 0
+
+    def progress(self, job_id, done, total):
+        """
+        Record the progress of a running job
+
+        Returns:
+            Whether its cancellation has been requested
+        """
+        self.execute('UPDATE jobs SET done = ?, total = ?, updated = ? '
+                     'WHERE id = ?', (done, total, time.time(), job_id))
+        with self.lock:
+            row = self.conn.execute('SELECT cancel FROM jobs WHERE id = ?',
+                                    (job_id,)).fetchone()
+
+        return bool(row and row[0])
+
+    def finish(self, job_id, status, result=None, error=None):
+        # Finished jobs have done all of their chunks, which is one chunk
+        # for jobs which weren't split into chunks
+        self.execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, updated = ?, '
+            'total = MAX(total, 1), done = CASE WHEN ? = ? THEN '
+            'MAX(total, 1) ELSE done END WHERE id = ?',
+            (status, result, error, time.time(), status, DONE, job_id))
+
+    def cancel(self, job_id):
+        """
+        Cancel a queued job, or request the cancellation of a running one
+        """
+        if not self.execute(
+                'UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND '
+                'status = ?', (CANCELLED, time.time(), job_id, QUEUED)):
+            self.execute('UPDATE jobs SET cancel = 1 WHERE id = ? AND '
+                         'status = ?', (job_id, RUNNING))
+
+    def expire(self, before):
+        """
+        Delete finished jobs last updated before a time
+        """
+        self.execute(
+            'DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated < ?',
+            FINISHED + (before,))
+
+    def close(self):
+        self.conn.close()
+
+
+def get_store():
+    """
+    The job store at settings.JOB_STORE_PATH, created if it doesn't exist
+    yet.  Without a path, or if its directory is missing, jobs are kept in
+    an in-memory store of the process.
+    """
+    path = settings.JOB_STORE_PATH
+    if not path or not os.path.isdir(os.path.dirname(path) or '.'):
+        path = ':memory:'
+
+    store = STORES.get(path)
+    if store is None:
+        with STORES_LOCK:
+            store = STORES.get(path)
+            if store is None:
+                store = STORES[path] = JobStore(path)
+
+    return store
+
+
+def get_pool():
+    """
+    Get the job thread pool, which is created on the first job of each
+    worker process.  When threading has been monkey patched by gevent, a
+    regular ThreadPool would run jobs as greenlets, whose computation would
+    block every request of the worker and its heartbeat, so jobs run on a
+    native thread pool of gevent's instead.  It's separate from the hub's
+    pool used for raster I/O, so jobs don't hold up reads of requests.
+    """
+    global POOL
+
+    if POOL is None:
+        with POOL_LOCK:
+            if POOL is None:
+                POOL = _gevent_pool() or ThreadPool(settings.JOB_WORKERS)
+
+    return POOL
+
+
+def _gevent_pool():
+    try:
+        from gevent import monkey
+        from gevent.threadpool import ThreadPool as NativeThreadPool
+    except ImportError:
+        return None
+
+    if not monkey.is_module_patched('threading'):
+        return None
+
+    return NativeThreadPool(settings.JOB_WORKERS)
+
+
+def submit(operation, func, *args):
+    """
+    Queue a job which calls `func` with `args` and stores the JSON encoded
+    dict it returns as its result.  `func` is also passed a `progress`
+    callback, which records that `done` of its `total` chunks are done and
+    raises JobCancelled once the job's cancellation has been requested, so
+    the work stops at the start of a chunk.
+
+    Args:
+        operation (string): Name of the analysis the job runs, eg `counts`
+
+    Returns:
+        The queued Job
+    """
+    store = get_store()
+    if settings.JOB_RESULT_TTL:
+        store.expire(time.time() - settings.JOB_RESULT_TTL)
+
+    job = Job(uuid.uuid4().hex, operation)
+    store.put_job(job)
+    get_pool().apply_async(run, (job.id, func, args))
+
+    return job
+
+
+def run(job_id, func, args):
+    store = get_store()
+    if not store.start(job_id):
+        return
+
+    def progress(done, total):
+        if store.progress(job_id, done, total):
+            raise JobCancelled()
+
+    try:
+        # Jobs which aren't split into chunks are a single chunk, which is
+        # done once the job is finished
+        progress(0, 1)
+        result = func(*args, progress=progress)
+    except JobCancelled:
+        store.finish(job_id, CANCELLED)
+    except Exception as e:
+        LOG.exception('Job %s failed', job_id)
+        store.finish(job_id, FAILED, error=getattr(e, 'message', None) or
+                     str(e) or type(e).__name__)
+    else:
+        store.finish(job_id, DONE, result=encoding.encode_json(result))
+
+
+def get_job(job_id):
+    """
+    A job, or None if there isn't one with the id.  Jobs left queued or
+    running by a worker process which has exited are marked as failed.
+    """
+    store = get_store()
+    job = store.get_job(job_id)
+    if job is not None and job.status not in FINISHED and \
+            not process_exists(job.pid):
+        store.finish(job_id, FAILED,
+                     error='The worker running the job exited')
+        job = store.get_job(job_id)
+
+    return job
+
+
+def cancel(job_id):
+    """
+    Cancel a job, which stops a running job at the end of its current chunk
+
+    Returns:
+        The job, or None if there isn't one with the id
+    """
+    get_store().cancel(job_id)
+    return get_job(job_id)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
@@ -1,32 +1,65 @@
 from __future__ import print_function
 from __future__ import division
 
-from request_utils import parse_config
-import geoprocessing
+import time
+
+# Modules imported at cold start, before the first invocation.  Every method
+# needs rasterio, numpy and shapely, so they are all imported here, and open
+# datasets and projections are cached by raster_io and geo_utils for warm
+# starts.
+INIT_START = time.time()
+
+from request_utils import parse_config  # noqa
+from errors import UserInputError  # noqa
+import geoprocessing  # noqa
+import raster_io  # noqa
+
+INIT_TIME = time.time() - INIT_START
+COLD_START = True
 
 
 def handler(body, context):
     """
-    Perform a cell count analysis on a portion of a provided raster.
-    If `modifications` is present on the input payload, apply those
-    modification values to the raster before performing the count.
+    Perform the analysis named by the `method` key of the body on a portion
+    of a provided raster.  Methods mirror the Flask endpoints:
+
+        count: cell counts, with `modifications` applied if present
+        pair-counts: counts of cell pairs of two stacked rasters
+        stats: the statistic named by the `stat` key
+        xy: the cell value at a point
+        sample-change: cell values interpolated along `queryLine`
+
+    Responses include the read statistics of the invocation, its duration,
+    and whether it was a cold start.
     """
+    global COLD_START
+    start = time.time()
+    stats = raster_io.reset_request_stats()
 
     # Due to differences in lamda and api gateway test interface, this
     # may be parsed json or a string
     user_input = parse_config(body)
-    geom = user_input['query_polygon']
-    layers = user_input['raster_paths']
-    mods = user_input['mods']
 
-    method = body['method']
+    method = body.get('method')
+    if method not in METHODS:
+        raise UserInputError('{0} is not a supported method'.format(method))
+
+    result = METHODS[method](user_input, body)
+    result['io'] = stats.as_dict()
+    result['time'] = time.time() - start
+    result['coldStart'] = COLD_START
+    if COLD_START:
+        result['initTime'] = INIT_TIME
+        COLD_START = False
 
-    if method == 'count':
-        return count(geom, layers[0], mods)
+    return result
 
 
-def count(geom, raster_path, mods):
-    total, count_map = geoprocessing.count(geom, raster_path, mods)
+def count(user_input, body):
+    total, count_map = geoprocessing.count(user_input['query_polygon'],
+                                           user_input['raster_paths'][0],
+                                           user_input['mods'],
+                                           user_input['approximate'])
 
     return {
         'cellCount': total,
@@ -34,6 +67,53 @@ def count(geom, raster_path, mods):
     }
 
 
+def pair_counts(user_input, body):
+    pair_map = geoprocessing.count_pairs(user_input['query_polygon'],
+                                         user_input['raster_paths'])
+
+    return {
+        'pairs': pair_map,
+    }
+
+
+def stats(user_input, body):
+    stat = body.get('stat')
+    value = geoprocessing.statistics(user_input['query_polygon'],
+                                     user_input['raster_paths'][0], stat)
+
+    return {
+        'stat': stat,
+        'value': value,
+    }
+
+
+def xy(user_input, body):
+    value = geoprocessing.sample_at_point(user_input['query_polygon'],
+                                          user_input['raster_paths'][0])
+
+    return {
+        'value': value,
+    }
+
+
+def sample_change(user_input, body):
+    value = geoprocessing.sample_along_line(user_input['query_line'],
+                                            user_input['raster_paths'][0])
+
+    return {
+        'value': value,
+    }
+
+
+METHODS = {
+    'count': count,
+    'pair-counts': pair_counts,
+    'stats': stats,
+    'xy': xy,
+    'sample-change': sample_change,
+}
+
+
 if __name__ == '__main__':
     """
     Simple check against the above function intended for lambda execution
@@ -54,3 +134,4 @@ if __name__ == '__main__':
 
     print(body)  # Output can be used in API Gateway test UI
     print(handler(body, None))
+    print(handler(body, None))
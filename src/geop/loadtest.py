@@ -0,0 +1,343 @@
+"""
+Replay a mix of analysis and tile requests against the API under
+concurrency, and report throughput and latency percentiles per endpoint.
+Run from this directory against a running server:
+
+    python loadtest.py --url http://localhost:8080 --mix counts=4,tiles=6
+
+or start gunicorn locally with each of several worker configurations in
+turn, to compare them:
+
+    python loadtest.py --server "-w 1 -k gevent" --server "-w 4 -k sync"
+
+Query polygons are generated around Philadelphia, or read from a GeoJSON
+FeatureCollection of recorded areas of interest with `--polygons`.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import shlex
+import subprocess
+import threading
+import time
+
+from Queue import Queue, Empty
+
+import numpy as np
+import requests
+
+from shapely.geometry import Point, mapping, shape
+
+from geo_utils import lnglat_to_tile
+
+# Mix of endpoints and their relative weights
+DEFAULT_MIX = 'counts=4,pair-counts=1,stats=2,xy=2,tiles=6'
+
+# EPSG:4326 extent of generated queries
+DEFAULT_BBOX = (-75.3, 39.8, -74.9, 40.1)
+
+# Radius range of generated query polygons, in degrees
+MIN_RADIUS = 0.005
+MAX_RADIUS = 0.1
+
+STATS = ['min', 'max', 'mean', 'stddev']
+
+
+def parse_mix(mix):
+    """
+    Parse a mix such as `counts=4,tiles=6` into a list of (endpoint, weight)
+    """
+    endpoints = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise ValueError('Unknown endpoint {}, expected one of {}'.format(
+                name, ', '.join(sorted(ENDPOINTS))))
+        endpoints.append((name, float(weight or 1)))
+
+    return endpoints
+
+
+def generate_polygons(bbox, count, rng):
+    """
+    Circular query polygons with random centers within `bbox` and radii
+    spread evenly on a log scale, so most queries are small but some span
+    much of the area
+    """
+    west, south, east, north = bbox
+    radii = np.exp(rng.uniform(np.log(MIN_RADIUS), np.log(MAX_RADIUS),
+                               count))
+
+    return [mapping(Point(rng.uniform(west, east),
+                          rng.uniform(south, north)).buffer(radius))
+            for radius in radii]
+
+
+def load_polygons(path):
+    """
+    Read the polygons of a GeoJSON FeatureCollection of recorded queries
+    """
+    with open(path) as f:
+        collection = json.load(f)
+
+    return [feature['geometry'] for feature in collection['features']
+            if feature['geometry']['type'] in ('Polygon', 'MultiPolygon')]
+
+
+def counts_request(rng, polygon, options):
+    return 'POST', '/counts', {
+        'rasters': [options.raster],
+        'queryPolygon': polygon,
+    }
+
+
+def pair_counts_request(rng, polygon, options):
+    return 'POST', '/pair-counts', {
+        'rasters': options.pair_rasters or [options.raster] * 2,
+        'queryPolygon': polygon,
+    }
+
+
+def stats_request(rng, polygon, options):
+    return 'POST', '/stats/{}'.format(rng.choice(STATS)), {
+        'rasters': [options.raster],
+        'queryPolygon': polygon,
+    }
+
+
+def xy_request(rng, polygon, options):
+    point = shape(polygon).representative_point()
+    return 'POST', '/xy', {
+        'rasters': [options.raster],
+        'queryPolygon': mapping(point),
+    }
+
+
+def tile_request(rng, polygon, options):
+    point = shape(polygon).representative_point()
+    zoom = rng.randint(options.zooms[0], options.zooms[1] + 1)
+    x, y = lnglat_to_tile(point.x, point.y, zoom)
+    return 'GET', '/{}/{}/{}/{}.{}'.format(options.layer, zoom, x, y,
+                                          options.format), None
+
+
+ENDPOINTS = {
+    'counts': counts_request,
+    'pair-counts': pair_counts_request,
+    'stats': stats_request,
+    'xy': xy_request,
+    'tiles': tile_request,
+}
+
+
+def build_requests(mix, count, polygons, options, seed=0):
+    """
+    Draw `count` requests from the weighted mix of endpoints, each over one
+    of `polygons`.  The same seed always builds the same requests, so runs
+    against different configurations are comparable.
+
+    Returns:
+        List of (endpoint, method, path, JSON body) tuples
+    """
+    rng = np.random.RandomState(seed)
+    names = [name for name, _ in mix]
+    weights = np.array([weight for _, weight in mix])
+
+    built = []
+    for name in rng.choice(names, size=count, p=weights / weights.sum()):
+        polygon = polygons[rng.randint(len(polygons))]
+        method, path, body = ENDPOINTS[name](rng, polygon, options)
+        built.append((name, method, path, body))
+
+    return built
+
+
+def run_load(base_url, load, concurrency):
+    """
+    Send every request of `load` to the server at `base_url` from
+    `concurrency` clients at once, each sending its next request as soon
+    as the last has finished
+
+    Returns:
+        List of (endpoint, status code, latency in seconds) of each request,
+        and the elapsed time of the whole run
+    """
+    pending = Queue()
+    for item in load:
+        pending.put(item)
+
+    results = []
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            try:
+                name, method, path, body = pending.get_nowait()
+            except Empty:
+                return
+
+            start = time.time()
+            try:
+                response = session.request(method, base_url + path,
+                                           json=body, timeout=120)
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+
+            with lock:
+                results.append((name, status, time.time() - start))
+
+    start = time.time()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    return results, time.time() - start
+
+
+def summarize(results, elapsed):
+    """
+    Throughput, error count and latency percentiles in milliseconds, per
+    endpoint and over all requests
+    """
+    by_endpoint = {'all': results}
+    for result in results:
+        by_endpoint.setdefault(result[0], []).append(result)
+
+    summary = {}
+    for name, endpoint_results in by_endpoint.items():
+        latencies = np.array([latency for _, _, latency in endpoint_results])
+        summary[name] = {
+            'requests': len(endpoint_results),
+            'errors': sum(1 for _, status, _ in endpoint_results
+                          if status is None or status >= 400),
+            'rps': len(endpoint_results) / elapsed,
+            'p50_ms': np.percentile(latencies, 50) * 1000,
+            'p90_ms': np.percentile(latencies, 90) * 1000,
+            'p99_ms': np.percentile(latencies, 99) * 1000,
+            'max_ms': latencies.max() * 1000,
+        }
+
+    return summary
+
+
+def print_summary(label, summary):
+    print('\n{}'.format(label))
+    print('{0:<12} {1:>8} {2:>7} {3:>8} {4:>9} {5:>9} {6:>9} {7:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms',
+        'p99 ms', 'max ms'))
+
+    for name in sorted(summary, key=lambda name: (name == 'all', name)):
+        print('{0:<12} {requests:>8} {errors:>7} {rps:>8.1f} {p50_ms:>9.1f} '
+              '{p90_ms:>9.1f} {p99_ms:>9.1f} {max_ms:>9.1f}'.format(
+                  name, **summary[name]))
+
+
+def start_server(gunicorn_args, port):
+    """
+    Start gunicorn serving the app with the given worker arguments, and wait
+    until it accepts requests
+    """
+    command = ['gunicorn', '-b', '127.0.0.1:{}'.format(port),
+               '--timeout', '120'] + shlex.split(gunicorn_args) + ['main:app']
+    server = subprocess.Popen(command)
+
+    url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(100):
+        try:
+            requests.get(url + '/metrics', timeout=1)
+            return server, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError('gunicorn {} did not start'.format(gunicorn_args))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', default='http://localhost:8080',
+                        help='Base URL of a running server')
+    target.add_argument('--server', action='append',
+                        help='gunicorn worker arguments to start a local '
+                        'server with, may be repeated to compare')
+    parser.add_argument('--port', type=int, default=8090,
+                        help='Port of locally started servers')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Endpoints and their relative weights')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8],
+                        help='Numbers of concurrent clients to run with')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='Requests to send before measuring')
+    parser.add_argument('--polygons', help='GeoJSON FeatureCollection of '
+                        'query polygons, in EPSG:4326')
+    parser.add_argument('--bbox', type=float, nargs=4, default=DEFAULT_BBOX,
+                        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                        help='EPSG:4326 extent of generated polygons')
+    parser.add_argument('--raster', default='nlcd/nlcd_2011_landcover_2011_'
+                        'edition_2014_10_10.img')
+    parser.add_argument('--pair-rasters', nargs=2,
+                        help='Rasters of pair count requests, defaults to '
+                        'pairing --raster with itself')
+    parser.add_argument('--layer', default='nlcd', help='Tile layer')
+    parser.add_argument('--zooms', type=int, nargs=2, default=[10, 16],
+                        metavar=('MIN', 'MAX'))
+    parser.add_argument('--format', default='png')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='Path to save results as JSON')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    if args.polygons:
+        polygons = load_polygons(args.polygons)
+    else:
+        polygons = generate_polygons(args.bbox, 200, rng)
+
+    mix = parse_mix(args.mix)
+    warmup = build_requests(mix, args.warmup, polygons, args, args.seed + 1)
+    load = build_requests(mix, args.requests, polygons, args, args.seed)
+
+    runs = []
+    for gunicorn_args in args.server or [None]:
+        server = None
+        url = args.url
+        if gunicorn_args:
+            server, url = start_server(gunicorn_args, args.port)
+
+        try:
+            for concurrency in args.concurrency:
+                run_load(url, warmup, concurrency)
+                results, elapsed = run_load(url, load, concurrency)
+
+                label = '{} at concurrency {}'.format(
+                    gunicorn_args or url, concurrency)
+                summary = summarize(results, elapsed)
+                print_summary(label, summary)
+
+                runs.append({
+                    'server': gunicorn_args or url,
+                    'concurrency': concurrency,
+                    'elapsed': elapsed,
+                    'endpoints': summary,
+                })
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'mix': args.mix, 'requests': args.requests,
+                       'runs': runs}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,48 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, g, request, jsonify, send_file
+from functools import partial
+import json
 import numpy as np
 
+import elevation_extraction
+import encoding
+import geometry_store
 import geoprocessing
+import jobs
+import preload
+import raster_io
+import result_cache
+import scenario_store
+import settings
 import tiles
+import timing
+import zonal_store
 
-from errors import UserInputError
-from geo_utils import tile_to_bbox, tile_read, as_json
-from request_utils import parse_config
+from errors import JobNotFinishedError, UserInputError
+from geo_utils import tile_read, as_json
+from request_utils import (ANALYSIS_OPERATIONS, STATS, get_path,
+                           parse_analyses, parse_config, parse_geometry,
+                           parse_scenario)
 
 from flask_cors import CORS
 
 app = Flask(__name__)
 CORS(app)
 
+# Hot layers are loaded once, before gunicorn forks its workers when it's
+# run with --preload
+preload.preload()
+
+# Palettes are packed once at startup rather than for every tile
+LAYER_PALETTES = {
+    layer: tiles.make_palette(config['palette'])
+    if config['palette'] else None
+    for layer, config in settings.TILE_LAYERS.items()
+}
+
+# A color palette from 0 (white -> green) to 10 (red) for overall
+# site priorities
+PRIORITY_PALETTE = tiles.make_palette([255,255,255, 0,104,55, 26,152,80, 102,189,99, 166,217,106, 217,239,139, 254,224,139, 253,174,97, 244,109,67, 215,48,39, 165,0,38])  # noqa
+
 
 @app.route('/counts', methods=['POST'])
 def count():
@@ -23,16 +53,20 @@ def count():
     """
     user_input = parse_config(request)
 
-    geom = user_input['query_polygon']
-    raster_path = user_input['raster_paths'][0]
-    mods = user_input['mods']
+    return encode_response(memoize('counts', user_input,
+                                   partial(count_result, user_input)))
 
-    total, count_map = geoprocessing.count(geom, raster_path, mods)
 
-    return jsonify({
+def count_result(user_input, progress=None):
+    total, count_map = geoprocessing.count(user_input['query_polygon'],
+                                           user_input['raster_paths'][0],
+                                           user_input['mods'],
+                                           user_input['approximate'],
+                                           progress)
+    return {
         'cellCount': total,
         'counts': count_map,
-    })
+    }
 
 
 @app.route('/pair-counts', methods=['POST'])
@@ -44,16 +78,134 @@ def pair_counts():
     """
     user_input = parse_config(request)
 
-    geom = user_input['query_polygon']
-    raster_paths = user_input['raster_paths']
+    return encode_response(memoize('pair-counts', user_input,
+                                   partial(pair_count_result, user_input)))
+
 
-    pair_map = geoprocessing.count_pairs(geom, raster_paths)
+def pair_count_result(user_input, progress=None):
+    return {
+        'pairs': geoprocessing.count_pairs(user_input['query_polygon'],
+                                           user_input['raster_paths'],
+                                           progress)
+    }
 
-    return jsonify({
-        'pairs': pair_map
+
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    """
+    Run several counts, pair counts and stats over the same query polygon in
+    one request, reading each raster once and returning every result
+    together, in the order of `analyses`.
+    """
+    user_input = parse_analyses(request)
+
+    results = geoprocessing.analyze(user_input['query_polygon'],
+                                    user_input['analyses'])
+
+    return encode_response({
+        'results': results
     })
 
 
+@app.route('/scenarios', methods=['POST'])
+def create_scenario():
+    """
+    Store `modifications` as a scenario, which counts and stats requests
+    reference by `scenarioId` rather than sending the modifications.  They
+    are rasterized on the grid of each of `rasters`, if given.
+    """
+    mods, raster_paths = parse_scenario(request)
+
+    scenario = scenario_store.create_scenario(mods)
+    for raster_path in raster_paths:
+        grid, _, _ = scenario_store.grid_of(
+            raster_io.info(raster_path).transform)
+        scenario.delta(grid)
+
+    return encode_response({
+        'scenarioId': scenario.id,
+        'modifications': len(scenario.mods),
+    })
+
+
+@app.route('/scenarios/<scenario_id>', methods=['GET'])
+def get_scenario(scenario_id):
+    scenario = scenario_store.get_scenario(scenario_id)
+    if scenario is None:
+        raise UserInputError('{} is not a stored scenario'.format(
+            scenario_id))
+
+    return encode_response({
+        'scenarioId': scenario.id,
+        'modifications': len(scenario.mods),
+    })
+
+
+@app.route('/geometries', methods=['POST'])
+def register_geometry():
+    """
+    Register a query polygon, given as GeoJSON or WKB, in the SRS of the
+    rasters it will be analyzed over, so requests reference it by
+    `queryGeometryId` rather than sending its vertices
+    """
+    geom, srs = parse_geometry(request)
+
+    return encode_response({
+        'geometryId': geometry_store.register_geometry(geom, srs),
+        'srs': srs,
+    })
+
+
+@app.route('/geometries/<geometry_id>', methods=['GET'])
+def get_geometry(geometry_id):
+    geom = geometry_store.get_geometry(geometry_id)
+    if geom is None:
+        raise UserInputError('{} is not a registered geometry'.format(
+            geometry_id))
+
+    return encode_response({
+        'geometryId': geom.geometry_id,
+        'srs': geom.srs,
+    })
+
+
+@app.route('/boundaries/<dataset>/<boundary_id>/<any("counts", "pair-counts"):analysis>', methods=['POST'])  # noqa
+def boundary_analysis(dataset, boundary_id, analysis):
+    """
+    Counts or pair counts over a well-known boundary, such as a HUC-12,
+    identified by its dataset and id rather than a query polygon.  Answered
+    from the zonal store when precomputed for the requested rasters, as
+    they are now, and otherwise computed live over the stored boundary.
+    """
+    req_config = request.get_json(silent=True) or {}
+    rasters = req_config.get('rasters')
+    if not rasters:
+        raise UserInputError('rasters key is required in config')
+    if len(rasters) != ANALYSIS_OPERATIONS[analysis]:
+        raise UserInputError('{} requires {} rasters'.format(
+            analysis, ANALYSIS_OPERATIONS[analysis]))
+
+    store = zonal_store.get_store()
+    if store is None:
+        raise UserInputError('No boundaries have been precomputed')
+
+    raster_paths = [get_path(raster) for raster in rasters]
+    summary = store.get_summary(dataset, boundary_id, analysis, rasters,
+                                raster_paths)
+    precomputed = summary is not None
+
+    if not precomputed:
+        geom = store.get_boundary(dataset, boundary_id)
+        if geom is None:
+            raise UserInputError('No boundary {0} in {1}'.format(
+                boundary_id, dataset))
+
+        summary = zonal_store.ANALYSES[analysis](geom, raster_paths)
+
+    summary['precomputed'] = precomputed
+    return encode_response(summary)
+
+
 @app.route('/xy', methods=['POST'])
 def xy():
     """
@@ -66,7 +218,7 @@ def xy():
 
     value = geoprocessing.sample_at_point(geom, raster_path)
 
-    return jsonify({
+    return encode_response({
         'value': value
     })
 
@@ -82,9 +234,9 @@ def sample_change():
 
     value = geoprocessing.sample_along_line(line, raster_path)
 
-    return jsonify({
+    return encode_response({
         'value': value
-    })
+    }, array_key='value')
 
 
 @app.route('/stats/<stat>', methods=['POST'])
@@ -94,14 +246,141 @@ def stats(stat):
     """
     user_input = parse_config(request)
 
+    return encode_response(memoize('stats/' + stat, user_input,
+                                   partial(stats_result, user_input, stat)))
+
+
+def stats_result(user_input, stat, progress=None):
+    return {
+        'stat': stat,
+        'value': geoprocessing.statistics(user_input['query_polygon'],
+                                          user_input['raster_paths'][0], stat,
+                                          progress)
+    }
+
+
+def increments_result(user_input, progress=None):
+    return {
+        'files': elevation_extraction.process_increments(
+            user_input['query_polygon'], user_input['raster_paths'][0],
+            progress=progress)
+    }
+
+
+# Analyses which can be submitted as jobs, named after the endpoints whose
+# responses they match
+JOB_OPERATIONS = {
+    'counts': count_result,
+    'pair-counts': pair_count_result,
+    'elevation-increments': increments_result,
+}
+JOB_OPERATIONS.update(('stats/' + stat, partial(stats_result, stat=stat))
+                      for stat in STATS)
+
+
+@app.route('/jobs/<path:operation>', methods=['POST'])
+def submit_job(operation):
+    """
+    Run an analysis as a job, outside of the request, with the same config
+    as its endpoint, such as `/jobs/counts` for `/counts`.  The job's status
+    and progress are polled from `/jobs/<job_id>`, and its result fetched
+    from `/jobs/<job_id>/result` once it's done.
+    """
+    if operation not in JOB_OPERATIONS:
+        raise UserInputError('{} can not be run as a job'.format(operation))
+
+    user_input = parse_config(request)
+    job = jobs.submit(operation, JOB_OPERATIONS[operation], user_input)
+
+    response = encode_response(job.as_dict())
+    response.status_code = 202
+    return response
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    return encode_response(find_job(job_id).as_dict())
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = find_job(job_id)
+    if job.status != jobs.DONE:
+        raise JobNotFinishedError('Job {0} is {1}{2}'.format(
+            job_id, job.status, ': ' + job.error if job.error else ''))
+
+    return encode_response(json.loads(job.result))
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """
+    Cancel a job.  A running job stops once it finishes its current chunk.
+    """
+    find_job(job_id)
+    return encode_response(jobs.cancel(job_id).as_dict())
+
+
+def find_job(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise UserInputError('{} is not a job'.format(job_id))
+    return job
+
+
+@app.route('/stack/counts', methods=['POST'])
+def stack_counts():
+    """
+    Cell counts of each band of a stack of aligned rasters, such as land
+    cover of several years, given as `rasters` of one or more bands each
+    """
+    user_input = parse_config(request)
+
     geom = user_input['query_polygon']
-    raster_path = user_input['raster_paths'][0]
+    raster_paths = user_input['raster_paths']
+
+    bands = geoprocessing.count_bands(geom, raster_paths)
+
+    return encode_response({
+        'bands': [{'cellCount': total, 'counts': count_map}
+                  for total, count_map in bands]
+    })
 
-    value = geoprocessing.statistics(geom, raster_path, stat)
 
-    return jsonify({
+@app.route('/stack/changes', methods=['POST'])
+def stack_changes():
+    """
+    Count cells which changed from each value to each other value between
+    consecutive bands of a stack of aligned rasters
+    """
+    user_input = parse_config(request)
+
+    geom = user_input['query_polygon']
+    raster_paths = user_input['raster_paths']
+
+    changes = geoprocessing.change_matrix(geom, raster_paths)
+
+    return encode_response({
+        'changes': [{'from': band, 'to': band + 1, 'pairs': pairs}
+                    for band, pairs in enumerate(changes)]
+    })
+
+
+@app.route('/stack/stats/<stat>', methods=['POST'])
+def stack_stats(stat):
+    """
+    Return basic statistics of each band of a stack of aligned rasters
+    """
+    user_input = parse_config(request)
+
+    geom = user_input['query_polygon']
+    raster_paths = user_input['raster_paths']
+
+    values = geoprocessing.stack_statistics(geom, raster_paths, stat)
+
+    return encode_response({
         'stat': stat,
-        'value': value
+        'values': values
     })
 
 
@@ -117,7 +396,7 @@ def extract_features(code):
 
     values = geoprocessing.extract(geom, raster_path, int(code))
 
-    return jsonify(as_json(values))
+    return encode_response(as_json(values))
 
 
 @app.route('/above/<lower>/below/<upper>', methods=['POST'])
@@ -133,56 +412,56 @@ def extract_above(lower, upper):
     values = geoprocessing.extract_above(geom, raster_path,
                                          int(lower), int(upper))
 
-    return jsonify(as_json(values, from_srs='epsg:4269'))
+    return encode_response(as_json(values, from_srs='epsg:4269'))
 
 
-@app.route('/<layer>/<int:z>/<int:x>/<int:y>.png')
-def layer_tile(layer, z, x, y):
+@app.route('/<layer>/<int:z>/<int:x>/<int:y>.<any(png, webp):img_format>')
+def layer_tile(layer, z, x, y, img_format):
     """
     Given a known layer, render the tile at z/x/y with an embedded color table
     or a user defined color palette
     """
-    # This would need to otherwise be specified in a config.
-    # Requirements are EPSG:3857
-    user_palette = None
-    if layer == 'nlcd':
-        path = '/usr/data/nlcd/nlcd_webm_512.tif'
-    elif layer == 'nlcd_s3':
-        path = 's3://simple-raster-processing/nlcd_webm_512.tif'
-    elif layer == 'soil':
-        path = '/usr/data/hydro_soils_webm_512.tif'
-        user_palette = [255,255,255, 255,255,212, 254,227,145, 204,76,2, 140,45,4, 254,196,79, 254,153,41, 236,112,20]  # noqa
-    else:
+    # Layers are registered in settings.  Requirements are EPSG:3857
+    if layer not in settings.TILE_LAYERS:
         raise UserInputError('No layer {0} is registered.'.format(layer))
 
-    bbox = tile_to_bbox(z, x, y)
+    config = settings.TILE_LAYERS[layer]
 
-    img = tiles.render_tile(bbox, path, user_palette)
-    return send_file(img, mimetype='image/png')
+    def render(bbox, tile_size):
+        tile, palette = tile_read(bbox, config['path'], tile_size)
+        if LAYER_PALETTES[layer] is not None:
+            palette = LAYER_PALETTES[layer]
+        return tile, palette, config['nodata']
 
+    img = tiles.get_tile(layer, z, x, y, img_format, render)
+    return send_file(img, mimetype=tiles.MIMETYPES[img_format])
 
-@app.route('/nlcd-grouped/<int:z>/<int:x>/<int:y>.png')
-def reclass_tile(z, x, y):
+
+@app.route('/nlcd-grouped/<int:z>/<int:x>/<int:y>.<any(png, webp):img_format>')  # noqa
+def reclass_tile(z, x, y, img_format):
     """
     On the fly reclassification of NLCD values into groups
     """
     # This would need to otherwise be specified in a config.
     # Requirements are EPSG:3857 and a color table
     path = '/usr/data/nlcd/nlcd_webm_512.tif'
-    bbox = tile_to_bbox(z, x, y)
-    tile, palette = tile_read(bbox, path)
-    # Reclassify the nlcd data to be in related groups
-    substitutions = [[(21, 24), 23], [(41, 52), 41], [(71, 74), 71],
-                     [(81, 82), 81], [(90, 95), 11]]
-    geoprocessing.reclassify_from_data(tile, substitutions)
 
-    # Render new tiles using the reclassified nlcd data
-    img = tiles.render_tile_from_data(tile, palette)
-    return send_file(img, mimetype='image/png')
+    def render(bbox, tile_size):
+        tile, palette = tile_read(bbox, path, tile_size)
+        # Reclassify the nlcd data to be in related groups
+        substitutions = [[(21, 24), 23], [(41, 52), 41], [(71, 74), 71],
+                         [(81, 82), 81], [(90, 95), 11]]
+        geoprocessing.reclassify_from_data(tile, substitutions)
+
+        # Render new tiles using the reclassified nlcd data
+        return tile, palette, None
 
+    img = tiles.get_tile('nlcd-grouped', z, x, y, img_format, render)
+    return send_file(img, mimetype=tiles.MIMETYPES[img_format])
 
-@app.route('/priority/<int:z>/<int:x>/<int:y>.png')
-def priority(z, x, y):
+
+@app.route('/priority/<int:z>/<int:x>/<int:y>.<any(png, webp):img_format>')
+def priority(z, x, y, img_format):
     """
     A contrived prioritization analysis to identify areas where Green
     Stormwater Infrastructure projects would have the most benefit. This
@@ -194,15 +473,23 @@ def priority(z, x, y):
     provided by the client, exposing they dynamic nature of this on-the-fly
     processing.
     """
+    img = tiles.get_tile('priority', z, x, y, img_format, render_priority)
+    return send_file(img, mimetype=tiles.MIMETYPES[img_format])
+
+
+def render_priority(bbox, tile_size):
+    """
+    Run the priority analysis over a (meta)tile sized bbox, which is read,
+    reclassified and overlaid in a single pass
+    """
     # This would need to otherwise be specified in a config.
     # Requirements are EPSG:3857
     nlcd_path = '/usr/data/nlcd/nlcd_webm_512.tif'
     soil_path = '/usr/data/hydro_soils_webm_512.tif'
 
     # Decimated read for the bbox of each layer.
-    bbox = tile_to_bbox(z, x, y)
-    nlcd_tile, _ = tile_read(bbox, nlcd_path)
-    soil_tile, _ = tile_read(bbox, soil_path)
+    nlcd_tile, _ = tile_read(bbox, nlcd_path, tile_size)
+    soil_tile, _ = tile_read(bbox, soil_path, tile_size)
 
     # Reclassify both the nlcd and soils data sets into a priority map of
     # 0 (low) to 10 (high) normalized values.  For example, NLCD 21-24 are
@@ -232,13 +519,81 @@ def priority(z, x, y):
     # can round to ints so that we can create a straightforward palette
     priority_rounded = priority.astype(np.uint8)
 
-    # A color palette from 0 (white -> green) to 10 (red) for our overall
-    # site priorities
-    palette = [255,255,255, 0,104,55, 26,152,80, 102,189,99, 166,217,106, 217,239,139, 254,224,139, 253,174,97, 244,109,67, 215,48,39, 165,0,38]  # noqa
+    # Render the image tile for this priority map with the priority palette
+    return priority_rounded, PRIORITY_PALETTE, None
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Request and stage latency histograms of this worker process, in the
+    Prometheus text format
+    """
+    return Response(timing.render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def memoize(operation, user_input, compute):
+    """
+    The result of an analysis from the result cache, computing it on a miss.
+    Whether it was cached is reported in the X-Result-Cache header.
+    """
+    result, g.result_cache = result_cache.memoize(operation, user_input,
+                                                  compute)
+    return result
+
+
+def encode_response(data, array_key=None):
+    """
+    Serialize an analysis result with the time taken by the request, and the
+    time taken by each stage if requested with `?timing=true` or enabled
+    in settings, in the encoding which best matches the request's Accept
+    header
+
+    Args:
+        array_key (optional string): Key of the array in an array shaped
+            result, which can also be encoded as NPY or Arrow
+    """
+    timings = timing.current()
+    with timing.stage('serialize'):
+        data['time'] = timings.total()
+        if settings.RESPONSE_TIMINGS or \
+                request.args.get('timing', '').lower() in ('1', 'true'):
+            data['timings'] = timings.as_dict()
+
+        mimetype, encode = encoding.negotiate(request.accept_mimetypes,
+                                              array_key)
+        response = Response(encode(data, array_key), mimetype=mimetype)
+        response.vary.add('Accept')
+        return response
+
+
+@app.before_request
+def reset_request_stats():
+    raster_io.reset_request_stats()
+    timing.reset()
 
-    # Render the image tile for this priority map with the new palette
-    img = tiles.render_tile_from_data(priority_rounded, palette)
-    return send_file(img, mimetype='image/png')
+
+@app.after_request
+def add_request_stats(response):
+    """
+    Report the raster reads made by the request, the byte ranges and bytes
+    fetched from remote rasters, and the time spent in each stage, and
+    record the request latency
+    """
+    stats = raster_io.request_stats()
+    response.headers['X-Raster-Reads'] = stats.reads
+    response.headers['X-Raster-Ranges'] = stats.ranges
+    response.headers['X-Raster-Bytes'] = stats.bytes
+    if 'result_cache' in g:
+        response.headers['X-Result-Cache'] = g.result_cache
+
+    timings = timing.current()
+    response.headers['Server-Timing'] = timings.server_timing()
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    timing.record_request(route, response.status_code, timings)
+    return response
 
 
 @app.errorhandler(UserInputError)
@@ -0,0 +1,225 @@
+"""
+Zero-copy reads of uncompressed local rasters.  When settings.IO_MMAP is
+enabled, the first band of an uncompressed GeoTIFF whose strips or tiles are
+stored in order, or of a band sequential ENVI raster, is mapped into memory
+and windows are read as views of the map rather than decoded by GDAL into a
+new array.  The pages of a mapped raster are shared through the OS page
+cache by every worker process on the host.  Bands preloaded into shared
+memory by `preload.py` are read the same way.
+"""
+from __future__ import division
+
+import os
+import threading
+
+import numpy as np
+
+import settings
+
+# Mapped and preloaded bands, keyed by raster path.  A raster which can't
+# be mapped is kept as None, so it's only checked once per process.
+BANDS = {}
+BANDS_LOCK = threading.Lock()
+
+
+class MappedBand(object):
+    """
+    A band of a raster mapped into memory as (block row, block col, row,
+    col) of its blocks.  Windows of striped rasters are views of the map,
+    and windows of tiled rasters are gathered from the views of their tiles
+    without decoding them.  A band with a `factor` holds an overview of the
+    raster at 1/`factor` of its `height` and `width`, which only serves
+    reads decimated by at least as much.
+    """
+    def __init__(self, blocks, height, width, factor=1):
+        self.blocks = blocks
+        self.height = height
+        self.width = width
+        self.factor = factor
+
+    @property
+    def striped(self):
+        return self.blocks.shape[1] == 1
+
+    def rows(self):
+        return self.blocks.reshape(-1, self.blocks.shape[3])
+
+    def contains(self, window):
+        (row_start, row_stop), (col_start, col_stop) = window
+        return 0 <= row_start < row_stop <= self.height and \
+            0 <= col_start < col_stop <= self.width
+
+    def read(self, window):
+        """
+        The cells of a window, as a read-only view of the map for striped
+        rasters
+        """
+        (row_start, row_stop), (col_start, col_stop) = window
+        if self.striped:
+            return self.rows()[row_start:row_stop, col_start:col_stop]
+
+        block_rows, block_cols = self.blocks.shape[2:]
+        tiles = self.blocks[row_start // block_rows:
+                            (row_stop - 1) // block_rows + 1,
+                            col_start // block_cols:
+                            (col_stop - 1) // block_cols + 1]
+        cells = tiles.transpose(0, 2, 1, 3).reshape(
+            tiles.shape[0] * block_rows, tiles.shape[1] * block_cols)
+
+        row_offset = row_start % block_rows
+        col_offset = col_start % block_cols
+        return cells[row_offset:row_offset + row_stop - row_start,
+                     col_offset:col_offset + col_stop - col_start]
+
+    def resolves(self, window, shape):
+        """
+        Whether the band is at least as fine as a window read into `shape`
+        """
+        (row_start, row_stop), (col_start, col_stop) = window
+        return (row_stop - row_start) >= shape[0] * self.factor and \
+            (col_stop - col_start) >= shape[1] * self.factor
+
+    def read_decimated(self, window, shape):
+        """
+        The cells of a window resampled to `shape` by nearest neighbor, as
+        GDAL reads a window into a smaller array
+        """
+        (row_start, row_stop), (col_start, col_stop) = window
+        rows = row_start + ((np.arange(shape[0]) + 0.5) *
+                            (row_stop - row_start) / shape[0]).astype(int)
+        cols = col_start + ((np.arange(shape[1]) + 0.5) *
+                            (col_stop - col_start) / shape[1]).astype(int)
+
+        if self.factor > 1:
+            overview = self.rows()
+            rows = np.minimum(rows // self.factor, overview.shape[0] - 1)
+            cols = np.minimum(cols // self.factor, overview.shape[1] - 1)
+            return overview[np.ix_(rows, cols)]
+
+        if self.striped:
+            return self.rows()[np.ix_(rows, cols)]
+
+        block_rows, block_cols = self.blocks.shape[2:]
+        return self.blocks[(rows // block_rows)[:, np.newaxis],
+                           (cols // block_cols)[np.newaxis, :],
+                           (rows % block_rows)[:, np.newaxis],
+                           (cols % block_cols)[np.newaxis, :]]
+
+
+def read(src, window, out_shape=None):
+    """
+    Read a window of the first band of an open raster, from its preloaded
+    band, or its memory map when settings.IO_MMAP is enabled and it can be
+    mapped, otherwise with GDAL.  Views of the map are read-only, so they're
+    copied by anything which modifies them.
+
+    Args:
+        out_shape (optional tuple): Shape to resample the window to, as
+            `src.read` does, whose last two dimensions are used
+    """
+    band = BANDS.get(src.name)
+    if band is None and settings.IO_MMAP:
+        band = get_band(src)
+
+    if band is not None and band.contains(window):
+        if out_shape is not None and band.resolves(window, out_shape[-2:]):
+            return band.read_decimated(window, out_shape[-2:])
+        if out_shape is None and band.factor == 1:
+            return band.read(window)
+
+    return src.read(1, window=window, out_shape=out_shape)
+
+
+def get_band(src):
+    """
+    The MappedBand of the first band of an open raster, or None if it can't
+    be mapped
+    """
+    try:
+        return BANDS[src.name]
+    except KeyError:
+        pass
+
+    with BANDS_LOCK:
+        if src.name not in BANDS:
+            BANDS[src.name] = map_band(src)
+
+    return BANDS[src.name]
+
+
+def map_band(src):
+    if not os.path.isfile(src.name):
+        return None
+    if src.driver == 'GTiff':
+        return map_geotiff(src)
+    if src.driver == 'ENVI':
+        return map_envi(src)
+    return None
+
+
+def map_geotiff(src):
+    """
+    Map the first band of an uncompressed GeoTIFF, if its blocks are stored
+    one after another in row major order, as GDAL writes them
+    """
+    if src.compression is not None or (
+            src.count > 1 and
+            src.tags(ns='IMAGE_STRUCTURE').get('INTERLEAVE') != 'BAND'):
+        return None
+
+    block_rows, block_cols = src.block_shapes[0]
+    rows = -(-src.height // block_rows)
+    cols = -(-src.width // block_cols)
+    dtype = np.dtype(src.dtypes[0])
+    block_bytes = block_rows * block_cols * dtype.itemsize
+
+    first = block_offset(src, 0, 0)
+    last = block_offset(src, rows - 1, cols - 1)
+    if not first or last != first + (rows * cols - 1) * block_bytes:
+        return None
+
+    with open(src.name, 'rb') as f:
+        byte_order = '<' if f.read(2) == b'II' else '>'
+
+    # The last strip of a striped raster only holds its remaining rows
+    if cols == 1 and block_cols == src.width:
+        shape = (1, 1, src.height, src.width)
+    else:
+        shape = (rows, cols, block_rows, block_cols)
+
+    return MappedBand(np.memmap(src.name, dtype.newbyteorder(byte_order),
+                                mode='r', offset=first, shape=shape),
+                      src.height, src.width)
+
+
+def block_offset(src, row, col):
+    offset = src.get_tag_item('BLOCK_OFFSET_{0}_{1}'.format(col, row),
+                              'TIFF', bidx=1)
+    return int(offset) if offset else None
+
+
+def map_envi(src):
+    """
+    Map the first band of a band sequential ENVI raster, whose header gives
+    the offset and byte order of its cells
+    """
+    headers = [path for path in src.files if path.lower().endswith('.hdr')]
+    if not headers:
+        return None
+
+    header = {}
+    with open(headers[0]) as f:
+        for line in f:
+            key, _, value = line.partition('=')
+            header[key.strip().lower()] = value.strip()
+
+    if src.count > 1 and header.get('interleave', 'bsq').lower() != 'bsq':
+        return None
+
+    byte_order = '>' if header.get('byte order') == '1' else '<'
+    dtype = np.dtype(src.dtypes[0]).newbyteorder(byte_order)
+
+    return MappedBand(np.memmap(src.name, dtype, mode='r',
+                                offset=int(header.get('header offset', 0)),
+                                shape=(1, 1, src.height, src.width)),
+                      src.height, src.width)
@@ -0,0 +1,181 @@
+"""
+Plan how an analysis reads its rasters before reading them.  The cells an
+analysis would read and the memory it would need are estimated from the
+windows of the query polygon and the data type and block layout of each
+raster, and the analysis is then run in memory, streamed through in strips,
+read at a lower resolution or refused, within the limits of settings.
+"""
+from __future__ import division
+
+import numpy as np
+
+import raster_io
+import settings
+
+from errors import RequestTooLargeError
+from geo_utils import (classify_window, cluster_parts, get_window_and_affine,
+                       window_cells)
+
+# Modes of running an analysis
+MEMORY = 'memory'
+STREAM = 'stream'
+DECIMATE = 'decimate'
+
+# Memory needed for each cell of a window besides its value: the geometry
+# and nodata masks, and the flat index of a cell in the polygon
+CELL_OVERHEAD_BYTES = 10
+
+MB = 1024 * 1024
+
+
+class Estimate(object):
+    """
+    The cells of a raster an analysis of a polygon would read and hold
+    """
+    def __init__(self, window_cells, read_cells, width, itemsize):
+        self.window_cells = window_cells
+        self.read_cells = read_cells
+        self.width = width
+        self.itemsize = itemsize
+
+    @property
+    def read_bytes(self):
+        return self.read_cells * self.itemsize
+
+    @property
+    def memory_bytes(self):
+        # The window is read, and the values of the cells in the polygon
+        # are gathered into another array
+        return self.window_cells * (2 * self.itemsize + CELL_OVERHEAD_BYTES)
+
+
+class Plan(object):
+    """
+    How to run an analysis: its mode, the rows of each strip of a streamed
+    analysis and the factor of a decimated one
+    """
+    def __init__(self, mode, estimates, strip_rows=None, factor=1):
+        self.mode = mode
+        self.estimates = estimates
+        self.strip_rows = strip_rows
+        self.factor = factor
+
+
+def estimate(geom, raster_path):
+    """
+    Estimate the cells an analysis of `geom` would read from a raster, from
+    the window of each cluster of its parts and the blocks of the window
+    which intersect it, without reading any cells
+    """
+    raster_info = raster_io.info(raster_path)
+
+    total_cells = read_cells = width = 0
+    for part in cluster_parts(geom, raster_info):
+        window = get_window_and_affine(part, raster_info)[0]
+        regions = classify_window(part, window, raster_info)
+
+        total_cells += window_cells(window)
+        read_cells += window_cells(window) if regions is None else \
+            sum(window_cells(region) for region in regions[0] + regions[1])
+        width = max(width, window[1][1] - window[1][0])
+
+    return Estimate(total_cells, read_cells, width,
+                    np.dtype(raster_info.dtypes[0]).itemsize)
+
+
+def bounds_estimate(geom, raster_path):
+    """
+    An upper bound of `estimate`, from the window of the bounds of `geom`
+    """
+    raster_info = raster_io.info(raster_path)
+    window = get_window_and_affine(geom, raster_info)[0]
+
+    return Estimate(window_cells(window), window_cells(window),
+                    window[1][1] - window[1][0],
+                    np.dtype(raster_info.dtypes[0]).itemsize)
+
+
+def within_limits(estimates):
+    """
+    Whether the memory and the reads of estimates are within the limits of
+    settings
+    """
+    memory = sum(est.memory_bytes for est in estimates)
+    read = sum(est.read_bytes for est in estimates)
+
+    return (not settings.PLAN_MEMORY_MB or
+            memory <= settings.PLAN_MEMORY_MB * MB,
+            not settings.PLAN_MAX_READ_MB or
+            read <= settings.PLAN_MAX_READ_MB * MB)
+
+
+def plan(geom, raster_paths, streamable=True, approximate=False):
+    """
+    Choose how to run an analysis of `geom` over `raster_paths`.  It runs in
+    memory when it fits in settings.PLAN_MEMORY_MB, otherwise at the
+    coarsest power of 2 resolution which fits if approximate results are
+    allowed, or otherwise in strips of about settings.PLAN_STRIP_MB.
+
+    Args:
+        streamable (optional bool): Whether the analysis can be computed a
+            strip at a time, as counts and statistics can
+
+        approximate (optional bool): Whether the analysis can be computed
+            from a lower resolution
+
+    Returns:
+        A Plan
+
+    Raises:
+        RequestTooLargeError: If the analysis would read more than
+            settings.PLAN_MAX_READ_MB, or can't be streamed or decimated and
+            wouldn't fit in memory
+    """
+    # Most polygons are small enough that the whole window of their bounds
+    # is within the limits, without estimating the blocks they would read
+    estimates = [bounds_estimate(geom, raster_path)
+                 for raster_path in raster_paths]
+    if all(within_limits(estimates)):
+        return Plan(MEMORY, estimates)
+
+    estimates = [estimate(geom, raster_path) for raster_path in raster_paths]
+    fits, readable = within_limits(estimates)
+
+    if fits and readable:
+        return Plan(MEMORY, estimates)
+
+    memory = sum(est.memory_bytes for est in estimates)
+    read = sum(est.read_bytes for est in estimates)
+
+    memory_limit = settings.PLAN_MEMORY_MB * MB
+    read_limit = settings.PLAN_MAX_READ_MB * MB
+
+    if approximate:
+        factor = 2
+        while memory_limit and memory / factor**2 > memory_limit or \
+                read_limit and read / factor**2 > read_limit:
+            factor *= 2
+        return Plan(DECIMATE, estimates, factor=factor)
+
+    if streamable and readable:
+        return Plan(STREAM, estimates, strip_rows=strip_rows(estimates))
+
+    if not readable:
+        raise RequestTooLargeError(
+            'The query polygon would read {0:.0f}MB of raster data, more '
+            'than the limit of {1}MB'.format(read / MB,
+                                             settings.PLAN_MAX_READ_MB))
+
+    raise RequestTooLargeError(
+        'The query polygon would need {0:.0f}MB of memory, more than the '
+        'limit of {1}MB'.format(memory / MB, settings.PLAN_MEMORY_MB))
+
+
+def strip_rows(estimates):
+    """
+    The number of rows of the widest window of the rasters whose cells
+    would need about settings.PLAN_STRIP_MB of memory
+    """
+    row_bytes = sum(est.width * (2 * est.itemsize + CELL_OVERHEAD_BYTES)
+                    for est in estimates)
+    return max(int(settings.PLAN_STRIP_MB * MB // max(row_bytes, 1)), 1)
@@ -0,0 +1,132 @@
+"""
+Precompute zonal summaries for every feature of a boundary dataset into the
+zonal store, so the /boundaries routes can answer without reading rasters.
+Run from this directory:
+
+    python precompute.py huc12 huc12.geojson --id-field HUC12 \
+        --raster nlcd/nlcd_2011_landcover_2011_edition_2014_10_10.img \
+        --pair-raster hydro_soils.tif
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import time
+
+from multiprocessing import Pool, cpu_count
+
+from shapely.geometry import shape
+
+import settings
+
+from geo_utils import reproject
+from request_utils import DEFAULT_SRS, get_path
+from zonal_store import ANALYSES, ZonalStore
+
+
+def read_boundaries(path, id_field, from_srs, to_srs):
+    """
+    Read the features of a GeoJSON FeatureCollection as (id, geometry)
+    pairs, reprojected into the SRS of the rasters
+    """
+    with open(path) as f:
+        collection = json.load(f)
+
+    for feature in collection['features']:
+        geom = shape(feature['geometry'])
+        if from_srs != to_srs:
+            geom = reproject(geom, to_srs, from_srs)
+        yield str(feature['properties'][id_field]), geom
+
+
+def summarize_boundary(job):
+    """
+    Run every analysis over a single boundary in a worker process
+    """
+    boundary_id, geom, analyses = job
+    return boundary_id, geom, [
+        (analysis, rasters, ANALYSES[analysis](
+            geom, [get_path(raster) for raster in rasters]))
+        for analysis, rasters in analyses
+    ]
+
+
+def precompute(dataset, boundaries, analyses, store_path, processes=None):
+    """
+    Store each boundary of `dataset` and the result of each analysis over
+    it.  Analyses are computed across a pool of processes and written by
+    this process, so the store only ever has a single writer.
+
+    Args:
+        boundaries (iterable): (id, Shapely geometry) pairs
+        analyses (list): (analysis name, list of raster names) pairs
+
+    Returns:
+        The number of boundaries summarized
+    """
+    store = ZonalStore(store_path, create=True)
+    pool = Pool(processes or cpu_count())
+    jobs = ((boundary_id, geom, analyses) for boundary_id, geom in boundaries)
+
+    summarized = 0
+    try:
+        for boundary_id, geom, results in pool.imap_unordered(
+                summarize_boundary, jobs, chunksize=4):
+            store.put_boundary(dataset, boundary_id, geom)
+            for analysis, rasters, summary in results:
+                store.put_summary(dataset, boundary_id, analysis, rasters,
+                                  [get_path(raster) for raster in rasters],
+                                  summary)
+
+            summarized += 1
+            if summarized % 100 == 0:
+                store.commit()
+                print('{} boundaries summarized'.format(summarized))
+    finally:
+        pool.close()
+        pool.join()
+        store.commit()
+        store.close()
+
+    return summarized
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('dataset', help='Name of the boundary dataset, eg '
+                        'huc12, used in /boundaries/<dataset>/<id> routes')
+    parser.add_argument('geojson', help='GeoJSON FeatureCollection of '
+                        'boundaries')
+    parser.add_argument('--id-field', required=True,
+                        help='Feature property which identifies a boundary')
+    parser.add_argument('--srs', default='epsg:4326',
+                        help='SRS of the GeoJSON')
+    parser.add_argument('--raster-srs', default=DEFAULT_SRS)
+    parser.add_argument('--raster', action='append', default=[],
+                        help='Raster name in DATA_DIR to compute counts of, '
+                        'may be repeated')
+    parser.add_argument('--pair-raster', action='append', default=[],
+                        help='Raster name to compute pair counts of with '
+                        'each --raster, may be repeated')
+    parser.add_argument('--store', default=settings.ZONAL_STORE_PATH)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    analyses = [('counts', [raster]) for raster in args.raster]
+    analyses += [('pair-counts', [raster, pair_raster])
+                 for raster in args.raster for pair_raster in args.pair_raster]
+
+    start = time.time()
+    boundaries = read_boundaries(args.geojson, args.id_field, args.srs,
+                                 args.raster_srs)
+    summarized = precompute(args.dataset, boundaries, analyses, args.store,
+                            args.processes)
+
+    print('{} boundaries summarized in {:.1f}s'.format(
+        summarized, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
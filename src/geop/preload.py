@@ -0,0 +1,106 @@
+"""
+Hot layers loaded into shared memory when the app starts.  Run gunicorn
+with `--preload` and each layer of settings.PRELOAD_LAYERS is read once, in
+the master process before it forks its workers.  The cells are held in
+anonymous shared mappings which are never written after loading, so every
+worker reads the same physical pages rather than building its own copy, and
+the first requests of a worker don't wait for the layer to be read.
+"""
+from __future__ import division
+
+import logging
+import mmap
+import time
+
+import numpy as np
+import rasterio
+
+import memmap_io
+import raster_io
+import settings
+
+from request_utils import get_path
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_layers(layers):
+    """
+    Parse a comma separated list of layers, as tile layer names or raster
+    names in DATA_DIR, each optionally followed by `@` and the factor of the
+    overview to preload, eg `nlcd,soil@4`
+
+    Returns:
+        List of (raster path, factor) pairs
+    """
+    parsed = []
+    for layer in layers.split(','):
+        name, _, factor = layer.strip().partition('@')
+        if not name:
+            continue
+
+        if name in settings.TILE_LAYERS:
+            raster_path = settings.TILE_LAYERS[name]['path']
+        else:
+            raster_path = get_path(name)
+        parsed.append((raster_path, int(factor or 1)))
+
+    return parsed
+
+
+def shared_array(shape, dtype):
+    """
+    A zeroed array in an anonymous shared mapping.  Forked processes share
+    its pages with the process which created it.
+    """
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * np.dtype(dtype).itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+def preload_layer(raster_path, factor=1):
+    """
+    Read the first band of a raster, or its overview at 1/`factor` of its
+    resolution, into shared memory, and serve reads of the raster from it
+
+    Returns:
+        The MappedBand of the layer
+    """
+    with raster_io.env(raster_io.is_remote(raster_path)):
+        with rasterio.open(raster_path) as src:
+            # The overview is read from whole multiples of `factor` cells,
+            # so each of its cells is sampled from the same cell as GDAL
+            # samples for reads decimated by `factor`
+            shape = (max(src.height // factor, 1), max(src.width // factor, 1))
+            data = shared_array(shape, src.dtypes[0])
+            src.read(1, out=data, window=((0, min(shape[0] * factor,
+                                                  src.height)),
+                                          (0, min(shape[1] * factor,
+                                                  src.width))))
+
+            data.flags.writeable = False
+            band = memmap_io.MappedBand(data[np.newaxis, np.newaxis],
+                                        src.height, src.width, factor)
+            memmap_io.BANDS[src.name] = band
+
+    return band
+
+
+def preload(layers=None):
+    """
+    Preload every layer of `layers`, settings.PRELOAD_LAYERS by default
+
+    Returns:
+        The number of bytes loaded
+    """
+    loaded = 0
+    for raster_path, factor in parse_layers(
+            settings.PRELOAD_LAYERS if layers is None else layers):
+        start = time.time()
+        band = preload_layer(raster_path, factor)
+
+        loaded += band.blocks.nbytes
+        LOG.info('Preloaded %s at 1/%d in %.1fs, %dMB', raster_path, factor,
+                 time.time() - start, band.blocks.nbytes // (1024 * 1024))
+
+    return loaded
@@ -0,0 +1,351 @@
+"""
+Raster reads against object stores (s3:// or http(s)://) are blocking GDAL
+VSI calls.  Under a gevent worker they would block every request on the
+worker, so they are run on a bounded pool of OS threads while the calling
+greenlet waits.  Identical reads which are in flight at the same time are
+coalesced into a single read.
+
+Every read runs in a GDAL environment configured from settings, and the
+ranges and bytes fetched by remote reads are counted per request.
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import rasterio
+
+from multiprocessing.pool import ThreadPool
+from rasterio.transform import rowcol
+
+import settings
+import timing
+
+from cache import SingleFlight
+
+REMOTE_PREFIXES = ('s3://', 'http://', 'https://', '/vsis3/', '/vsicurl/')
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+READS = SingleFlight()
+
+# Layouts of rasters, keyed by raster path
+INFO = {}
+
+# Idle open datasets, keyed by raster path.  A dataset is only used by one
+# read at a time.
+DATASETS = {}
+DATASETS_LOCK = threading.Lock()
+
+# Read statistics of the current request, and of the read running on the
+# current I/O thread.  Local to each greenlet under gevent.
+LOCAL = threading.local()
+
+# GDAL logs each remote fetch as `Downloading 0-16383 (url)...`, or a list
+# of ranges when adjacent ranges are merged into a multi-range request
+DOWNLOAD_RE = re.compile(r'Downloading ([\d\-,]+)')
+RANGE_RE = re.compile(r'(\d+)-(\d+)')
+
+# Extensions of the rasters and sidecar files GDAL may look for remotely
+RASTER_EXTENSIONS = '.tif,.TIF,.tiff,.img,.ovr,.msk'
+
+
+class ReadStats(object):
+    def __init__(self):
+        self.reads = 0
+        self.ranges = 0
+        self.bytes = 0
+        self.open_time = 0
+        self.read_time = 0
+
+    def add(self, other):
+        self.reads += other.reads
+        self.ranges += other.ranges
+        self.bytes += other.bytes
+        self.open_time += other.open_time
+        self.read_time += other.read_time
+
+    def as_dict(self):
+        return {
+            'reads': self.reads,
+            'ranges': self.ranges,
+            'bytes': self.bytes,
+        }
+
+
+class RasterInfo(object):
+    """
+    The layout of a raster: its grid, data type, tiling and overviews.
+    Windows can be computed against it as against an open dataset, so
+    reads can be planned before they are made.
+    """
+    def __init__(self, src):
+        self.transform = src.transform
+        self.width = src.width
+        self.height = src.height
+        self.count = src.count
+        self.dtypes = src.dtypes
+        self.nodata = src.nodata
+        self.is_tiled = src.is_tiled
+        self.block_shapes = src.block_shapes
+        self.overviews = src.overviews(1)
+
+    def index(self, x, y):
+        return rowcol(self.transform, x, y)
+
+
+class DownloadCounter(logging.Handler):
+    """
+    Counts the byte ranges fetched by GDAL into the stats of the read
+    running on the thread which logged them
+    """
+    def emit(self, record):
+        stats = getattr(LOCAL, 'read_stats', None)
+        if stats is None:
+            return
+
+        match = DOWNLOAD_RE.search(record.getMessage())
+        if match:
+            for start, end in RANGE_RE.findall(match.group(1)):
+                stats.ranges += 1
+                stats.bytes += int(end) - int(start) + 1
+
+
+def is_remote(raster_path):
+    return raster_path.startswith(REMOTE_PREFIXES)
+
+
+def raster_version(raster_path):
+    """
+    The modification time and size of a local raster, which change when it
+    is replaced.  Remote rasters have no version, they are expected to be
+    replaced at a new path.
+    """
+    if is_remote(raster_path):
+        return None
+
+    stat = os.stat(raster_path)
+    return stat.st_mtime, stat.st_size
+
+
+def get_pool():
+    """
+    Get the I/O thread pool.  When threading has been monkey patched by
+    gevent, a regular ThreadPool would run greenlets rather than threads,
+    so gevent's native thread pool is used instead.
+    """
+    global POOL
+
+    if POOL is None:
+        with POOL_LOCK:
+            if POOL is None:
+                POOL = _gevent_pool() or ThreadPool(settings.IO_THREADS)
+
+    return POOL
+
+
+def _gevent_pool():
+    try:
+        import gevent
+        from gevent import monkey
+    except ImportError:
+        return None
+
+    if not monkey.is_module_patched('threading'):
+        return None
+
+    pool = gevent.get_hub().threadpool
+    pool.maxsize = settings.IO_THREADS
+    return pool
+
+
+def read(raster_path, reader, key=None):
+    """
+    Open `raster_path` and call `reader` with the open dataset.  Remote
+    rasters are read on the I/O thread pool, and concurrent reads with the
+    same `key` share a single read.
+
+    Args:
+        raster_path (string): Local path or URL of a raster
+
+        reader (function): Called with the open rasterio dataset, returns
+            the result of the read.  It runs on another thread, so must not
+            depend on request state.
+
+        key (optional hashable): Identifies reads which produce the same
+            result, typically the path, window and band.  Reads without a
+            key are not coalesced.
+
+    Returns:
+        The result of `reader`.  Arrays in the result of a keyed read are
+        copied for every caller, so callers are free to modify them in place.
+    """
+    if not (is_remote(raster_path) or settings.IO_POOL_LOCAL):
+        result, stats = open_and_read(raster_path, reader)
+        record_stats(stats)
+        return result
+
+    if key is None:
+        result, stats = get_pool().apply(open_and_read, (raster_path, reader))
+        record_stats(stats)
+        return result
+
+    start = time.time()
+    (result, stats), shared = READS.do((raster_path, key), get_pool().apply,
+                                       open_and_read, (raster_path, reader))
+
+    # A shared read is only counted against the request which made it, the
+    # others only spent time waiting for it
+    if shared:
+        timing.current().add('read', time.time() - start)
+    else:
+        record_stats(stats)
+
+    # The caller which made the read gets a copy too, as it would otherwise
+    # modify the arrays while the others copy them
+    return copy_arrays(result)
+
+
+def info(raster_path):
+    """
+    The RasterInfo of a raster, which is only opened for it once per process
+    """
+    raster_info = INFO.get(raster_path)
+    if raster_info is None:
+        if is_remote(raster_path) or settings.IO_POOL_LOCAL:
+            raster_info, stats = get_pool().apply(open_and_read,
+                                                  (raster_path, RasterInfo))
+        else:
+            raster_info, stats = open_and_read(raster_path, RasterInfo)
+
+        # Opening a raster for its layout doesn't read any of its cells, but
+        # anything fetched to open it is counted
+        stats.reads = 0
+        record_stats(stats)
+        INFO[raster_path] = raster_info
+
+    return raster_info
+
+
+def record_stats(stats):
+    request_stats().add(stats)
+
+    timings = timing.current()
+    timings.add('open', stats.open_time)
+    timings.add('read', stats.read_time)
+
+
+def open_and_read(raster_path, reader):
+    stats = ReadStats()
+    stats.reads = 1
+    LOCAL.read_stats = stats
+
+    try:
+        with env(is_remote(raster_path)):
+            start = time.time()
+            src = acquire_dataset(raster_path)
+            stats.open_time = time.time() - start
+
+            try:
+                result = reader(src)
+            except Exception:
+                src.close()
+                raise
+
+            stats.read_time = time.time() - start - stats.open_time
+            release_dataset(raster_path, src)
+            return result, stats
+    finally:
+        LOCAL.read_stats = None
+
+
+def acquire_dataset(raster_path):
+    with DATASETS_LOCK:
+        idle = DATASETS.get(raster_path)
+        if idle:
+            return idle.pop()
+
+    return rasterio.open(raster_path)
+
+
+def release_dataset(raster_path, src):
+    with DATASETS_LOCK:
+        idle = DATASETS.setdefault(raster_path, [])
+        if len(idle) < settings.IO_IDLE_DATASETS:
+            idle.append(src)
+            return
+
+    src.close()
+
+
+def env(remote=False):
+    """
+    The rasterio environment for a read, with the GDAL configuration options
+    from settings
+    """
+    # rasterio sets the cache size in bytes
+    options = {
+        'GDAL_CACHEMAX': settings.IO_BLOCK_CACHE_MB * 1024 * 1024,
+    }
+
+    if remote:
+        cache_bytes = settings.IO_VSI_CACHE_MB * 1024 * 1024
+        options.update({
+            'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+            'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': RASTER_EXTENSIONS,
+            'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES':
+                'YES' if settings.IO_MERGE_RANGES else 'NO',
+            'GDAL_HTTP_MULTIRANGE':
+                'YES' if settings.IO_MERGE_RANGES else 'NO',
+            'GDAL_INGESTED_BYTES_AT_OPEN': settings.IO_HEADER_BYTES,
+            'VSI_CACHE': 'TRUE' if settings.IO_VSI_CACHE_MB else 'FALSE',
+            'VSI_CACHE_SIZE': cache_bytes,
+            'CPL_VSIL_CURL_CACHE_SIZE': cache_bytes,
+            'CPL_DEBUG': 'ON' if settings.IO_STATS else 'OFF',
+        })
+
+    return rasterio.Env(**options)
+
+
+def request_stats():
+    """
+    Read statistics accumulated by the current request
+    """
+    stats = getattr(LOCAL, 'request_stats', None)
+    if stats is None:
+        stats = LOCAL.request_stats = ReadStats()
+    return stats
+
+
+def reset_request_stats():
+    LOCAL.request_stats = ReadStats()
+    return LOCAL.request_stats
+
+
+def install_download_counter():
+    gdal_logger = logging.getLogger('rasterio._env')
+    if not any(isinstance(handler, DownloadCounter)
+               for handler in gdal_logger.handlers):
+        gdal_logger.addHandler(DownloadCounter())
+        gdal_logger.setLevel(logging.DEBUG)
+
+
+def copy_arrays(result):
+    """
+    Copy the arrays of a read result.  Namedtuples, such as Affine
+    transforms, hold no arrays and are kept as they are.
+    """
+    if isinstance(result, np.ndarray):
+        return result.copy()
+    if isinstance(result, tuple) and not hasattr(result, '_fields'):
+        return tuple(copy_arrays(item) for item in result)
+    if isinstance(result, list):
+        return [copy_arrays(item) for item in result]
+    return result
+
+
+if settings.IO_STATS:
+    install_download_counter()
@@ -1,11 +1,28 @@
+import base64
 import os
 from shapely.geometry import shape
 
+import geometry_store
+import scenario_store
+import timing
+
 from geo_utils import reproject
 from errors import UserInputError
 
 DATA_PATH = '/usr/data/'
 DEFAULT_SRS = 'epsg:5070'
+QUERY_SRS = 'epsg:4326'
+
+# Content types of request bodies which are the WKB of the query polygon
+WKB_MIMETYPES = ('application/wkb', 'application/octet-stream')
+
+# Operations of /analyze, and the number of rasters each takes
+ANALYSIS_OPERATIONS = {
+    'counts': 1,
+    'pair-counts': 2,
+    'stats': 1,
+}
+STATS = ('min', 'max', 'mean', 'stddev')
 
 
 def get_path(raster_name):
@@ -19,6 +36,7 @@ def get_path(raster_name):
     return raster_path
 
 
+@timing.timed('parse')
 def parse_config(request):
     """
     Parse a JSON object from the request.
@@ -26,18 +44,38 @@ def parse_config(request):
     Keys:
         rasters (list): List of filenames for rasters
         queryPolygon (GeoJSON): Input to query on
+        queryPolygonWkb (string): In place of `queryPolygon`, the base64
+            encoded WKB of the polygon.  The body of a request with a
+            `application/wkb` content type is taken as the WKB instead, and
+            the other keys are read from its query string, with `rasters`
+            as a comma separated list.
+        queryGeometryId (string): In place of `queryPolygon`, the id of a
+            polygon registered by POST /geometries in the SRS of `rasters`
         src_srs (string): Optional.  SRS of `rasters`. Defaults to EPSG:5070
+        query_srs (string): Optional.  SRS of `queryPolygon`,
+            `queryPolygonWkb`, `queryLine` and `modifications`. Defaults to
+            EPSG:4326
+        approximate (bool): Optional.  Allow approximate counts from the
+            block histogram index of a raster
+        modifications (list): Optional.  Polygons and the `newValue` to
+            write over the rasters where they intersect
+        scenarioId (string): Optional.  The id of modifications stored by
+            POST /scenarios, in place of `modifications`
 
     """
 
+    wkb_body = None
     if 'get_json' in dir(request):
-        req_config = request.get_json(silent=True)
+        if request.mimetype in WKB_MIMETYPES:
+            req_config = parse_wkb_args(request.args)
+            wkb_body = request.get_data()
+        else:
+            req_config = request.get_json(silent=True)
     else:
         req_config = request
 
     if req_config:
         query_line_srs = None
-        query_polygon_srs = None
 
         rasters = req_config.get('rasters', None)
         if not rasters:
@@ -45,26 +83,35 @@ def parse_config(request):
 
         raster_paths = [get_path(raster) for raster in rasters]
 
-        query_polygon = req_config.get('queryPolygon', None)
+        srs = req_config.get('src_srs', DEFAULT_SRS)
+        query_srs = req_config.get('query_srs', QUERY_SRS)
+
+        query_polygon_srs = parse_polygon(req_config, srs, wkb_body)
         query_line = req_config.get('queryLine', None)
-        if not query_polygon and not query_line:
+        if not query_polygon_srs and not query_line:
             raise UserInputError('queryPolygon or queryLine key is required \
                                  in config')
 
-        srs = req_config.get('src_srs', DEFAULT_SRS)
-
-        # Reproject the required input query polygon
-        if query_polygon:
-            query_polygon_srs = reproject(shape(query_polygon), srs)
-
         if query_line:
-            query_line_srs = reproject(shape(query_line), srs)
+            query_line_srs = reproject(shape(query_line), srs, query_srs)
 
         # Modifications are optional, reproject if any exist
         mods = req_config.get('modifications', None)
         if mods:
             for mod in mods:
-                mod['geom'] = reproject(shape(mod['geom']), srs)
+                mod['geom'] = reproject(shape(mod['geom']), srs, query_srs)
+
+        # Stored scenarios are already reprojected
+        scenario_id = req_config.get('scenarioId')
+        if scenario_id:
+            if mods:
+                raise UserInputError('modifications and scenarioId can not '
+                                     'both be given')
+
+            mods = scenario_store.get_scenario(scenario_id)
+            if mods is None:
+                raise UserInputError('{} is not a stored scenario'.format(
+                    scenario_id))
 
         return {
             'query_polygon': query_polygon_srs,
@@ -72,6 +119,184 @@ def parse_config(request):
             'raster_paths': raster_paths,
             'srs': srs,
             'mods': mods,
+            'approximate': bool(req_config.get('approximate')),
         }
 
     raise UserInputError('JSON config is required in body')
+
+
+def parse_wkb_args(args):
+    """
+    The config of a request with a WKB body, from its query string
+    """
+    req_config = dict(args.items())
+    if req_config.get('rasters'):
+        req_config['rasters'] = req_config['rasters'].split(',')
+    req_config['approximate'] = \
+        req_config.get('approximate', '').lower() in ('1', 'true')
+
+    return req_config
+
+
+def parse_polygon(req_config, srs, wkb_body=None):
+    """
+    The query polygon of a config, reprojected into `srs`, from GeoJSON,
+    WKB or the id of a registered geometry.  Polygons given as WKB or by id
+    are cached with their prepared geometry, so repeated requests over the
+    same polygon don't parse or reproject it again.
+
+    Returns:
+        The polygon, or None if the config doesn't have one
+    """
+    query_srs = req_config.get('query_srs', QUERY_SRS)
+
+    geometry_id = req_config.get('queryGeometryId')
+    if geometry_id:
+        geom = geometry_store.get_geometry(geometry_id)
+        if geom is None:
+            raise UserInputError('{} is not a registered geometry'.format(
+                geometry_id))
+        if geom.srs != srs:
+            raise UserInputError('{0} is registered in {1}, not {2}'.format(
+                geometry_id, geom.srs, srs))
+        return geom
+
+    data = wkb_body
+    if not data and req_config.get('queryPolygonWkb'):
+        try:
+            data = base64.b64decode(req_config['queryPolygonWkb'])
+        except (TypeError, ValueError):
+            raise UserInputError('queryPolygonWkb is not base64 encoded')
+
+    if data:
+        try:
+            return geometry_store.from_wkb(data, srs, query_srs)
+        except ValueError:
+            raise UserInputError('queryPolygonWkb is not valid WKB')
+
+    query_polygon = req_config.get('queryPolygon')
+    if query_polygon:
+        return reproject(shape(query_polygon), srs, query_srs)
+
+    return None
+
+
+def parse_geometry(request):
+    """
+    Parse a polygon to register, given by the same keys as the query
+    polygon of `parse_config`: `queryPolygon`, `queryPolygonWkb` or a WKB
+    body, `src_srs` and `query_srs`
+
+    Returns:
+        The polygon reprojected into `src_srs`, and `src_srs`
+    """
+    wkb_body = None
+    if request.mimetype in WKB_MIMETYPES:
+        req_config = parse_wkb_args(request.args)
+        wkb_body = request.get_data()
+    else:
+        req_config = request.get_json(silent=True) or {}
+
+    srs = req_config.get('src_srs', DEFAULT_SRS)
+    geom = parse_polygon(dict(req_config, queryGeometryId=None), srs,
+                         wkb_body)
+    if geom is None:
+        raise UserInputError('queryPolygon or queryPolygonWkb key is '
+                             'required in config')
+
+    return geom, srs
+
+
+def parse_scenario(request):
+    """
+    Parse a JSON object of modifications to store as a scenario.
+
+    Keys:
+        modifications (list): Polygons and the `newValue` to write over
+            rasters where they intersect, applied in order
+        rasters (list): Optional.  Rasters whose grids the modifications
+            are rasterized on when the scenario is stored, rather than by
+            its first analysis of each
+        src_srs (string): Optional.  SRS of the rasters. Defaults to
+            EPSG:5070
+        query_srs (string): Optional.  SRS of the modifications. Defaults
+            to EPSG:4326
+
+    Returns:
+        The reprojected modifications, and the raster paths
+    """
+    req_config = request.get_json(silent=True)
+    mods = req_config.get('modifications') if req_config else None
+    if not mods:
+        raise UserInputError('modifications key is required in config')
+
+    srs = req_config.get('src_srs', DEFAULT_SRS)
+    query_srs = req_config.get('query_srs', QUERY_SRS)
+    for mod in mods:
+        if 'geom' not in mod or 'newValue' not in mod:
+            raise UserInputError('modifications require geom and newValue')
+        mod['geom'] = reproject(shape(mod['geom']), srs, query_srs)
+
+    raster_paths = [get_path(raster)
+                    for raster in req_config.get('rasters') or []]
+
+    return mods, raster_paths
+
+
+def parse_analyses(request):
+    """
+    Parse a JSON object of several analyses over a shared query polygon.
+
+    Keys:
+        queryPolygon (GeoJSON): Input to query on
+        src_srs (string): Optional.  SRS of the rasters. Defaults to EPSG:5070
+        analyses (list): Objects with the `operation` to run, `counts`,
+            `pair-counts` or `stats`, its list of `rasters`, and the `stat`
+            of `stats`
+
+    Returns:
+        The config parsed by `parse_config`, with `analyses` as a list of
+        (operation, raster paths, stat) tuples
+    """
+    if 'get_json' in dir(request):
+        req_config = request.get_json(silent=True)
+    else:
+        req_config = request
+
+    analyses = req_config.get('analyses') if req_config else None
+    if not analyses:
+        raise UserInputError('analyses key is required in config')
+
+    rasters = []
+    for analysis in analyses:
+        operation = analysis.get('operation')
+        if operation not in ANALYSIS_OPERATIONS:
+            raise UserInputError('{} is not a supported operation'.format(
+                operation))
+
+        analysis_rasters = analysis.get('rasters') or []
+        if len(analysis_rasters) != ANALYSIS_OPERATIONS[operation]:
+            raise UserInputError('{} requires {} rasters'.format(
+                operation, ANALYSIS_OPERATIONS[operation]))
+
+        if operation == 'stats' and analysis.get('stat') not in STATS:
+            raise UserInputError('stat must be one of {}'.format(
+                ', '.join(STATS)))
+
+        rasters.extend(raster for raster in analysis_rasters
+                       if raster not in rasters)
+
+    # Every raster is validated and the polygon reprojected once
+    user_input = parse_config(dict(req_config, rasters=rasters))
+    if user_input['query_polygon'] is None:
+        raise UserInputError('queryPolygon key is required in config')
+
+    paths = dict(zip(rasters, user_input['raster_paths']))
+    user_input['analyses'] = [
+        (analysis['operation'], [paths[raster]
+                                 for raster in analysis['rasters']],
+         analysis.get('stat'))
+        for analysis in analyses
+    ]
+
+    return user_input
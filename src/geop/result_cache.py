@@ -0,0 +1,79 @@
+"""
+Memoized results of analysis endpoints.  Identical requests, such as page
+reloads or several users viewing the same project, are answered from an
+in-memory cache, and concurrent identical requests wait on a single
+computation rather than each computing it.
+"""
+import hashlib
+import json
+
+import raster_io
+import scenario_store
+import settings
+
+from cache import LRUCache, SingleFlight
+
+# Analysis results keyed by the hash of their request
+RESULTS = LRUCache(settings.RESULT_CACHE_SIZE, settings.RESULT_CACHE_TTL)
+
+# Results being computed, keyed the same way
+COMPUTATIONS = SingleFlight()
+
+
+def result_key(operation, user_input):
+    """
+    A hash of everything an analysis result depends on: the operation, the
+    rasters and the version of each, the reprojected query geometry and
+    any modifications
+
+    Args:
+        operation (string): Name of the analysis and any of its parameters,
+            eg `stats/mean`
+
+        user_input (dict): The request as parsed by `parse_config`
+    """
+    geom = user_input['query_polygon'] or user_input['query_line']
+    mods = user_input['mods'] or []
+    if isinstance(mods, scenario_store.Scenario):
+        mods = mods.id
+    else:
+        mods = [(mod['geom'].wkb.encode('hex'), mod['newValue'])
+                for mod in mods]
+
+    request = json.dumps({
+        'operation': operation,
+        'rasters': [(path, raster_io.raster_version(path))
+                    for path in user_input['raster_paths']],
+        'geom': getattr(geom, 'geometry_id', None) or geom.wkb.encode('hex'),
+        'mods': mods,
+        'approximate': user_input['approximate'],
+    }, sort_keys=True)
+
+    return hashlib.sha1(request).hexdigest()
+
+
+def memoize(operation, user_input, compute):
+    """
+    The cached result of an analysis, or the result of `compute()` if it
+    isn't cached.  The result must not be modified, it is returned as a
+    shallow copy so the response can add to it.
+
+    Returns:
+        The result, and `hit` if it was cached, `shared` if it was computed
+        for a concurrent identical request, or `miss`
+    """
+    if not settings.RESULT_CACHE_SIZE:
+        return compute(), 'miss'
+
+    key = result_key(operation, user_input)
+    result = RESULTS.get(key)
+    if result is not None:
+        return dict(result), 'hit'
+
+    def compute_and_cache():
+        result = compute()
+        RESULTS.set(key, result)
+        return result
+
+    result, shared = COMPUTATIONS.do(key, compute_and_cache)
+    return dict(result), 'shared' if shared else 'miss'
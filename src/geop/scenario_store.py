@@ -0,0 +1,286 @@
+"""
+Scenarios of modifications stored server side, so analyses of a scenario
+reference it by id rather than sending, reprojecting and rasterizing its
+modifications with every request.  A scenario keeps its reprojected
+modifications and, for each raster grid it has been analyzed on, the cells
+each modification covers.  Analyses burn those cells into the windows they
+read without any geometry work.
+
+Scenarios are kept in a SQLite file at settings.SCENARIO_STORE_PATH, so
+every worker process shares them, and recently used scenarios are cached in
+memory.
+"""
+from __future__ import division
+
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+
+from io import BytesIO
+
+import numpy as np
+
+from affine import Affine
+from rasterio import features
+from shapely import wkb
+
+import settings
+
+from cache import LRUCache
+
+# Open stores, keyed by file path
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+# Recently used scenarios, keyed by id
+SCENARIOS = LRUCache(settings.SCENARIO_CACHE_SIZE)
+
+
+class Scenario(object):
+    """
+    Modifications of rasters, as a list of dicts of a reprojected `geom` and
+    its `newValue`, applied in order.  The cells each covers are rasterized
+    once for each grid they're burned into.
+    """
+    def __init__(self, scenario_id, mods, store=None):
+        self.id = scenario_id
+        self.mods = mods
+        self.store = store
+        self.deltas = {}
+        self.lock = threading.Lock()
+
+    def delta(self, grid, all_touched=True):
+        """
+        The cells of a grid covered by each modification, loaded from the
+        store or rasterized and stored if this is the first use of the grid
+
+        Args:
+            grid (tuple): The grid of a window, as given by `grid_of`
+
+        Returns:
+            A list of (rows, cols, new value) of each modification, in
+            order, where rows and cols are arrays of cells of the grid
+        """
+        key = json.dumps(list(grid) + [all_touched])
+        delta = self.deltas.get(key)
+        if delta is not None:
+            return delta
+
+        with self.lock:
+            if key not in self.deltas:
+                delta = self.store.get_delta(self.id, key) \
+                    if self.store else None
+                if delta is None:
+                    delta = rasterize_delta(self.mods, grid, all_touched)
+                    if self.store:
+                        self.store.put_delta(self.id, key, delta)
+                self.deltas[key] = delta
+
+        return self.deltas[key]
+
+    def burn(self, band, shifted_affine, all_touched=True):
+        """
+        Write the new values of the scenario into a window of a raster in
+        place, as rasterizing its modifications over the window would
+        """
+        grid, row_offset, col_offset = grid_of(shifted_affine)
+        rows_in_window, cols_in_window = band.shape
+
+        for rows, cols, value in self.delta(grid, all_touched):
+            rows = rows - row_offset
+            cols = cols - col_offset
+            inside = (rows >= 0) & (rows < rows_in_window) & \
+                (cols >= 0) & (cols < cols_in_window)
+            band[rows[inside], cols[inside]] = value
+
+
+def grid_of(transform):
+    """
+    The grid a window is on, and the row and col of its upper left cell on
+    the grid.  Windows of the same raster, and rasters aligned with it, are
+    on the same grid.
+
+    Returns:
+        The grid as (cell width, cell height, and the offset of the grid's
+        origin in a cell in x and y), row and col
+    """
+    col = transform.c / transform.a
+    row = transform.f / transform.e
+
+    # Offsets are rounded so windows whose origins differ by float error
+    # are on the same grid
+    col_origin = round(col % 1, 6) % 1
+    row_origin = round(row % 1, 6) % 1
+
+    return ((transform.a, transform.e, col_origin, row_origin),
+            int(round(row - row_origin)), int(round(col - col_origin)))
+
+
+def rasterize_delta(mods, grid, all_touched=True):
+    """
+    Rasterize each modification over the window of its bounds on a grid
+
+    Returns:
+        A list of (rows, cols, new value) of each modification
+    """
+    width, height, col_origin, row_origin = grid
+    delta = []
+    for mod in mods:
+        minx, miny, maxx, maxy = mod['geom'].bounds
+
+        # A cell of margin around the bounds, so all touched cells on the
+        # edges of the bounds are rasterized
+        col_start = int(math.floor(minx / width - col_origin)) - 1
+        col_stop = int(math.ceil(maxx / width - col_origin)) + 1
+        row_start = int(math.floor(maxy / height - row_origin)) - 1
+        row_stop = int(math.ceil(miny / height - row_origin)) + 1
+
+        covered = features.geometry_mask(
+            [mod['geom']], out_shape=(row_stop - row_start,
+                                      col_stop - col_start),
+            transform=Affine(width, 0, (col_start + col_origin) * width,
+                             0, height, (row_start + row_origin) * height),
+            all_touched=all_touched, invert=True)
+
+        rows, cols = np.nonzero(covered)
+        delta.append(((rows + row_start).astype(np.int32),
+                      (cols + col_start).astype(np.int32),
+                      mod['newValue']))
+
+    return delta
+
+
+def scenario_id(mods):
+    """
+    A hash of reprojected modifications, so the same modifications are
+    always stored as the same scenario
+    """
+    return hashlib.sha1(json.dumps(
+        [(mod['geom'].wkb.encode('hex'), mod['newValue']) for mod in mods]
+    )).hexdigest()
+
+
+class ScenarioStore(object):
+    """
+    Scenarios' modifications, as WKB and new values, and the rasterized
+    delta of each scenario on each grid it has been analyzed on
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS scenarios (
+                id TEXT PRIMARY KEY,
+                mods TEXT);
+            CREATE TABLE IF NOT EXISTS deltas (
+                id TEXT,
+                grid TEXT,
+                delta BLOB,
+                PRIMARY KEY (id, grid));
+        """)
+
+    def get_scenario(self, scenario_id):
+        with self.lock:
+            row = self.conn.execute('SELECT mods FROM scenarios WHERE id = ?',
+                                    (scenario_id,)).fetchone()
+        if not row:
+            return None
+
+        mods = [{'geom': wkb.loads(geom, hex=True), 'newValue': value}
+                for geom, value in json.loads(row[0])]
+        return Scenario(scenario_id, mods, self)
+
+    def put_scenario(self, scenario):
+        mods = [(mod['geom'].wkb.encode('hex'), mod['newValue'])
+                for mod in scenario.mods]
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO scenarios VALUES (?, ?)',
+                (scenario.id, json.dumps(mods)))
+            self.conn.commit()
+
+    def get_delta(self, scenario_id, grid):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT delta FROM deltas WHERE id = ? AND grid = ?',
+                (scenario_id, grid)).fetchone()
+        if not row:
+            return None
+
+        with np.load(BytesIO(bytes(row[0]))) as npz:
+            return [(npz['rows_{}'.format(idx)], npz['cols_{}'.format(idx)],
+                     npz['values'][idx].item())
+                    for idx in range(len(npz['values']))]
+
+    def put_delta(self, scenario_id, grid, delta):
+        arrays = {}
+        for idx, (rows, cols, _) in enumerate(delta):
+            arrays['rows_{}'.format(idx)] = rows
+            arrays['cols_{}'.format(idx)] = cols
+
+        f = BytesIO()
+        np.savez_compressed(f, values=np.array([value for _, _, value
+                                                in delta]), **arrays)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO deltas VALUES (?, ?, ?)',
+                (scenario_id, grid, sqlite3.Binary(f.getvalue())))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def get_store():
+    """
+    The scenario store at settings.SCENARIO_STORE_PATH, created if it
+    doesn't exist yet, or None if there's no path or its directory is
+    missing
+    """
+    path = settings.SCENARIO_STORE_PATH
+    store = STORES.get(path)
+    if store is None:
+        if not path or not os.path.isdir(os.path.dirname(path) or '.'):
+            return None
+
+        with STORES_LOCK:
+            store = STORES.get(path)
+            if store is None:
+                store = STORES[path] = ScenarioStore(path)
+
+    return store
+
+
+def create_scenario(mods):
+    """
+    Store a scenario of reprojected modifications
+
+    Returns:
+        The Scenario
+    """
+    store = get_store()
+    scenario = Scenario(scenario_id(mods), mods, store)
+    if store:
+        store.put_scenario(scenario)
+
+    SCENARIOS.set(scenario.id, scenario)
+    return scenario
+
+
+def get_scenario(scenario_id):
+    """
+    A stored scenario, or None if there isn't one with the id
+    """
+    scenario = SCENARIOS.get(scenario_id)
+    if scenario is None:
+        store = get_store()
+        scenario = store.get_scenario(scenario_id) if store else None
+        if scenario is not None:
+            SCENARIOS.set(scenario_id, scenario)
+
+    return scenario
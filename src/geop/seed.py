@@ -0,0 +1,143 @@
+"""
+Pre-render tiles of a static tile layer into the tile store, so the tile
+routes can serve them without rendering.  Run from this directory:
+
+    python seed.py nlcd --bbox -75.3 39.8 -74.9 40.1 --zooms 8 14
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import time
+
+from multiprocessing import Pool, cpu_count
+
+import settings
+import tiles
+
+from geo_utils import lnglat_to_tile, tile_to_bbox
+from tile_store import DirectoryStore, MBTilesStore, mbtiles_path
+
+
+def tile_range(bbox, min_zoom, max_zoom):
+    """
+    Generate every z/x/y tile which intersects a EPSG:4326 bounding box
+    """
+    west, south, east, north = bbox
+    for zoom in range(min_zoom, max_zoom + 1):
+        min_x, min_y = lnglat_to_tile(west, north, zoom)
+        max_x, max_y = lnglat_to_tile(east, south, zoom)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield zoom, x, y
+
+
+def render_seed_tile(job):
+    """
+    Render a single tile in a worker process
+
+    Returns:
+        The tile coordinates and encoded tile, which is None when every cell
+        of the tile is nodata
+    """
+    layer, img_format, zoom, x, y = job
+    config = settings.TILE_LAYERS[layer]
+    palette = config['palette']
+    if palette:
+        palette = tiles.make_palette(palette)
+
+    img = tiles.render_tile(tile_to_bbox(zoom, x, y), config['path'],
+                            palette, img_format, config['nodata'],
+                            skip_empty=True)
+
+    return zoom, x, y, img.getvalue() if img is not None else None
+
+
+def seed(layer, bbox, min_zoom, max_zoom, img_format, store_path,
+         use_mbtiles=False, processes=None):
+    """
+    Render all tiles of `layer` within `bbox` between two zoom levels across a
+    pool of processes.  Tiles are written by this process as they are
+    rendered, so an MBTiles file only ever has a single writer.
+
+    Returns:
+        The number of tiles written and skipped
+    """
+    jobs = ((layer, img_format, zoom, x, y)
+            for zoom, x, y in tile_range(bbox, min_zoom, max_zoom))
+
+    if use_mbtiles:
+        mbtiles = MBTilesStore(mbtiles_path(store_path, layer, img_format),
+                               create=True)
+        mbtiles.set_metadata({
+            'name': layer,
+            'type': 'overlay',
+            'version': '1',
+            'format': img_format,
+            'bounds': ','.join(str(coord) for coord in bbox),
+            'minzoom': min_zoom,
+            'maxzoom': max_zoom,
+        })
+    else:
+        directory = DirectoryStore(store_path)
+
+    written = skipped = 0
+    pool = Pool(processes or cpu_count())
+
+    try:
+        for zoom, x, y, img in pool.imap_unordered(render_seed_tile, jobs,
+                                                   chunksize=16):
+            if img is None:
+                skipped += 1
+                continue
+
+            if use_mbtiles:
+                mbtiles.put(zoom, x, y, img)
+            else:
+                directory.put(layer, zoom, x, y, img_format, img)
+
+            written += 1
+            if written % 1000 == 0:
+                if use_mbtiles:
+                    mbtiles.commit()
+                print('{} tiles written'.format(written))
+    finally:
+        pool.close()
+        pool.join()
+
+        if use_mbtiles:
+            mbtiles.commit()
+            mbtiles.close()
+
+    return written, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('layer', choices=sorted(settings.TILE_LAYERS))
+    parser.add_argument('--bbox', type=float, nargs=4, required=True,
+                        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                        help='EPSG:4326 bounding box to seed')
+    parser.add_argument('--zooms', type=int, nargs=2, required=True,
+                        metavar=('MIN', 'MAX'))
+    parser.add_argument('--format', default=settings.TILE_FORMAT,
+                        choices=sorted(tiles.MIMETYPES))
+    parser.add_argument('--store', default=settings.TILE_STORE_PATH,
+                        help='Tile store directory')
+    parser.add_argument('--mbtiles', action='store_true',
+                        help='Write an MBTiles file instead of a directory '
+                        'tree of tiles')
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    start = time.time()
+    written, skipped = seed(args.layer, args.bbox, args.zooms[0],
+                            args.zooms[1], args.format, args.store,
+                            args.mbtiles, args.processes)
+
+    print('{} tiles written, {} empty tiles skipped in {:.1f}s'.format(
+        written, skipped, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
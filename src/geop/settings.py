@@ -0,0 +1,159 @@
+"""
+Tunable settings for the geoprocessing service.  Every value can be
+overridden by an environment variable of the same name, which allows the
+Flask container and the lambda package to be configured without code
+changes.
+"""
+import os
+
+
+def env(name, default, cast=str):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if cast is bool:
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return cast(value)
+
+
+# Include the time spent in each stage of a request in analysis responses.
+# Can be enabled per request with `?timing=true`.
+RESPONSE_TIMINGS = env('RESPONSE_TIMINGS', False, bool)
+
+# Reads of remote rasters run on a pool of IO_THREADS threads, so they don't
+# block a gevent worker.  Local reads run on the pool when IO_POOL_LOCAL.
+IO_THREADS = env('IO_THREADS', 8, int)
+IO_POOL_LOCAL = env('IO_POOL_LOCAL', False, bool)
+
+# Up to IO_IDLE_DATASETS open handles to each raster are kept between reads,
+# so its header isn't fetched and parsed again.  0 closes after every read.
+IO_IDLE_DATASETS = env('IO_IDLE_DATASETS', 4, int)
+
+# Uncompressed local rasters are memory mapped when IO_MMAP, and windows of
+# them are read as views of the map rather than decoded by GDAL.  The pages
+# of a raster are shared by every worker process through the page cache.
+IO_MMAP = env('IO_MMAP', False, bool)
+
+# Hot layers read into shared memory at startup, as a comma separated list
+# of tile layer names or raster names in DATA_DIR.  A name followed by `@4`
+# preloads its overview at 1/4 resolution, which serves tiles at low zooms.
+# Run gunicorn with --preload so workers share a single copy.
+PRELOAD_LAYERS = env('PRELOAD_LAYERS', '')
+
+# GDAL configuration for every raster read.  The block cache is shared by
+# all reads in a process.  Remote reads merge adjacent byte ranges into
+# single requests, fetch IO_HEADER_BYTES up front when opening a file to get
+# the header in one request, and keep fetched ranges in an IO_VSI_CACHE_MB
+# cache.  When IO_STATS is enabled, ranges and bytes fetched are counted
+# for each request from GDAL's debug messages, which turns on GDAL debug
+# logging, so it's off by default.
+IO_BLOCK_CACHE_MB = env('IO_BLOCK_CACHE_MB', 256, int)
+IO_MERGE_RANGES = env('IO_MERGE_RANGES', True, bool)
+IO_HEADER_BYTES = env('IO_HEADER_BYTES', 32768, int)
+IO_VSI_CACHE_MB = env('IO_VSI_CACHE_MB', 64, int)
+IO_STATS = env('IO_STATS', False, bool)
+
+# Tile encoding.  PNG compression level is the zlib level (0-9), compression
+# type is the zlib strategy: -1 default, 1 filtered, 2 huffman only, 3 rle,
+# 4 fixed.  Compare settings for a layer with `python benchmark.py encode`.
+TILE_FORMAT = env('TILE_FORMAT', 'png')
+TILE_PNG_COMPRESS_LEVEL = env('TILE_PNG_COMPRESS_LEVEL', 6, int)
+TILE_PNG_COMPRESS_TYPE = env('TILE_PNG_COMPRESS_TYPE', -1, int)
+TILE_WEBP_LOSSLESS = env('TILE_WEBP_LOSSLESS', True, bool)
+TILE_WEBP_QUALITY = env('TILE_WEBP_QUALITY', 80, int)
+
+# Tiles are rendered in metatiles of METATILE_SIZE x METATILE_SIZE tiles
+# with a single read, and every tile of the metatile is kept in an in-memory
+# cache of TILE_CACHE_SIZE encoded tiles
+METATILE_SIZE = env('METATILE_SIZE', 4, int)
+TILE_CACHE_SIZE = env('TILE_CACHE_SIZE', 4096, int)
+
+# Directory of tiles pre-rendered by `seed.py`, which are served before
+# rendering.  An empty value disables the tile store.  The keys of the last
+# TILE_RENDERED_SIZE tiles rendered by a process, which aren't in the store,
+# are kept so they aren't looked up in it again.
+TILE_STORE_PATH = env('TILE_STORE_PATH', '/usr/data/tiles')
+TILE_RENDERED_SIZE = env('TILE_RENDERED_SIZE', 65536, int)
+
+# SQLite file of zonal summaries of boundaries precomputed by
+# `precompute.py`, which the /boundaries routes answer from.  An empty value
+# disables the store.
+ZONAL_STORE_PATH = env('ZONAL_STORE_PATH', '/usr/data/zonal.sqlite')
+
+# SQLite file of scenarios of modifications stored by POST /scenarios, and
+# the number of scenarios cached in memory by each process.  Without a
+# store, scenarios are only kept in the memory of the process which
+# stored them.
+SCENARIO_STORE_PATH = env('SCENARIO_STORE_PATH', '/usr/data/scenarios.sqlite')
+SCENARIO_CACHE_SIZE = env('SCENARIO_CACHE_SIZE', 256, int)
+
+# SQLite file of query polygons registered by POST /geometries, and the
+# number of registered polygons and polygons sent as WKB cached in memory by
+# each process.  Without a store, registered polygons are only kept in the
+# memory of the process which registered them.
+GEOMETRY_STORE_PATH = env('GEOMETRY_STORE_PATH', '/usr/data/geometries.sqlite')
+GEOMETRY_CACHE_SIZE = env('GEOMETRY_CACHE_SIZE', 256, int)
+
+# SQLite file of jobs submitted to /jobs, their progress and results, which
+# every worker process polls.  Jobs run on JOB_WORKERS threads of the worker
+# which accepted them, and finished jobs are deleted after JOB_RESULT_TTL
+# seconds.  Without a store, jobs are only kept in the memory of the process
+# which accepted them.
+JOB_STORE_PATH = env('JOB_STORE_PATH', '/usr/data/jobs.sqlite')
+JOB_WORKERS = env('JOB_WORKERS', 2, int)
+JOB_RESULT_TTL = env('JOB_RESULT_TTL', 86400, int)
+
+# Results of /counts, /pair-counts and /stats requests are kept in an
+# in-memory cache of RESULT_CACHE_SIZE results for RESULT_CACHE_TTL seconds,
+# keyed by their rasters, geometry and modifications.  0 disables the cache.
+RESULT_CACHE_SIZE = env('RESULT_CACHE_SIZE', 1024, int)
+RESULT_CACHE_TTL = env('RESULT_CACHE_TTL', 300, int)
+
+# Windows of polygons larger than 2 x 2 blocks of MASK_BLOCK_SIZE cells are
+# split into blocks inside, outside and on the boundary of the polygon.
+# Blocks outside aren't read and only boundary blocks are masked.  0 reads
+# and masks the whole window.
+MASK_BLOCK_SIZE = env('MASK_BLOCK_SIZE', 256, int)
+
+# Reads are planned before they're made.  Analyses which would need more
+# than PLAN_MEMORY_MB of memory are streamed through in strips of about
+# PLAN_STRIP_MB, or read at a lower resolution when approximate results are
+# allowed.  Requests which would read more than PLAN_MAX_READ_MB of cells,
+# or which can't be streamed and won't fit in memory, are refused.  0 lifts
+# a limit.
+PLAN_MEMORY_MB = env('PLAN_MEMORY_MB', 1024, int)
+PLAN_STRIP_MB = env('PLAN_STRIP_MB', 64, int)
+PLAN_MAX_READ_MB = env('PLAN_MAX_READ_MB', 16384, int)
+
+# Directory of block histogram indexes of categorical rasters built by
+# `histogram_index.py`.  Counts of rasters with an index only read the blocks
+# on the boundary of polygons whose bounding box covers at least
+# HISTOGRAM_MIN_CELLS cells.  Rasters which aren't tiled are indexed in
+# blocks of HISTOGRAM_BLOCK_SIZE cells.  Approximate counts use the coarsest
+# level of the pyramid whose blocks still span HISTOGRAM_APPROXIMATE_BLOCKS
+# across the polygon.
+HISTOGRAM_INDEX_PATH = env('HISTOGRAM_INDEX_PATH', '/usr/data/histograms')
+HISTOGRAM_MIN_CELLS = env('HISTOGRAM_MIN_CELLS', 1000000, int)
+HISTOGRAM_BLOCK_SIZE = env('HISTOGRAM_BLOCK_SIZE', 256, int)
+HISTOGRAM_APPROXIMATE_BLOCKS = env('HISTOGRAM_APPROXIMATE_BLOCKS', 32, int)
+
+# Layers which can be rendered as tiles.  Rasters must be in EPSG:3857.
+# `palette` overrides a ColorTable in the raster, `nodata` is the cell
+# value rendered as transparent.
+TILE_LAYERS = {
+    'nlcd': {
+        'path': '/usr/data/nlcd/nlcd_webm_512.tif',
+        'palette': None,
+        'nodata': 0,
+    },
+    'nlcd_s3': {
+        'path': 's3://simple-raster-processing/nlcd_webm_512.tif',
+        'palette': None,
+        'nodata': 0,
+    },
+    'soil': {
+        'path': '/usr/data/hydro_soils_webm_512.tif',
+        'palette': [255,255,255, 255,255,212, 254,227,145, 204,76,2, 140,45,4, 254,196,79, 254,153,41, 236,112,20],  # noqa
+        'nodata': 255,
+    },
+}
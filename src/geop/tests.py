@@ -1,17 +1,57 @@
 from __future__ import division
 
+import base64
+import importlib
 import json
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import cache
 import geoprocessing
 import elevation_extraction
+import encoding
+import geometry_store
 import geo_utils
+import histogram_index
+import jobs
+import loadtest
+import main
+import memmap_io
+import planner
+import precompute
+import preload
+import raster_io
+import result_cache
+import scenario_store
+import seed
+import tile_store
+import tiles
+import zonal_store
 import numpy as np
+import rasterio
 
+from argparse import Namespace
+from collections import Counter
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 from copy import copy
+from io import BytesIO
+from multiprocessing import Process
+from errors import RequestTooLargeError, UserInputError
+from PIL import Image
 from shapely import wkt
-from shapely.geometry import mapping, Point, Polygon, shape
+from shapely.geometry import (mapping, LineString, MultiPolygon, Point,
+                               Polygon, shape)
 from shapely.geometry.geo import box
+from werkzeug.serving import WSGIRequestHandler, make_server
 
+TEST_DATA = '../test_data'
 NLCD_PATH = '../test_data/philly_nlcd.tif'
 NLCD_EDIT_PATH = '../test_data/philly_nlcd_edited.tif'
 NLCD_ONES = '../test_data/philly_ones.tif'      # all cells are 1
@@ -19,6 +59,10 @@ NLCD_THREES = '../test_data/philly_threes.tif'  # all cells are 3
 NLCD_LARGE = '../test_data/nlcd_large.tif'
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    pass
+
+
 class CountTests(unittest.TestCase):
     count_geom = Polygon([
         [1747260.99651947943493724, 2071928.23170474520884454],
@@ -86,6 +130,72 @@ class CountTests(unittest.TestCase):
         self.assertDictEqual(pairs, expectedPairs)
 
 
+class StackTests(unittest.TestCase):
+    geom = Polygon([
+        [1747247.00531901302747428, 2071931.02994483849033713],
+        [1747248.4044390597846359, 2071849.88098213309422135],
+        [1747333.05120188184082508, 2071848.48186208633705974],
+        [1747333.05120188184082508, 2071931.02994483849033713],
+        [1747247.00531901302747428, 2071931.02994483849033713]])
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'stack.tif')
+
+        # The two rasters as bands of one raster
+        with rasterio.open(NLCD_PATH) as src:
+            profile = src.profile
+            profile.update(count=2)
+            with rasterio.open(self.path, 'w', **profile) as dst:
+                dst.write(src.read(1), 1)
+                with rasterio.open(NLCD_EDIT_PATH) as edited:
+                    dst.write(edited.read(1), 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_band_counts(self):
+        """
+        Test that each band of a stack is counted like a single raster
+        """
+        expected = [geoprocessing.count(self.geom, path)
+                    for path in (NLCD_PATH, NLCD_EDIT_PATH)]
+
+        for rasters in ([NLCD_PATH, NLCD_EDIT_PATH], [self.path]):
+            self.assertEqual(geoprocessing.count_bands(self.geom, rasters),
+                             expected)
+
+    def test_change_matrix(self):
+        """
+        Test that changes between bands are the pairs of the two rasters
+        """
+        expected = geoprocessing.count_pairs(self.geom,
+                                             [NLCD_PATH, NLCD_EDIT_PATH])
+
+        for rasters in ([NLCD_PATH, NLCD_EDIT_PATH], [self.path]):
+            self.assertEqual(geoprocessing.change_matrix(self.geom, rasters),
+                             [expected])
+
+    def test_stack_statistics(self):
+        """
+        Test the statistics of each band of a stack
+        """
+        expected = [geoprocessing.statistics(self.geom, path, 'mean')
+                    for path in (NLCD_PATH, NLCD_EDIT_PATH)]
+        values = geoprocessing.stack_statistics(self.geom, [self.path], 'mean')
+
+        self.assertEqual(len(values), 2)
+        for value, expected_value in zip(values, expected):
+            self.assertAlmostEqual(value, expected_value)
+
+    def test_unaligned(self):
+        """
+        Test that rasters on different grids can't be stacked
+        """
+        with self.assertRaises(UserInputError):
+            geoprocessing.count_bands(self.geom, [NLCD_PATH, NLCD_LARGE])
+
+
 class SamplingTests(unittest.TestCase):
     def test_xy(self):
         """
@@ -140,6 +250,43 @@ class FeatureTests(unittest.TestCase):
         elevation_extraction.process_increments(geom, pa_dem)
 
 
+class IncrementTests(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.patched = (elevation_extraction.extract_between,
+                        elevation_extraction.POLL_SECONDS)
+        elevation_extraction.POLL_SECONDS = 0.05
+
+    def tearDown(self):
+        (elevation_extraction.extract_between,
+         elevation_extraction.POLL_SECONDS) = self.patched
+        shutil.rmtree(self.out_dir)
+
+    def test_increments(self):
+        """
+        Test that the area of each increment of elevation is saved
+        """
+        paths = elevation_extraction.process_increments(
+            CountTests.count_geom, NLCD_ONES, self.out_dir)
+
+        self.assertEqual(len(paths), 1)
+        with open(paths[0]) as f:
+            self.assertEqual(json.load(f)['type'], 'MultiPolygon')
+
+    def test_failed_process(self):
+        """
+        Test that extraction fails, rather than waiting forever, when a
+        process extracting increments exits without saving them
+        """
+        def exit(*args):
+            os._exit(1)
+
+        elevation_extraction.extract_between = exit
+        with self.assertRaises(RuntimeError):
+            elevation_extraction.process_increments(
+                CountTests.count_geom, NLCD_ONES, self.out_dir)
+
+
 class WeightedOverlayTests(unittest.TestCase):
     def test_weighted_overlay(self):
         """
@@ -264,6 +411,38 @@ class StatisticsTests(unittest.TestCase):
         self.assertRaises(Exception, geoprocessing.statistics,
                           self.stats_geom, NLCD_PATH, 'foo')
 
+    def test_no_valid_cells(self):
+        """
+        Test that there is no statistic of a polygon over only nodata cells,
+        read in memory or streamed
+        """
+        root = tempfile.mkdtemp()
+        limits = (planner.settings.PLAN_MEMORY_MB,
+                  planner.settings.PLAN_STRIP_MB)
+        try:
+            raster = os.path.join(root, 'nodata.tif')
+            with rasterio.open(NLCD_PATH) as src:
+                profile = src.profile
+            with rasterio.open(raster, 'w', **profile) as dst:
+                dst.write(np.zeros((1, profile['height'], profile['width']),
+                                   dtype=profile['dtype']))
+
+            for stat in ('min', 'max', 'mean', 'stddev'):
+                self.assertIsNone(
+                    geoprocessing.statistics(self.stats_geom, raster, stat))
+
+            planner.settings.PLAN_MEMORY_MB = 0.000001
+            planner.settings.PLAN_STRIP_MB = 0.0000001
+            self.assertEqual(planner.plan(self.stats_geom, [raster]).mode,
+                             planner.STREAM)
+            for stat in ('min', 'max', 'mean', 'stddev'):
+                self.assertIsNone(
+                    geoprocessing.statistics(self.stats_geom, raster, stat))
+        finally:
+            (planner.settings.PLAN_MEMORY_MB,
+             planner.settings.PLAN_STRIP_MB) = limits
+            shutil.rmtree(root)
+
 
 class ImageTests(unittest.TestCase):
     def test_decimated_read(self):
@@ -298,6 +477,1665 @@ class ImageTests(unittest.TestCase):
         self.assertItemsEqual(palette[765:768], colormap[255][0:3])
 
 
+class TileEncodingTests(unittest.TestCase):
+    tile = np.repeat(np.arange(16, dtype=np.uint8), 16 * 256).reshape(256, 256)
+
+    def test_palette_reuse(self):
+        """
+        Test that a palette list is packed once and reused
+        """
+        colors = [255, 255, 255, 0, 104, 55]
+        palette = tiles.make_palette(colors)
+
+        self.assertEqual(len(palette), 6)
+        self.assertIs(tiles.make_palette(list(colors)), palette)
+        self.assertIs(tiles.make_palette(palette), palette)
+
+    def test_png_transparency(self):
+        """
+        Test that a nodata value is written as a transparent palette index
+        """
+        palette = [val for idx in range(16) for val in (idx, idx, idx)]
+        img_data = tiles.render_tile_from_data(self.tile, palette, 'png', 0)
+
+        img = Image.open(img_data)
+        self.assertEqual(img.format, 'PNG')
+        self.assertEqual(img.mode, 'P')
+        self.assertEqual(img.info['transparency'], 0)
+
+    def test_unsupported_format(self):
+        """
+        Test that an unknown image format is rejected
+        """
+        self.assertRaises(UserInputError, tiles.render_tile_from_data,
+                          self.tile, [], 'gif')
+
+
+class MetatileTests(unittest.TestCase):
+    def setUp(self):
+        tiles.TILE_CACHE.clear()
+
+    def test_metatile_bbox(self):
+        """
+        Test that a metatile covers exactly the tiles it contains
+        """
+        mx, my, size = geo_utils.metatile_origin(10, 301, 385, 4)
+        self.assertEqual((mx, my, size), (300, 384, 4))
+
+        bbox = geo_utils.metatile_to_bbox(10, mx, my, size)
+        upper_left = geo_utils.tile_to_bbox(10, 300, 384)
+        lower_right = geo_utils.tile_to_bbox(10, 303, 387)
+        self.assertAlmostEqual(bbox.bounds[0], upper_left.bounds[0])
+        self.assertAlmostEqual(bbox.bounds[3], upper_left.bounds[3])
+        self.assertAlmostEqual(bbox.bounds[1], lower_right.bounds[1])
+        self.assertAlmostEqual(bbox.bounds[2], lower_right.bounds[2])
+
+        # There are fewer tiles than a metatile at low zooms
+        self.assertEqual(geo_utils.metatile_origin(1, 1, 0, 4), (0, 0, 2))
+
+    def test_single_render(self):
+        """
+        Test that tiles of a rendered metatile are served from the cache
+        """
+        calls = []
+
+        def render(bbox, tile_size):
+            calls.append(tile_size)
+            data = np.arange(tile_size * tile_size) // tile_size % 256
+            return data.astype(np.uint8).reshape(tile_size, -1), None, None
+
+        for x in range(300, 304):
+            for y in range(384, 388):
+                img = tiles.get_tile('test', 10, x, y, 'png', render)
+                self.assertEqual(Image.open(img).size, (256, 256))
+
+        self.assertEqual(calls, [4 * 256])
+
+    def test_lru_eviction(self):
+        """
+        Test that the least recently used entry is evicted from the cache
+        """
+        lru = cache.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+
+
+class TileStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store_path = tile_store.settings.TILE_STORE_PATH
+        tile_store.settings.TILE_STORE_PATH = self.root
+
+    def tearDown(self):
+        tile_store.settings.TILE_STORE_PATH = self.store_path
+        shutil.rmtree(self.root)
+
+    def test_directory_store(self):
+        """
+        Test that a tile written to a directory store is served
+        """
+        tile_store.DirectoryStore(self.root).put('nlcd', 3, 2, 1, 'png', b'a')
+
+        self.assertEqual(tile_store.get_tile('nlcd', 3, 2, 1, 'png'), b'a')
+        self.assertIsNone(tile_store.get_tile('nlcd', 3, 2, 2, 'png'))
+        self.assertIsNone(tile_store.get_tile('nlcd', 3, 2, 1, 'webp'))
+
+    def test_mbtiles_store(self):
+        """
+        Test that a tile written to an MBTiles file is served, with rows
+        stored in TMS order
+        """
+        path = tile_store.mbtiles_path(self.root, 'soil', 'png')
+        mbtiles = tile_store.MBTilesStore(path, create=True)
+        mbtiles.put(3, 2, 1, b'b')
+        mbtiles.commit()
+
+        row = mbtiles.conn.execute('SELECT tile_row FROM tiles').fetchone()
+        self.assertEqual(row[0], 6)
+        mbtiles.close()
+
+        self.assertEqual(tile_store.get_tile('soil', 3, 2, 1, 'png'), b'b')
+        self.assertIsNone(tile_store.get_tile('soil', 3, 2, 2, 'png'))
+
+    def test_rendered_tiles(self):
+        """
+        Test that tiles rendered by the process aren't looked up in the
+        store again once they have left the tile cache
+        """
+        probes = []
+        directory_get = tile_store.DirectoryStore.get
+
+        def get(store, *key):
+            probes.append(key)
+            return directory_get(store, *key)
+
+        def render(bbox, tile_size):
+            return np.zeros((tile_size, tile_size), np.uint8), None, None
+
+        tiles.TILE_CACHE.clear()
+        tile_store.RENDERED.clear()
+        tile_store.DirectoryStore.get = get
+        try:
+            tiles.get_tile('test', 10, 300, 384, 'png', render)
+            self.assertEqual(len(probes), 1)
+
+            tiles.TILE_CACHE.clear()
+            tiles.get_tile('test', 10, 301, 385, 'png', render)
+            self.assertEqual(len(probes), 1)
+        finally:
+            tile_store.DirectoryStore.get = directory_get
+            tile_store.RENDERED.clear()
+
+    def test_seed_tile_range(self):
+        """
+        Test that a bounding box is covered by the tiles it intersects
+        """
+        bbox = (-75.3, 39.8, -74.9, 40.1)
+        tiles_z10 = list(seed.tile_range(bbox, 10, 10))
+        self.assertEqual(tiles_z10, [(10, 297, 387), (10, 297, 388),
+                                     (10, 298, 387), (10, 298, 388)])
+
+        for zoom, x, y in tiles_z10:
+            west, south, east, north = geo_utils.reproject(
+                geo_utils.tile_to_bbox(zoom, x, y),
+                'epsg:4326', 'epsg:3857').bounds
+            self.assertTrue(west < bbox[2] and east > bbox[0])
+            self.assertTrue(south < bbox[3] and north > bbox[1])
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files from the test data directory with support for byte range
+    requests, standing in for an object store
+    """
+    def send_head(self):
+        path = os.path.join(TEST_DATA, os.path.basename(self.path))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        return BytesIO(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class RemoteReadTests(unittest.TestCase):
+    count_geom = CountTests.count_geom
+
+    @classmethod
+    def setUpClass(cls):
+        # GDAL holds the GIL for some requests, so the server runs in its own
+        # process rather than a thread
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        server.daemon_threads = True
+        cls.server = Process(target=server.serve_forever)
+        cls.server.daemon = True
+        cls.server.start()
+        server.server_close()
+        cls.url = 'http://127.0.0.1:{}/philly_nlcd.tif'.format(
+            server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+
+    def test_remote_count(self):
+        """
+        Test that a range read over http on the I/O pool matches a local read
+        """
+        _, remote_counts = geoprocessing.count(self.count_geom, self.url)
+        _, local_counts = geoprocessing.count(self.count_geom, NLCD_PATH)
+
+        self.assertDictEqual(remote_counts, local_counts)
+
+    def test_cached_result(self):
+        """
+        Test that results over remote rasters are cached, without a version
+        from the local file system
+        """
+        result_cache.RESULTS.clear()
+        user_input = {
+            'raster_paths': [self.url],
+            'query_polygon': self.count_geom,
+            'query_line': None,
+            'mods': None,
+            'approximate': False,
+        }
+
+        def compute():
+            return {'counts': geoprocessing.count(self.count_geom,
+                                                  self.url)[1]}
+
+        result, status = result_cache.memoize('counts', user_input, compute)
+        self.assertEqual(status, 'miss')
+
+        cached, status = result_cache.memoize('counts', user_input, compute)
+        self.assertEqual(status, 'hit')
+        self.assertEqual(cached, result)
+
+    def test_coalesced_reads(self):
+        """
+        Test that identical concurrent reads share one read, and each caller
+        gets its own copy of the data
+        """
+        started = threading.Event()
+        calls = []
+
+        def reader(src):
+            calls.append(1)
+            started.wait(5)
+            return src.read(1, window=((0, 2), (0, 2)))
+
+        results = []
+
+        def read():
+            results.append(raster_io.read(self.url, reader, key='corner'))
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        started.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(set(id(result) for result in results)), 4)
+
+    def test_coalesced_windows(self):
+        """
+        Test that concurrent analyses of the same window share its read, and
+        modifications burned into one caller's window aren't seen by another
+        """
+        mods = [{'geom': self.count_geom.buffer(100), 'newValue': 42}]
+        raster_io.info(self.url)
+
+        calls = []
+        open_and_read = raster_io.open_and_read
+
+        def slow_open_and_read(raster_path, reader):
+            calls.append(1)
+            time.sleep(0.5)
+            return open_and_read(raster_path, reader)
+
+        results = {}
+
+        def count(name, modifications):
+            results[name] = geoprocessing.count(self.count_geom, self.url,
+                                                modifications)
+
+        threads = [threading.Thread(target=count, args=('modified', mods)),
+                   threading.Thread(target=count, args=('original', None))]
+        raster_io.open_and_read = slow_open_and_read
+        try:
+            for thread in threads:
+                thread.start()
+                time.sleep(0.1)
+            for thread in threads:
+                thread.join()
+        finally:
+            raster_io.open_and_read = open_and_read
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results['original'],
+                         geoprocessing.count(self.count_geom, NLCD_PATH))
+        self.assertEqual(results['modified'], (6, {'42': 6}))
+
+    def test_read_stats(self):
+        """
+        Test that the ranges and bytes fetched by a remote read are counted
+        """
+        # A raster which no other test reads, so nothing is in the VSI cache
+        url = self.url.replace('philly_nlcd', 'philly_nlcd_edited')
+        stats = raster_io.reset_request_stats()
+
+        io_stats = raster_io.settings.IO_STATS
+        raster_io.settings.IO_STATS = True
+        raster_io.install_download_counter()
+        try:
+            geoprocessing.count(self.count_geom, url)
+        finally:
+            raster_io.settings.IO_STATS = io_stats
+
+        self.assertEqual(stats.reads, 1)
+        self.assertGreater(stats.ranges, 0)
+        self.assertEqual(stats.bytes, os.path.getsize(NLCD_EDIT_PATH))
+
+
+class MaskDecompositionTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'nlcd_tiled.tif')
+        self.block_size = geo_utils.settings.MASK_BLOCK_SIZE
+
+        with rasterio.open(NLCD_LARGE) as src:
+            profile = src.profile
+            profile.update(tiled=True, blockxsize=64, blockysize=64)
+            with rasterio.open(self.path, 'w', **profile) as dst:
+                dst.write(src.read())
+
+            left, bottom, right, top = src.bounds
+
+        width, height = right - left, top - bottom
+        self.skinny = LineString([
+            (left + width * 0.1, bottom + height * 0.1),
+            (left + width * 0.9, bottom + height * 0.8),
+        ]).buffer(300)
+        self.multi = MultiPolygon([
+            Point(left + width * 0.2, top - height * 0.2).buffer(2000),
+            Point(right - width * 0.2, bottom + height * 0.2).buffer(3000),
+        ])
+
+    def tearDown(self):
+        geo_utils.settings.MASK_BLOCK_SIZE = self.block_size
+        shutil.rmtree(self.root)
+
+    def mask(self, geom, block_size):
+        geo_utils.settings.MASK_BLOCK_SIZE = block_size
+        return geo_utils.mask_geom_on_raster(geom, self.path)[0]
+
+    def test_classify_window(self):
+        """
+        Test that blocks outside of a polygon are dropped
+        """
+        with rasterio.open(self.path) as src:
+            window, _ = geo_utils.get_window_and_affine(self.skinny, src)
+            geo_utils.settings.MASK_BLOCK_SIZE = 64
+            inside, boundary = geo_utils.classify_window(self.skinny, window,
+                                                         src)
+
+        (row_start, row_stop), (col_start, col_stop) = window
+        window_cells = (row_stop - row_start) * (col_stop - col_start)
+        read_cells = sum((rows[1] - rows[0]) * (cols[1] - cols[0])
+                         for rows, cols in inside + boundary)
+
+        self.assertGreater(len(boundary), 0)
+        self.assertLess(read_cells, window_cells / 2)
+
+    def test_same_mask(self):
+        """
+        Test that masking only the boundary blocks gives the same mask and
+        values as masking the whole window
+        """
+        for geom in (self.skinny, self.multi):
+            expected = self.mask(geom, 0)
+            masked = self.mask(geom, 64)
+
+            self.assertTrue(np.array_equal(masked.mask, expected.mask))
+            self.assertTrue(np.array_equal(masked.compressed(),
+                                           expected.compressed()))
+
+
+class GeomValuesTests(unittest.TestCase):
+    def setUp(self):
+        with rasterio.open(NLCD_LARGE) as src:
+            self.geom = box(*src.bounds).centroid.buffer(5000)
+
+        self.layer, _ = geo_utils.mask_geom_on_raster(self.geom, NLCD_LARGE)
+
+    def test_geom_values(self):
+        """
+        Test that the values gathered for a geometry are the unmasked cells
+        of its masked window
+        """
+        values = geo_utils.geom_values(self.geom, NLCD_LARGE)
+
+        self.assertEqual(values.ndim, 1)
+        self.assertTrue(np.array_equal(values, self.layer.compressed()))
+
+    def test_count_values(self):
+        """
+        Test that integer and float values are counted alike
+        """
+        values = self.layer.compressed()
+        total, counts = geoprocessing.count_values(values)
+        float_total, float_counts = geoprocessing.count_values(
+            values.astype(np.float32))
+
+        self.assertEqual(total, float_total)
+        self.assertEqual(counts, {str(int(float(value))): count
+                                  for value, count in float_counts.items()})
+
+    def test_pair_values(self):
+        """
+        Test that pairs of values are counted from 1-D arrays as from masked
+        arrays
+        """
+        values = self.layer.compressed()[:5000]
+        shifted = np.roll(values, 1)
+        pairs = geoprocessing.count_pairs_from_values([values, shifted])
+
+        expected = Counter('{}::{}'.format(a, b)
+                           for a, b in zip(values, shifted))
+        self.assertEqual(pairs, dict(expected))
+
+
+class NodataTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'nlcd_sparse.tif')
+        self.block_size = geo_utils.settings.MASK_BLOCK_SIZE
+
+        # A sparse copy of NLCD_LARGE with a corner of nodata, whose empty
+        # tiles aren't written
+        with rasterio.open(NLCD_LARGE) as src:
+            profile = src.profile
+            profile.update(tiled=True, blockxsize=64, blockysize=64,
+                           SPARSE_OK=True)
+            self.data = src.read(1)
+            self.data[:320, :320] = src.nodata
+            with rasterio.open(self.path, 'w', **profile) as dst:
+                dst.write(self.data, 1)
+
+            left, bottom, right, top = src.bounds
+            self.geom = box(left, top - 9000, left + 15000, top - 3000)
+
+        geo_utils.settings.MASK_BLOCK_SIZE = 64
+        self.window_values = geo_utils.mask_geom_on_raster(
+            self.geom, NLCD_LARGE)[0].compressed()
+
+    def tearDown(self):
+        geo_utils.settings.MASK_BLOCK_SIZE = self.block_size
+        shutil.rmtree(self.root)
+
+    def test_sparse_region(self):
+        """
+        Test that regions of tiles which aren't in the file are found
+        """
+        with rasterio.open(self.path) as src:
+            self.assertTrue(geo_utils.sparse_region(src, ((0, 128),
+                                                          (0, 128))))
+            self.assertFalse(geo_utils.sparse_region(src, ((0, 128),
+                                                           (256, 384))))
+
+    def test_nodata_excluded(self):
+        """
+        Test that nodata cells are excluded from counts, pairs and stats
+        """
+        layer = geo_utils.mask_geom_on_raster(self.geom, self.path)[0]
+        expected = layer.compressed()
+        self.assertLess(expected.size, self.window_values.size)
+        self.assertNotIn(0, expected)
+
+        total, counts = geoprocessing.count(self.geom, self.path)
+        self.assertEqual(total, expected.size)
+        self.assertNotIn('0', counts)
+
+        pairs = geoprocessing.count_pairs(self.geom, [self.path, NLCD_LARGE])
+        self.assertEqual(sum(pairs.values()), expected.size)
+
+        self.assertAlmostEqual(
+            geoprocessing.statistics(self.geom, self.path, 'mean'),
+            expected.mean())
+
+
+class MultiPartTests(unittest.TestCase):
+    def setUp(self):
+        with rasterio.open(NLCD_LARGE) as src:
+            left, bottom, right, top = src.bounds
+
+        width, height = right - left, top - bottom
+        self.multi = MultiPolygon([
+            Point(left + width * 0.1, top - height * 0.1).buffer(1000),
+            Point(left + width * 0.15, top - height * 0.15).buffer(1000),
+            Point(right - width * 0.1, bottom + height * 0.1).buffer(1500),
+        ])
+
+    def test_cluster_parts(self):
+        """
+        Test that parts far apart are split into clusters, and parts close
+        together are kept together
+        """
+        with rasterio.open(NLCD_LARGE) as src:
+            clusters = geo_utils.cluster_parts(self.multi, src)
+            windows = [geo_utils.get_window_and_affine(cluster, src)[0]
+                       for cluster in clusters]
+            whole, _ = geo_utils.get_window_and_affine(self.multi, src)
+
+        self.assertEqual(sorted(len(getattr(cluster, 'geoms', [cluster]))
+                                for cluster in clusters), [1, 2])
+        self.assertFalse(geo_utils.windows_overlap(*windows))
+        self.assertLess(sum(geo_utils.window_cells(window)
+                            for window in windows),
+                        geo_utils.window_cells(whole) / 10)
+
+    def test_same_results(self):
+        """
+        Test that analyses over clusters of parts match those over the
+        whole window of the geometry
+        """
+        layer, _ = geo_utils.mask_geom_on_raster(self.multi, NLCD_LARGE)
+
+        self.assertEqual(geoprocessing.count(self.multi, NLCD_LARGE),
+                         geoprocessing.masked_array_count(layer))
+        self.assertEqual(
+            geoprocessing.count_pairs(self.multi, [NLCD_LARGE] * 2),
+            geoprocessing.count_pairs_from_values([layer.compressed()] * 2))
+        self.assertAlmostEqual(
+            geoprocessing.statistics(self.multi, NLCD_LARGE, 'mean'),
+            geoprocessing.statistics_from_data(layer, 'mean'))
+
+
+class MemmapTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tiled = os.path.join(self.root, 'nlcd_tiled.tif')
+        self.envi = os.path.join(self.root, 'nlcd.img')
+        self.compressed = os.path.join(self.root, 'nlcd_deflate.tif')
+
+        with rasterio.open(NLCD_LARGE) as src:
+            self.data = src.read(1)
+            profile = src.profile
+            self.geom = box(*src.bounds).centroid.buffer(5000)
+
+        for path, options in ((self.tiled, {'tiled': True, 'blockxsize': 64,
+                                            'blockysize': 64}),
+                              (self.envi, {'driver': 'ENVI'}),
+                              (self.compressed, {'compress': 'deflate'})):
+            with rasterio.open(path, 'w', **dict(profile, **options)) as dst:
+                dst.write(self.data, 1)
+
+        memmap_io.BANDS.clear()
+        memmap_io.settings.IO_MMAP = True
+
+    def tearDown(self):
+        memmap_io.settings.IO_MMAP = False
+        memmap_io.BANDS.clear()
+        shutil.rmtree(self.root)
+
+    def test_mapped(self):
+        """
+        Test that uncompressed rasters are mapped, and windows of them read
+        as GDAL reads them
+        """
+        windows = [((0, 872), (0, 943)), ((100, 133), (250, 700)),
+                   ((63, 65), (63, 65))]
+
+        for path in (NLCD_LARGE, self.tiled, self.envi):
+            with rasterio.open(path) as src:
+                self.assertIsNotNone(memmap_io.get_band(src))
+                for window in windows:
+                    self.assertTrue(np.array_equal(
+                        memmap_io.read(src, window),
+                        src.read(1, window=window)))
+                    self.assertTrue(np.array_equal(
+                        memmap_io.read(src, window, out_shape=(1, 64, 64)),
+                        src.read(1, window=window, out_shape=(1, 64, 64))))
+
+        with rasterio.open(self.compressed) as src:
+            self.assertIsNone(memmap_io.get_band(src))
+
+    def test_zero_copy(self):
+        """
+        Test that windows of striped rasters are read-only views of the map,
+        which modifications don't change
+        """
+        with rasterio.open(NLCD_LARGE) as src:
+            window = memmap_io.read(src, ((100, 200), (100, 200)))
+        self.assertIsInstance(window.base, np.memmap)
+        self.assertFalse(window.flags.writeable)
+
+        expected = geoprocessing.count(self.geom, NLCD_LARGE)
+        mods = [{'geom': self.geom.buffer(-2000), 'newValue': 1}]
+        self.assertNotEqual(geoprocessing.count(self.geom, NLCD_LARGE, mods),
+                            expected)
+        self.assertEqual(geoprocessing.count(self.geom, NLCD_LARGE), expected)
+
+
+class PreloadTests(unittest.TestCase):
+    def setUp(self):
+        memmap_io.BANDS.clear()
+        with rasterio.open(NLCD_LARGE) as src:
+            self.data = src.read(1)
+            self.geom = box(*src.bounds).centroid.buffer(5000)
+
+    def tearDown(self):
+        memmap_io.BANDS.clear()
+
+    def test_parse_layers(self):
+        """
+        Test that tile layers, raster names and overview factors are parsed
+        """
+        self.assertEqual(preload.parse_layers('nlcd, soil@4,'), [
+            (preload.settings.TILE_LAYERS['nlcd']['path'], 1),
+            (preload.settings.TILE_LAYERS['soil']['path'], 4),
+        ])
+
+    def test_preloaded(self):
+        """
+        Test that a preloaded layer is read-only shared memory, which
+        analyses read the same cells from
+        """
+        expected = geoprocessing.count(self.geom, NLCD_LARGE)
+        band = preload.preload_layer(NLCD_LARGE)
+
+        self.assertTrue(np.array_equal(band.rows(), self.data))
+        self.assertFalse(band.blocks.flags.writeable)
+        self.assertIsInstance(band.blocks.base.base, mmap.mmap)
+        self.assertEqual(geoprocessing.count(self.geom, NLCD_LARGE),
+                         expected)
+
+    def test_overview(self):
+        """
+        Test that an overview serves decimated reads, and full resolution
+        reads still read the raster
+        """
+        preload.preload_layer(NLCD_LARGE, factor=4)
+        window = ((0, 800), (0, 800))
+
+        with rasterio.open(NLCD_LARGE) as src:
+            self.assertTrue(np.array_equal(memmap_io.read(src, window),
+                                           src.read(1, window=window)))
+
+            decimated = memmap_io.read(src, window, out_shape=(1, 200, 200))
+            expected = src.read(1, window=window, out_shape=(1, 200, 200))
+
+        self.assertEqual(decimated.shape, (200, 200))
+        self.assertGreater((decimated == expected).mean(), 0.9)
+
+
+class ScenarioTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store_path = scenario_store.settings.SCENARIO_STORE_PATH
+        scenario_store.settings.SCENARIO_STORE_PATH = os.path.join(
+            self.root, 'scenarios.sqlite')
+        scenario_store.SCENARIOS.clear()
+        result_cache.RESULTS.clear()
+
+        with rasterio.open(NLCD_LARGE) as src:
+            center = box(*src.bounds).centroid
+
+        self.geom = center.buffer(5000)
+        self.mods = [
+            {'geom': center.buffer(2000), 'newValue': 42},
+            {'geom': Point(center.x + 1500, center.y).buffer(1000),
+             'newValue': 7},
+        ]
+
+    def tearDown(self):
+        for store in scenario_store.STORES.values():
+            store.close()
+        scenario_store.STORES.clear()
+        scenario_store.SCENARIOS.clear()
+        scenario_store.settings.SCENARIO_STORE_PATH = self.store_path
+        shutil.rmtree(self.root)
+
+    def test_same_results(self):
+        """
+        Test that analyses of a stored scenario match those of its
+        modifications
+        """
+        scenario = scenario_store.create_scenario(self.mods)
+        expected = geoprocessing.count(self.geom, NLCD_LARGE, self.mods)
+
+        self.assertIn('7', expected[1])
+        self.assertEqual(
+            geoprocessing.count(self.geom, NLCD_LARGE, scenario), expected)
+        self.assertEqual(
+            geoprocessing.count(self.geom.buffer(-3000), NLCD_LARGE,
+                                scenario),
+            geoprocessing.count(self.geom.buffer(-3000), NLCD_LARGE,
+                                self.mods))
+
+    def test_stored(self):
+        """
+        Test that a scenario and its rasterized cells are loaded from the
+        store without rasterizing its modifications again
+        """
+        scenario = scenario_store.create_scenario(self.mods)
+        expected = geoprocessing.count(self.geom, NLCD_LARGE, scenario)
+        scenario_store.SCENARIOS.clear()
+
+        rasterize_delta = scenario_store.rasterize_delta
+        scenario_store.rasterize_delta = None
+        try:
+            stored = scenario_store.get_scenario(scenario.id)
+            self.assertIsNot(stored, scenario)
+            self.assertEqual(
+                geoprocessing.count(self.geom, NLCD_LARGE, stored), expected)
+        finally:
+            scenario_store.rasterize_delta = rasterize_delta
+
+        self.assertIsNone(scenario_store.get_scenario('unknown'))
+
+    def test_endpoints(self):
+        """
+        Test that counts of a scenario by id match counts with its
+        modifications, and unknown scenarios are rejected
+        """
+        app = main.app.test_client()
+        polygon = mapping(geo_utils.reproject(self.geom, 'epsg:4326',
+                                              'epsg:5070'))
+        mods = [{'geom': mapping(geo_utils.reproject(
+            mod['geom'], 'epsg:4326', 'epsg:5070')),
+            'newValue': mod['newValue']} for mod in self.mods]
+
+        def post(url, body):
+            response = app.post(url, data=json.dumps(body),
+                                content_type='application/json')
+            return response, json.loads(response.data)
+
+        _, created = post('/scenarios', {
+            'modifications': mods, 'rasters': [os.path.abspath(NLCD_LARGE)]})
+        self.assertEqual(created['modifications'], 2)
+
+        body = {'rasters': [os.path.abspath(NLCD_LARGE)],
+                'queryPolygon': polygon}
+        _, expected = post('/counts', dict(body, modifications=mods))
+        _, result = post('/counts', dict(body,
+                                         scenarioId=created['scenarioId']))
+        self.assertEqual(result['counts'], expected['counts'])
+
+        response, _ = post('/counts', dict(body, scenarioId='unknown'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_query_srs(self):
+        """
+        Test that modifications are reprojected from `query_srs`, as the
+        query polygon is, in analyses and stored scenarios
+        """
+        app = main.app.test_client()
+        mods = [{'geom': mapping(mod['geom']), 'newValue': mod['newValue']}
+                for mod in self.mods]
+        body = {'rasters': [os.path.abspath(NLCD_LARGE)],
+                'queryPolygon': mapping(self.geom), 'query_srs': 'epsg:5070'}
+
+        def post(url, body):
+            return json.loads(app.post(url, data=json.dumps(body),
+                                       content_type='application/json').data)
+
+        total, counts = geoprocessing.count(self.geom, NLCD_LARGE, self.mods)
+        self.assertIn('42', counts)
+
+        result = post('/counts', dict(body, modifications=mods))
+        self.assertEqual(result['cellCount'], total)
+        self.assertEqual(result['counts'], counts)
+
+        created = post('/scenarios', {'modifications': mods,
+                                      'query_srs': 'epsg:5070'})
+        result = post('/counts', dict(body,
+                                      scenarioId=created['scenarioId']))
+        self.assertEqual(result['counts'], counts)
+
+
+class GeometryInputTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store_path = geometry_store.settings.GEOMETRY_STORE_PATH
+        geometry_store.settings.GEOMETRY_STORE_PATH = os.path.join(
+            self.root, 'geometries.sqlite')
+        geometry_store.GEOMETRIES.clear()
+        result_cache.RESULTS.clear()
+
+        self.app = main.app.test_client()
+        self.rasters = [os.path.abspath(NLCD_PATH)]
+        self.geom = CountTests.count_geom
+        self.wgs84 = geo_utils.reproject(self.geom, 'epsg:4326', 'epsg:5070')
+
+    def tearDown(self):
+        for store in geometry_store.STORES.values():
+            store.close()
+        geometry_store.STORES.clear()
+        geometry_store.GEOMETRIES.clear()
+        geometry_store.settings.GEOMETRY_STORE_PATH = self.store_path
+        shutil.rmtree(self.root)
+
+    def post(self, url, body):
+        response = self.app.post(url, data=json.dumps(body),
+                                 content_type='application/json')
+        return response.status_code, json.loads(response.data)
+
+    def post_wkb(self, url, geom, **args):
+        response = self.app.post(url, data=geom.wkb, query_string=args,
+                                 content_type='application/wkb')
+        return response.status_code, json.loads(response.data)
+
+    def test_wkb(self):
+        """
+        Test that counts of a polygon sent as WKB, in the body or base64
+        encoded, match counts of its GeoJSON
+        """
+        _, expected = self.post('/counts', {
+            'rasters': self.rasters, 'queryPolygon': mapping(self.wgs84)})
+        self.assertEqual(expected['cellCount'], 6)
+
+        _, result = self.post('/counts', {
+            'rasters': self.rasters,
+            'queryPolygonWkb': base64.b64encode(self.wgs84.wkb)})
+        self.assertEqual(result['counts'], expected['counts'])
+
+        _, result = self.post_wkb('/counts', self.geom,
+                                  rasters=','.join(self.rasters),
+                                  query_srs='epsg:5070')
+        self.assertEqual(result['counts'], expected['counts'])
+
+        status, _ = self.post('/counts', {
+            'rasters': self.rasters, 'queryPolygonWkb': 'AAAA'})
+        self.assertEqual(status, 400)
+
+    def test_cached(self):
+        """
+        Test that WKB is only parsed and prepared once
+        """
+        geom = geometry_store.from_wkb(self.geom.wkb, 'epsg:5070',
+                                       'epsg:5070')
+        self.assertTrue(geom.equals(self.geom))
+        self.assertIs(geo_utils.prepare(geom), geom.prepared)
+        self.assertIs(geometry_store.from_wkb(self.geom.wkb, 'epsg:5070',
+                                              'epsg:5070'), geom)
+
+    def test_registered(self):
+        """
+        Test that counts of a registered polygon by id match counts of its
+        GeoJSON, and unknown ids and other SRSs are rejected
+        """
+        _, registered = self.post_wkb('/geometries', self.geom,
+                                      query_srs='epsg:5070')
+        self.assertEqual(registered['srs'], 'epsg:5070')
+        geometry_store.GEOMETRIES.clear()
+
+        _, expected = self.post('/counts', {
+            'rasters': self.rasters, 'queryPolygon': mapping(self.wgs84)})
+        _, result = self.post('/counts', {
+            'rasters': self.rasters,
+            'queryGeometryId': registered['geometryId']})
+        self.assertEqual(result['counts'], expected['counts'])
+
+        status, _ = self.post('/counts', {
+            'rasters': self.rasters, 'queryGeometryId': 'unknown'})
+        self.assertEqual(status, 400)
+
+        status, _ = self.post('/counts', {
+            'rasters': self.rasters, 'src_srs': 'epsg:3857',
+            'queryGeometryId': registered['geometryId']})
+        self.assertEqual(status, 400)
+
+
+class PlannerTests(unittest.TestCase):
+    def setUp(self):
+        self.limits = (planner.settings.PLAN_MEMORY_MB,
+                       planner.settings.PLAN_STRIP_MB,
+                       planner.settings.PLAN_MAX_READ_MB)
+
+        with rasterio.open(NLCD_LARGE) as src:
+            self.geom = box(*src.bounds).centroid.buffer(5000)
+
+        self.layer, _ = geo_utils.mask_geom_on_raster(self.geom, NLCD_LARGE)
+
+    def tearDown(self):
+        (planner.settings.PLAN_MEMORY_MB, planner.settings.PLAN_STRIP_MB,
+         planner.settings.PLAN_MAX_READ_MB) = self.limits
+
+    def test_memory(self):
+        """
+        Test that polygons within the limits are read in memory
+        """
+        run = planner.plan(self.geom, [NLCD_LARGE, NLCD_LARGE])
+
+        self.assertEqual(run.mode, planner.MEMORY)
+        self.assertEqual(sum(est.window_cells for est in run.estimates),
+                         2 * self.layer.size)
+
+    def test_streamed(self):
+        """
+        Test that analyses streamed in strips match those read in memory
+        """
+        planner.settings.PLAN_MEMORY_MB = 0.1
+        planner.settings.PLAN_STRIP_MB = 0.05
+
+        run = planner.plan(self.geom, [NLCD_LARGE])
+        self.assertEqual(run.mode, planner.STREAM)
+        self.assertLess(run.strip_rows, self.layer.shape[0] / 10)
+
+        self.assertEqual(geoprocessing.count(self.geom, NLCD_LARGE),
+                         geoprocessing.masked_array_count(self.layer))
+        self.assertEqual(
+            geoprocessing.count_pairs(self.geom, [NLCD_LARGE] * 2),
+            geoprocessing.count_pairs_from_values(
+                [self.layer.compressed()] * 2))
+
+        for stat in ('min', 'max', 'mean', 'stddev'):
+            self.assertAlmostEqual(
+                geoprocessing.statistics(self.geom, NLCD_LARGE, stat),
+                geoprocessing.statistics_from_data(self.layer, stat))
+
+    def test_decimated(self):
+        """
+        Test that approximate counts too large for memory are read at a
+        lower resolution and scaled up
+        """
+        planner.settings.PLAN_MEMORY_MB = 0.1
+
+        run = planner.plan(self.geom, [NLCD_LARGE], approximate=True)
+        self.assertEqual(run.mode, planner.DECIMATE)
+        self.assertGreater(run.factor, 1)
+
+        total, _ = geoprocessing.count(self.geom, NLCD_LARGE,
+                                       approximate=True)
+        self.assertAlmostEqual(total / self.layer.count(), 1, delta=0.05)
+
+    def test_raster_edge(self):
+        """
+        Test that cells beyond the edge of the raster are neither read nor
+        counted by streamed and decimated reads
+        """
+        with rasterio.open(NLCD_LARGE) as src:
+            right, y = src.bounds.right, box(*src.bounds).centroid.y
+        geom = box(right - 5000, y - 5000, right + 5000, y + 5000)
+        expected = geoprocessing.count(geom, NLCD_LARGE)
+
+        planner.settings.PLAN_MEMORY_MB = 0.01
+        planner.settings.PLAN_STRIP_MB = 0.005
+        self.assertEqual(planner.plan(geom, [NLCD_LARGE]).mode,
+                         planner.STREAM)
+        self.assertEqual(geoprocessing.count(geom, NLCD_LARGE), expected)
+
+        run = planner.plan(geom, [NLCD_LARGE], approximate=True)
+        self.assertEqual(run.mode, planner.DECIMATE)
+        total, _ = geoprocessing.count(geom, NLCD_LARGE, approximate=True)
+        self.assertAlmostEqual(total / expected[0], 1, delta=0.05)
+
+    def test_too_large(self):
+        """
+        Test that requests over the read limit, or which can't be streamed
+        and won't fit in memory, are refused with a 413
+        """
+        planner.settings.PLAN_MAX_READ_MB = 0.1
+        with self.assertRaises(RequestTooLargeError) as raised:
+            geoprocessing.count(self.geom, NLCD_LARGE)
+        self.assertEqual(raised.exception.status_code, 413)
+
+        planner.settings.PLAN_MAX_READ_MB = 0
+        planner.settings.PLAN_MEMORY_MB = 0.1
+        with self.assertRaises(RequestTooLargeError):
+            geoprocessing.reclassify(self.geom, NLCD_LARGE, [[11, 1]])
+
+        planner.settings.PLAN_MAX_READ_MB = 0.000001
+        result_cache.RESULTS.clear()
+        response = main.app.test_client().post(
+            '/stats/mean', content_type='application/json', data=json.dumps({
+                'rasters': [os.path.abspath(NLCD_PATH)],
+                'queryPolygon': mapping(geo_utils.reproject(
+                    CountTests.count_geom, 'epsg:4326', 'epsg:5070')),
+            }))
+        self.assertEqual(response.status_code, 413)
+
+
+class JobTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store_path = jobs.settings.JOB_STORE_PATH
+        jobs.settings.JOB_STORE_PATH = os.path.join(self.root, 'jobs.sqlite')
+        self.limits = (planner.settings.PLAN_MEMORY_MB,
+                       planner.settings.PLAN_STRIP_MB)
+        result_cache.RESULTS.clear()
+
+        self.app = main.app.test_client()
+        with rasterio.open(NLCD_LARGE) as src:
+            geom = box(*src.bounds).centroid.buffer(5000)
+        self.body = {
+            'rasters': [os.path.abspath(NLCD_LARGE)],
+            'queryPolygon': mapping(geo_utils.reproject(geom, 'epsg:4326',
+                                                        'epsg:5070')),
+        }
+
+    def tearDown(self):
+        for store in jobs.STORES.values():
+            store.close()
+        jobs.STORES.clear()
+        jobs.settings.JOB_STORE_PATH = self.store_path
+        (planner.settings.PLAN_MEMORY_MB,
+         planner.settings.PLAN_STRIP_MB) = self.limits
+        shutil.rmtree(self.root)
+
+    def request(self, method, url, body=None):
+        response = self.app.open(url, method=method, data=json.dumps(body),
+                                 content_type='application/json')
+        return response.status_code, json.loads(response.data)
+
+    def wait(self, job_id, status=jobs.FINISHED):
+        for _ in range(500):
+            _, job = self.request('GET', '/jobs/' + job_id)
+            if job['status'] in status:
+                return job
+            time.sleep(0.01)
+        self.fail('Job {} did not finish'.format(job_id))
+
+    def test_streamed(self):
+        """
+        Test that a streamed count run as a job reports the progress of each
+        strip, and its result matches the count of the endpoint
+        """
+        planner.settings.PLAN_MEMORY_MB = 0.1
+        planner.settings.PLAN_STRIP_MB = 0.05
+
+        status, job = self.request('POST', '/jobs/counts', self.body)
+        self.assertEqual(status, 202)
+        job = self.wait(job['jobId'])
+
+        self.assertEqual(job['status'], jobs.DONE)
+        self.assertGreater(job['progress']['total'], 10)
+        self.assertEqual(job['progress']['done'], job['progress']['total'])
+
+        _, result = self.request('GET', '/jobs/{}/result'.format(job['jobId']))
+        _, expected = self.request('POST', '/counts', self.body)
+        self.assertEqual(result['counts'], expected['counts'])
+
+    def test_cancel(self):
+        """
+        Test that a running job stops at its next chunk once cancelled, and
+        its result isn't available
+        """
+        started = threading.Event()
+        chunks = []
+
+        def work(progress):
+            for chunk in range(1000):
+                progress(chunk, 1000)
+                chunks.append(chunk)
+                started.set()
+                time.sleep(0.01)
+            return {}
+
+        job = jobs.submit('test', work)
+        started.wait(5)
+        status, _ = self.request('GET', '/jobs/{}/result'.format(job.id))
+        self.assertEqual(status, 409)
+
+        _, cancelled = self.request('DELETE', '/jobs/' + job.id)
+        self.assertIn(cancelled['status'], (jobs.RUNNING, jobs.CANCELLED))
+        self.assertEqual(self.wait(job.id)['status'], jobs.CANCELLED)
+        self.assertLess(len(chunks), 1000)
+
+    def test_unchunked(self):
+        """
+        Test that a job which isn't split into chunks is one chunk, which is
+        done once the job is
+        """
+        started = threading.Event()
+        finish = threading.Event()
+
+        def work(progress):
+            started.set()
+            finish.wait(5)
+            return {}
+
+        job = jobs.submit('test', work)
+        started.wait(5)
+        _, running = self.request('GET', '/jobs/' + job.id)
+        finish.set()
+        self.assertEqual(running['progress'], {'done': 0, 'total': 1})
+        self.assertEqual(self.wait(job.id)['progress'],
+                         {'done': 1, 'total': 1})
+
+    def test_invalid(self):
+        """
+        Test that unknown operations and jobs are rejected, and jobs of
+        workers which exited are failed
+        """
+        status, _ = self.request('POST', '/jobs/reclassify', self.body)
+        self.assertEqual(status, 400)
+        status, _ = self.request('GET', '/jobs/unknown')
+        self.assertEqual(status, 400)
+
+        process = Process(target=time.sleep, args=(0,))
+        process.start()
+        process.join()
+        job = jobs.Job('orphan', 'counts', pid=process.pid)
+        jobs.get_store().put_job(job)
+
+        self.assertEqual(jobs.get_job(job.id).status, jobs.FAILED)
+
+
+class HistogramIndexTests(unittest.TestCase):
+    def setUp(self):
+        with rasterio.open(NLCD_LARGE) as src:
+            self.geom = box(*src.bounds).centroid.buffer(10000)
+
+        self.expected = geoprocessing.count(self.geom, NLCD_LARGE)
+
+        self.root = tempfile.mkdtemp()
+        self.settings = (histogram_index.settings.HISTOGRAM_INDEX_PATH,
+                         histogram_index.settings.HISTOGRAM_MIN_CELLS)
+        histogram_index.settings.HISTOGRAM_INDEX_PATH = self.root
+        histogram_index.settings.HISTOGRAM_MIN_CELLS = 0
+        histogram_index.INDEXES.clear()
+
+        self.index = histogram_index.build_index(NLCD_LARGE, block_size=64)
+        histogram_index.save_index(self.index,
+                                   histogram_index.index_path(NLCD_LARGE))
+
+    def tearDown(self):
+        (histogram_index.settings.HISTOGRAM_INDEX_PATH,
+         histogram_index.settings.HISTOGRAM_MIN_CELLS) = self.settings
+        histogram_index.INDEXES.clear()
+        shutil.rmtree(self.root)
+
+    def test_pyramid(self):
+        """
+        Test that each level of the pyramid holds every cell of the raster
+        """
+        cells = 872 * 943
+        self.assertEqual(len(self.index.levels), 5)
+        for level in self.index.levels:
+            self.assertEqual(level.sum(), cells)
+
+    def test_exact_count(self):
+        """
+        Test that counts from interior block histograms and masked boundary
+        blocks match a count of the whole masked window
+        """
+        interior, boundary = self.index.classify(self.geom)
+        self.assertGreater(interior.sum(), 0)
+        self.assertLess(len(boundary), 14 * 15)
+
+        total, counts = geoprocessing.count(self.geom, NLCD_LARGE)
+        self.assertEqual(total, self.expected[0])
+        self.assertEqual(counts, self.expected[1])
+
+    def test_approximate_count(self):
+        """
+        Test that approximate counts are close to exact counts
+        """
+        total, counts = geoprocessing.count(self.geom, NLCD_LARGE,
+                                            approximate=True)
+
+        self.assertAlmostEqual(total / self.expected[0], 1, places=2)
+        self.assertEqual(set(counts), set(self.expected[1]))
+
+    def test_approximate_level(self):
+        """
+        Test that approximate counts of large polygons are weighted from
+        fewer, coarser boundary blocks
+        """
+        blocks = histogram_index.settings.HISTOGRAM_APPROXIMATE_BLOCKS
+        histogram_index.settings.HISTOGRAM_APPROXIMATE_BLOCKS = 2
+        try:
+            level = self.index.approximate_level(self.geom)
+            self.assertGreater(level, 0)
+            self.assertEqual(self.index.approximate_level(
+                self.geom.centroid.buffer(100)), 0)
+
+            _, coarse = self.index.classify(self.geom, max_level=level)
+            _, fine = self.index.classify(self.geom)
+            self.assertLess(len(coarse), len(fine))
+
+            total, _ = geoprocessing.count(self.geom, NLCD_LARGE,
+                                           approximate=True)
+            self.assertAlmostEqual(total / self.expected[0], 1, delta=0.02)
+        finally:
+            histogram_index.settings.HISTOGRAM_APPROXIMATE_BLOCKS = blocks
+
+    def test_stale_index(self):
+        """
+        Test that the index of a raster is not used once the raster has been
+        modified
+        """
+        raster = os.path.join(self.root, 'nlcd.tif')
+        shutil.copy(NLCD_LARGE, raster)
+        histogram_index.save_index(
+            histogram_index.build_index(raster, block_size=64),
+            histogram_index.index_path(raster))
+
+        self.assertIsNotNone(histogram_index.get_index(raster))
+
+        mtime = os.stat(raster).st_mtime
+        os.utime(raster, (mtime + 10, mtime + 10))
+        self.assertIsNone(histogram_index.get_index(raster))
+        self.assertEqual(geoprocessing.count(self.geom, raster),
+                         self.expected)
+
+    def test_unknown_classes(self):
+        """
+        Test that values which aren't classes of the index are left out of
+        block histograms
+        """
+        classes = self.index.classes
+        values = np.array([classes[0], classes[0], classes[-1], 255, 2])
+        self.assertNotIn(255, classes)
+        self.assertNotIn(2, classes)
+
+        histogram = self.index.histogram(values)
+        self.assertEqual(len(histogram), len(classes))
+        self.assertEqual(histogram[0], 2)
+        self.assertEqual(histogram[-1], 1)
+        self.assertEqual(histogram.sum(), 3)
+
+
+class ZonalStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store_path = zonal_store.settings.ZONAL_STORE_PATH
+        zonal_store.settings.ZONAL_STORE_PATH = os.path.join(self.root,
+                                                             'zonal.sqlite')
+        self.app = main.app.test_client()
+
+        self.raster = os.path.abspath(NLCD_PATH)
+        precompute.precompute(
+            'huc12', [('020402030101', CountTests.count_geom)],
+            [('counts', [self.raster])],
+            zonal_store.settings.ZONAL_STORE_PATH, processes=1)
+
+    def tearDown(self):
+        zonal_store.settings.ZONAL_STORE_PATH = self.store_path
+        shutil.rmtree(self.root)
+
+    def post(self, url, rasters):
+        response = self.app.post(url, data=json.dumps({'rasters': rasters}),
+                                 content_type='application/json')
+        return response.status_code, json.loads(response.data)
+
+    def test_precomputed_counts(self):
+        """
+        Test that precomputed counts match a live count
+        """
+        status, result = self.post('/boundaries/huc12/020402030101/counts',
+                                   [self.raster])
+        total, counts = geoprocessing.count(CountTests.count_geom,
+                                            self.raster)
+
+        self.assertEqual(status, 200)
+        self.assertTrue(result['precomputed'])
+        self.assertEqual(result['cellCount'], total)
+        self.assertEqual(result['counts'],
+                         {str(key): value for key, value in counts.items()})
+
+    def test_live_fallback(self):
+        """
+        Test that analyses which weren't precomputed are computed over the
+        stored boundary, and unknown boundaries are rejected
+        """
+        status, result = self.post(
+            '/boundaries/huc12/020402030101/pair-counts',
+            [os.path.abspath(NLCD_ONES), os.path.abspath(NLCD_THREES)])
+
+        self.assertEqual(status, 200)
+        self.assertFalse(result['precomputed'])
+        self.assertEqual(result['pairs'], {'1.0::3.0': 6})
+
+        status, _ = self.post('/boundaries/huc12/foo/counts', [self.raster])
+        self.assertEqual(status, 400)
+
+        status, _ = self.post('/boundaries/huc12/020402030101/pair-counts',
+                              [self.raster])
+        self.assertEqual(status, 400)
+
+    def test_replaced_raster(self):
+        """
+        Test that summaries aren't served once their raster has changed
+        """
+        raster = os.path.join(self.root, 'nlcd.tif')
+        shutil.copy(NLCD_PATH, raster)
+        precompute.precompute(
+            'huc12', [('020402030101', CountTests.count_geom)],
+            [('counts', [raster])],
+            zonal_store.settings.ZONAL_STORE_PATH, processes=1)
+
+        status, result = self.post('/boundaries/huc12/020402030101/counts',
+                                   [raster])
+        self.assertTrue(result['precomputed'])
+
+        mtime = os.stat(raster).st_mtime
+        os.utime(raster, (mtime + 10, mtime + 10))
+        status, live = self.post('/boundaries/huc12/020402030101/counts',
+                                 [raster])
+
+        self.assertEqual(status, 200)
+        self.assertFalse(live['precomputed'])
+        self.assertEqual(live['counts'], result['counts'])
+
+
+class LambdaTests(unittest.TestCase):
+    lambda_handler = importlib.import_module('lambda')
+
+    def setUp(self):
+        self.body = {
+            'rasters': [os.path.abspath(NLCD_PATH)],
+            'queryPolygon': mapping(geo_utils.reproject(
+                CountTests.count_geom, 'epsg:4326', 'epsg:5070')),
+        }
+
+    def test_count(self):
+        """
+        Test that the count method matches a direct count
+        """
+        self.body['method'] = 'count'
+        result = self.lambda_handler.handler(self.body, None)
+
+        self.assertEqual(result['cellCount'], 6)
+        self.assertDictEqual(result['counts'], CountTests.expectedCounts)
+        self.assertIn('time', result)
+        self.assertIn('coldStart', result)
+
+    def test_stats(self):
+        """
+        Test that methods are dispatched with their arguments, and later
+        invocations are warm starts
+        """
+        self.body.update({'method': 'stats', 'stat': 'min'})
+        self.lambda_handler.handler(dict(self.body), None)
+        result = self.lambda_handler.handler(dict(self.body), None)
+
+        self.assertEqual(result['value'], 11)
+        self.assertFalse(result['coldStart'])
+
+    def test_unknown_method(self):
+        """
+        Test that an unsupported method is rejected
+        """
+        self.body['method'] = 'foo'
+        self.assertRaises(UserInputError, self.lambda_handler.handler,
+                          self.body, None)
+
+
+class ResponseEncodingTests(unittest.TestCase):
+    def setUp(self):
+        result_cache.RESULTS.clear()
+        self.app = main.app.test_client()
+        self.line = mapping(geo_utils.reproject(
+            LineString(CountTests.count_geom.exterior.coords[:3]),
+            'epsg:4326', 'epsg:5070'))
+
+    def post(self, url, body, accept=None):
+        body = dict(body, rasters=[os.path.abspath(NLCD_PATH)])
+        headers = {'Accept': accept} if accept else {}
+        return self.app.post(url, data=json.dumps(body), headers=headers,
+                             content_type='application/json')
+
+    def test_json(self):
+        """
+        Test that numpy values are encoded natively in compact JSON
+        """
+        data = {'count': np.uint8(3), 'mean': np.float32(0.5),
+                'values': np.arange(3, dtype=np.int16)}
+        encoded = encoding.encode_json(data)
+
+        self.assertNotIn(' ', encoded)
+        self.assertEqual(json.loads(encoded),
+                         {'count': 3, 'mean': 0.5, 'values': [0, 1, 2]})
+
+    def test_npy(self):
+        """
+        Test that samples along a line can be fetched as NPY, and as JSON
+        by default
+        """
+        response = self.post('/sample-change', {'queryLine': self.line})
+        self.assertEqual(response.mimetype, encoding.JSON)
+        values = json.loads(response.data)['value']
+
+        response = self.post('/sample-change', {'queryLine': self.line},
+                             accept=encoding.NPY)
+        self.assertEqual(response.mimetype, encoding.NPY)
+        self.assertEqual(np.load(BytesIO(response.data)).tolist(), values)
+
+    def test_unavailable(self):
+        """
+        Test that results without an array are encoded as JSON when an
+        array encoding is requested
+        """
+        polygon = mapping(geo_utils.reproject(
+            CountTests.count_geom, 'epsg:4326', 'epsg:5070'))
+        response = self.post('/counts', {'queryPolygon': polygon},
+                             accept=encoding.NPY)
+
+        self.assertEqual(response.mimetype, encoding.JSON)
+        self.assertEqual(json.loads(response.data)['cellCount'], 6)
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        polygon = mapping(geo_utils.reproject(
+            CountTests.count_geom, 'epsg:4326', 'epsg:5070'))
+        response = self.post('/counts', {'queryPolygon': polygon},
+                             accept=encoding.MSGPACK)
+
+        self.assertEqual(response.mimetype, encoding.MSGPACK)
+        result = encoding.msgpack.unpackb(response.data, raw=False)
+        self.assertEqual(result['cellCount'], 6)
+
+
+class InstrumentationTests(unittest.TestCase):
+    def setUp(self):
+        result_cache.RESULTS.clear()
+        self.app = main.app.test_client()
+        self.body = {
+            'rasters': [os.path.abspath(NLCD_PATH)],
+            'queryPolygon': mapping(geo_utils.reproject(
+                CountTests.count_geom, 'epsg:4326', 'epsg:5070')),
+        }
+
+    def post(self, url):
+        return self.app.post(url, data=json.dumps(self.body),
+                             content_type='application/json')
+
+    def test_stage_timings(self):
+        """
+        Test that the time spent in each stage is reported when requested
+        """
+        response = self.post('/counts?timing=true')
+        result = json.loads(response.data)
+
+        self.assertEqual(result['cellCount'], 6)
+        self.assertIn('time', result)
+        for stage in ('parse', 'open', 'read', 'mask', 'compute'):
+            self.assertIn(stage, result['timings'])
+            self.assertIn(stage + ';dur=',
+                          response.headers['Server-Timing'])
+
+        for url in ('/counts', '/counts?timing=false', '/counts?timing=0'):
+            result = json.loads(self.post(url).data)
+            self.assertNotIn('timings', result)
+
+    def test_metrics(self):
+        """
+        Test that request latencies are recorded per route
+        """
+        self.post('/stats/min')
+        metrics = self.app.get('/metrics').data.decode('utf-8')
+
+        self.assertIn('geop_request_duration_seconds_count'
+                      '{route="/stats/<stat>",status="200"}', metrics)
+        self.assertIn('geop_stage_duration_seconds_count'
+                      '{route="/stats/<stat>",stage="compute"}', metrics)
+
+
+class AnalyzeTests(unittest.TestCase):
+    def setUp(self):
+        result_cache.RESULTS.clear()
+        self.app = main.app.test_client()
+        self.rasters = [os.path.abspath(NLCD_PATH),
+                        os.path.abspath(NLCD_EDIT_PATH)]
+        self.polygon = mapping(geo_utils.reproject(
+            CountTests.count_geom, 'epsg:4326', 'epsg:5070'))
+
+    def post(self, url, body):
+        body = dict(body, queryPolygon=self.polygon)
+        response = self.app.post(url, data=json.dumps(body),
+                                 content_type='application/json')
+        return response, json.loads(response.data)
+
+    def test_analyses(self):
+        """
+        Test that each analysis matches its own endpoint, and each raster is
+        read once
+        """
+        analyses = [
+            {'operation': 'counts', 'rasters': self.rasters[:1]},
+            {'operation': 'pair-counts', 'rasters': self.rasters},
+            {'operation': 'stats', 'stat': 'mean',
+             'rasters': self.rasters[1:]},
+            {'operation': 'stats', 'stat': 'max',
+             'rasters': self.rasters[:1]},
+        ]
+        response, result = self.post('/analyze', {'analyses': analyses})
+
+        self.assertEqual(response.headers['X-Raster-Reads'], '2')
+        for analysis, analysis_result in zip(analyses, result['results']):
+            url = '/' + analysis['operation']
+            if 'stat' in analysis:
+                url = '/stats/' + analysis['stat']
+            _, expected = self.post(url, {'rasters': analysis['rasters']})
+
+            del expected['time']
+            self.assertEqual(analysis_result, expected)
+
+    def test_invalid_analysis(self):
+        """
+        Test that unknown operations and missing rasters are rejected
+        """
+        for analysis in ({'operation': 'foo', 'rasters': self.rasters[:1]},
+                         {'operation': 'pair-counts',
+                          'rasters': self.rasters[:1]},
+                         {'operation': 'stats', 'stat': 'median',
+                          'rasters': self.rasters[:1]}):
+            response, _ = self.post('/analyze', {'analyses': [analysis]})
+            self.assertEqual(response.status_code, 400)
+
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        result_cache.RESULTS.clear()
+        self.app = main.app.test_client()
+
+        self.root = tempfile.mkdtemp()
+        self.raster = os.path.join(self.root, 'nlcd.tif')
+        shutil.copy(NLCD_PATH, self.raster)
+        self.body = {
+            'rasters': [self.raster],
+            'queryPolygon': mapping(geo_utils.reproject(
+                CountTests.count_geom, 'epsg:4326', 'epsg:5070')),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def post(self, url):
+        response = self.app.post(url, data=json.dumps(self.body),
+                                 content_type='application/json')
+        return response.headers['X-Result-Cache'], json.loads(response.data)
+
+    def test_memoized(self):
+        """
+        Test that repeated requests are answered from the cache, unless the
+        request or the raster changed
+        """
+        status, result = self.post('/counts')
+        self.assertEqual(status, 'miss')
+
+        cached_status, cached = self.post('/counts')
+        self.assertEqual(cached_status, 'hit')
+        self.assertEqual(cached['counts'], result['counts'])
+
+        self.assertEqual(self.post('/stats/mean')[0], 'miss')
+        self.assertEqual(self.post('/stats/max')[0], 'miss')
+
+        os.utime(self.raster, (0, 0))
+        self.assertEqual(self.post('/counts')[0], 'miss')
+
+    def test_single_flight(self):
+        """
+        Test that concurrent identical requests share a computation
+        """
+        user_input = {'query_polygon': CountTests.count_geom,
+                      'query_line': None, 'raster_paths': [self.raster],
+                      'mods': None, 'approximate': False}
+        calls = []
+        started = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return {'value': 1}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            result_cache.memoize('test', user_input, compute)))
+        leader.start()
+        started.wait()
+        results.append(result_cache.memoize('test', user_input, compute))
+        leader.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(sorted(status for _, status in results),
+                         ['miss', 'shared'])
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+class LoadTestTests(unittest.TestCase):
+    def setUp(self):
+        self.server = make_server('127.0.0.1', 0, main.app, threaded=True,
+                                  request_handler=QuietRequestHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.polygons = [mapping(geo_utils.reproject(
+            CountTests.count_geom, 'epsg:4326', 'epsg:5070'))]
+        self.options = Namespace(raster=os.path.abspath(NLCD_PATH),
+                                 pair_rasters=None)
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_request_mix(self):
+        """
+        Test that the same seed builds the same mix of requests
+        """
+        mix = loadtest.parse_mix('counts=3,xy=1')
+        load = loadtest.build_requests(mix, 40, self.polygons, self.options)
+
+        self.assertEqual(load, loadtest.build_requests(
+            mix, 40, self.polygons, self.options))
+        self.assertEqual(set(name for name, _, _, _ in load),
+                         {'counts', 'xy'})
+        self.assertRaises(ValueError, loadtest.parse_mix, 'foo=1')
+
+    def test_run_load(self):
+        """
+        Test that every request is sent and summarized per endpoint
+        """
+        mix = loadtest.parse_mix('counts,stats,pair-counts')
+        load = loadtest.build_requests(mix, 12, self.polygons, self.options)
+        results, elapsed = loadtest.run_load(self.url, load, 4)
+        summary = loadtest.summarize(results, elapsed)
+
+        self.assertEqual(summary['all']['requests'], 12)
+        self.assertEqual(summary['all']['errors'], 0)
+        self.assertEqual(sum(endpoint['requests'] for name, endpoint
+                             in summary.items() if name != 'all'), 12)
+
+
 class S3Tests(unittest.TestCase):
     def setUp(self):
         self.url = 's3://simple-raster-processing/nlcd_512_lzw_tiled.tif'
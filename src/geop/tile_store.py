@@ -0,0 +1,142 @@
+"""
+On-disk stores of pre-rendered tiles.  Tiles are kept either as files in a
+`{layer}/{z}/{x}/{y}.{format}` directory tree, or in an MBTiles file named
+`{layer}.{format}.mbtiles`, both under settings.TILE_STORE_PATH.
+"""
+import os
+import sqlite3
+import threading
+
+import settings
+
+from cache import LRUCache
+
+# Open MBTiles stores, keyed by file path
+MBTILES = {}
+MBTILES_LOCK = threading.Lock()
+
+# Keys of tiles recently rendered by this process, (layer, z, x, y, format).
+# The store didn't have them, so they aren't looked up in it again.
+RENDERED = LRUCache(settings.TILE_RENDERED_SIZE)
+
+
+class DirectoryStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, layer, zoom, x, y, img_format):
+        return os.path.join(self.root, layer, str(zoom), str(x),
+                            '{0}.{1}'.format(y, img_format))
+
+    def get(self, layer, zoom, x, y, img_format):
+        try:
+            with open(self.path(layer, zoom, x, y, img_format), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, layer, zoom, x, y, img_format, data):
+        path = self.path(layer, zoom, x, y, img_format)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+
+        # Write to a temporary file and rename so a tile being served is
+        # never partially written
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+
+class MBTilesStore(object):
+    """
+    A single layer and format tileset in the MBTiles 1.2 format.  MBTiles
+    rows are numbered from the bottom (TMS), so y is flipped on the way in
+    and out.
+    """
+    def __init__(self, path, create=False):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        if create:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+                CREATE TABLE IF NOT EXISTS tiles (
+                    zoom_level INTEGER,
+                    tile_column INTEGER,
+                    tile_row INTEGER,
+                    tile_data BLOB);
+                CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+                    ON tiles (zoom_level, tile_column, tile_row);
+            """)
+
+    def get(self, zoom, x, y):
+        row = self.conn.execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND '
+            'tile_column = ? AND tile_row = ?',
+            (zoom, x, 2**zoom - 1 - y)).fetchone()
+
+        return bytes(row[0]) if row else None
+
+    def put(self, zoom, x, y, data):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+            (zoom, x, 2**zoom - 1 - y, sqlite3.Binary(data)))
+
+    def set_metadata(self, metadata):
+        self.conn.executemany(
+            'DELETE FROM metadata WHERE name = ?',
+            [(name,) for name in metadata])
+        self.conn.executemany(
+            'INSERT INTO metadata VALUES (?, ?)',
+            [(name, str(value)) for name, value in metadata.items()])
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def mbtiles_path(root, layer, img_format):
+    return os.path.join(root, '{0}.{1}.mbtiles'.format(layer, img_format))
+
+
+def add_rendered(layer, zoom, x, y, img_format):
+    """
+    Record that a tile which isn't in the tile store has been rendered
+    """
+    RENDERED.set((layer, zoom, x, y, img_format), True)
+
+
+def get_tile(layer, zoom, x, y, img_format):
+    """
+    Look up a pre-rendered tile in the tile store
+
+    Returns:
+        Encoded tile bytes or None if the tile has not been seeded, or was
+        recently rendered by this process
+    """
+    root = settings.TILE_STORE_PATH
+    if not root or (layer, zoom, x, y, img_format) in RENDERED:
+        return None
+
+    img = DirectoryStore(root).get(layer, zoom, x, y, img_format)
+    if img is not None:
+        return img
+
+    path = mbtiles_path(root, layer, img_format)
+    store = MBTILES.get(path)
+    if store is None:
+        if not os.path.isfile(path):
+            return None
+
+        with MBTILES_LOCK:
+            store = MBTILES.get(path)
+            if store is None:
+                store = MBTILES[path] = MBTilesStore(path)
+
+    return store.get(zoom, x, y)
@@ -1,10 +1,37 @@
+import numpy as np
+
 from PIL import Image
 from io import BytesIO
 
-from geo_utils import tile_read
+import settings
+import tile_store
+import timing
+
+from cache import LRUCache, SingleFlight
+from errors import UserInputError
+from geo_utils import tile_read, metatile_origin, metatile_to_bbox
+
+TILE_SIZE = 256
+
+# Encoded tiles keyed by (layer name, z, x, y, image format)
+TILE_CACHE = LRUCache(settings.TILE_CACHE_SIZE)
 
+# Metatiles being rendered, so a burst of requests for tiles of the same
+# metatile waits on a single render rather than each reading it
+METATILE_RENDERS = SingleFlight()
 
-def render_tile(geom, raster_path, user_palette):
+# Packed palettes keyed by the color sequence they were built from, so a
+# palette supplied as a list is only converted once per process
+PALETTE_CACHE = {}
+
+MIMETYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+
+def render_tile(geom, raster_path, user_palette, img_format=None,
+                nodata=None, skip_empty=False):
     """
     Generates a visual PNG map tile from a vector polygon
 
@@ -18,31 +45,202 @@ def render_tile(geom, raster_path, user_palette):
         uer_palette (optional list): A sequence of RGB triplets whose index
             corresponds to the raster value which will be rendered. If
             provided, will override a ColorTable defined in the raster
+
+        img_format (optional string): Image format to encode, `png` or `webp`.
+            Defaults to settings.TILE_FORMAT
+
+        nodata (optional int): Cell value to render as transparent
+
+        skip_empty (optional bool): If True, tiles where every cell is
+            `nodata` are not encoded
     Returns:
-        Byte Array of image in the PNG format
+        Byte Array of image in the requested format, or None for a skipped
+        empty tile
     """
     tile, palette = tile_read(geom, raster_path)
-    return render_tile_from_data(tile, user_palette or palette)
+    if skip_empty and nodata is not None and (tile == nodata).all():
+        return None
 
+    if user_palette is not None:
+        palette = user_palette
+    return render_tile_from_data(tile, palette, img_format, nodata)
 
-def render_tile_from_data(tile, palette):
+
+def render_tile_from_data(tile, palette, img_format=None, nodata=None):
     """
     Generates a visual PNG map tile from an ndarray of raster data
 
     Args:
         tile (ndarray) : A square 256x256 array of raster values
 
-        palette (list<int>): A list of RGB values to render `tile`
+        palette (list<int>|ndarray|bytes): RGB values to render `tile`.  A
+            palette packed with `make_palette` is used without conversion
+
+        img_format (optional string): Image format to encode, `png` or `webp`
+
+        nodata (optional int): Cell value to render as transparent
 
     Returns:
-        Byte Array of image in the PNG format
+        Byte Array of image in the requested format
     """
     img = Image.fromarray(tile, mode='P')
 
-    if len(palette):
-        img.putpalette(palette)
+    if palette is not None and len(palette):
+        img.putpalette(make_palette(palette))
+
+    return encode_tile(img, img_format, nodata)
+
+
+def get_tile(name, zoom, x, y, img_format, render):
+    """
+    Get an encoded tile from the tile cache or the tile store of seeded
+    tiles, rendering the metatile which contains it on a miss.  Every tile
+    of a rendered metatile is added to the cache, so requests for adjacent
+    tiles are served without another read.
+
+    Args:
+        name (string): Unique name of the layer or analysis being rendered,
+            used in the cache key
+
+        zoom (int): Zoom level for the tile
+        x (int): x coordinate of tile origin
+        y (int): y coordinate of tile origin
+
+        img_format (string): `png` or `webp`
+
+        render (function): Called with the EPSG:3857 bounding box of the
+            metatile and its width in cells, returns a tuple of the uint8
+            ndarray of cells to render, the palette, and the nodata value
+
+    Returns:
+        BytesIO of the encoded tile
+    """
+    img_format = img_format or settings.TILE_FORMAT
+    key = (name, zoom, x, y, img_format)
+
+    img = TILE_CACHE.get(key)
+    if img is not None:
+        return BytesIO(img)
+
+    img = tile_store.get_tile(name, zoom, x, y, img_format)
+    if img is not None:
+        TILE_CACHE.set(key, img)
+        return BytesIO(img)
+
+    mx, my, size = metatile_origin(zoom, x, y, settings.METATILE_SIZE)
+    metatile_key = (name, zoom, mx, my, img_format)
+
+    def render_and_cache():
+        tiles = render_metatile(zoom, mx, my, size, img_format, render)
+        for (tx, ty), tile_img in tiles.items():
+            TILE_CACHE.set((name, zoom, tx, ty, img_format), tile_img)
+            tile_store.add_rendered(name, zoom, tx, ty, img_format)
+        return tiles
+
+    tiles, _ = METATILE_RENDERS.do(metatile_key, render_and_cache)
+    return BytesIO(tiles[(x, y)])
+
+
+def render_metatile(zoom, x, y, size, img_format, render):
+    """
+    Render a `size` x `size` block of tiles whose upper left tile is z/x/y
+    with a single call to `render`, and slice it into encoded tiles.
+
+    Returns:
+        dict of (x, y) tile coordinates to encoded tile bytes
+    """
+    bbox = metatile_to_bbox(zoom, x, y, size)
+    data, palette, nodata = render(bbox, size * TILE_SIZE)
+
+    if palette is not None and len(palette):
+        palette = make_palette(palette)
+
+    tiles = {}
+    for row in range(size):
+        for col in range(size):
+            tile = np.ascontiguousarray(
+                data[row * TILE_SIZE:(row + 1) * TILE_SIZE,
+                     col * TILE_SIZE:(col + 1) * TILE_SIZE])
+            img = render_tile_from_data(tile, palette, img_format, nodata)
+            tiles[(x + col, y + row)] = img.getvalue()
+
+    return tiles
+
+
+def make_palette(colors):
+    """
+    Pack a flat sequence of RGB values into the byte string PIL uses for
+    palettes.  Packing a list requires a python level loop inside PIL, so
+    palettes should be packed once and reused across tiles.
+
+    Args:
+        colors (list<int>|ndarray|bytes): RGB triplets whose index
+            corresponds to a cell value
+
+    Returns:
+        Palette as a byte string of at most 256 RGB triplets
+    """
+    if isinstance(colors, bytes):
+        return colors
+
+    if isinstance(colors, np.ndarray):
+        return colors.astype(np.uint8).tobytes()
 
+    key = tuple(colors)
+    palette = PALETTE_CACHE.get(key)
+    if palette is None:
+        palette = np.array(key, dtype=np.uint8).tobytes()
+        PALETTE_CACHE[key] = palette
+
+    return palette
+
+
+@timing.timed('encode')
+def encode_tile(img, img_format=None, transparent=None):
+    """
+    Encode a paletted image with the configured compression options.
+
+    PNG tiles are written with the zlib level and strategy from settings.
+    A `transparent` palette index is written as a tRNS chunk, which keeps
+    the image paletted.  WebP has no paletted mode, so the image is expanded
+    to RGB, or RGBA when a transparent index is given.
+
+    Args:
+        img (PIL Image): Image in `P` mode
+
+        img_format (optional string): `png` or `webp`.  Defaults to
+            settings.TILE_FORMAT
+
+        transparent (optional int): Palette index to render as transparent
+
+    Returns:
+        BytesIO of the encoded image, seeked to the start
+    """
+    img_format = (img_format or settings.TILE_FORMAT).lower()
     img_data = BytesIO()
-    img.save(img_data, 'png')
+
+    if img_format == 'png':
+        options = {
+            'compress_level': settings.TILE_PNG_COMPRESS_LEVEL,
+            'compress_type': settings.TILE_PNG_COMPRESS_TYPE,
+        }
+        if transparent is not None:
+            options['transparency'] = transparent
+        img.save(img_data, 'png', **options)
+
+    elif img_format == 'webp':
+        if transparent is not None:
+            img.info['transparency'] = transparent
+            img = img.convert('RGBA')
+        else:
+            img = img.convert('RGB')
+        img.save(img_data, 'webp',
+                 lossless=settings.TILE_WEBP_LOSSLESS,
+                 quality=settings.TILE_WEBP_QUALITY)
+
+    else:
+        raise UserInputError('{0} is not a supported image format'
+                             .format(img_format))
+
     img_data.seek(0)
     return img_data
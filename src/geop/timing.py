@@ -0,0 +1,158 @@
+"""
+Per-request stage timings and process wide latency metrics.
+
+Code on the request path wraps its stages in `stage`, which accumulates the
+time spent in each named stage (parse, open, read, mask, compute, encode,
+serialize) for the current request.  Completed requests are recorded in
+latency histograms, which are rendered in the Prometheus text format.
+Metrics are kept per process, so each gunicorn worker reports its own.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+# Timings of the current request.  Local to each greenlet under gevent.
+LOCAL = threading.local()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+class Timings(object):
+    def __init__(self):
+        self.start = time.time()
+        self.stages = OrderedDict()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def total(self):
+        return time.time() - self.start
+
+    def as_dict(self):
+        return dict(self.stages)
+
+    def server_timing(self):
+        """
+        Format the stages as a Server-Timing header value, in milliseconds
+        """
+        stages = list(self.stages.items()) + [('total', self.total())]
+        return ', '.join('{0};dur={1:.2f}'.format(name, seconds * 1000)
+                         for name, seconds in stages)
+
+
+class Histogram(object):
+    """
+    A cumulative histogram of observations, in the Prometheus style, for
+    each distinct tuple of label values
+    """
+    def __init__(self, name, description, label_names, buckets):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {
+                    'buckets': [0] * len(self.buckets),
+                    'count': 0,
+                    'sum': 0.0,
+                }
+
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][idx] += 1
+            series['count'] += 1
+            series['sum'] += value
+
+    def render(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.description),
+            '# TYPE {0} histogram'.format(self.name),
+        ]
+
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                label_str = format_labels(self.label_names, labels)
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                        self.name, label_str, bound, count))
+                lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(
+                    self.name, label_str, series['count']))
+                lines.append('{0}_sum{{{1}}} {2}'.format(
+                    self.name, label_str, series['sum']))
+                lines.append('{0}_count{{{1}}} {2}'.format(
+                    self.name, label_str, series['count']))
+
+        return lines
+
+
+def format_labels(names, values):
+    return ','.join('{0}="{1}"'.format(name, value)
+                    for name, value in zip(names, values))
+
+
+REQUEST_LATENCY = Histogram(
+    'geop_request_duration_seconds', 'Request latency by route and status',
+    ('route', 'status'), LATENCY_BUCKETS)
+
+STAGE_LATENCY = Histogram(
+    'geop_stage_duration_seconds', 'Time spent per request in each stage',
+    ('route', 'stage'), LATENCY_BUCKETS)
+
+
+def reset():
+    LOCAL.timings = Timings()
+    return LOCAL.timings
+
+
+def current():
+    timings = getattr(LOCAL, 'timings', None)
+    if timings is None:
+        timings = LOCAL.timings = Timings()
+    return timings
+
+
+@contextmanager
+def stage(name):
+    """
+    Add the time spent in the block to the `name` stage of the current
+    request
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        current().add(name, time.time() - start)
+
+
+def record_request(route, status, timings):
+    REQUEST_LATENCY.observe((route, status), timings.total())
+    for name, seconds in timings.stages.items():
+        STAGE_LATENCY.observe((route, name), seconds)
+
+
+def render_metrics():
+    lines = REQUEST_LATENCY.render() + STAGE_LATENCY.render()
+    return '\n'.join(lines) + '\n'
+
+
+def timed(name):
+    """
+    Decorator which adds the time spent in a function to the `name` stage
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
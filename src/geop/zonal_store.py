@@ -0,0 +1,148 @@
+"""
+Zonal summaries of well-known boundaries, such as HUC-12s or counties,
+precomputed by `precompute.py` into a SQLite file at
+settings.ZONAL_STORE_PATH.  The geometry of each boundary is kept alongside
+its summaries, so analyses which weren't precomputed for a boundary can
+still be computed live.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+from shapely import wkb
+
+import geoprocessing
+import raster_io
+import settings
+
+# Open stores, keyed by file path
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+
+class ZonalStore(object):
+    """
+    Boundary geometries and their summaries, keyed by boundary dataset and
+    id.  Summaries are also keyed by analysis and by the comma separated
+    raster names they were computed over, as given in requests, and record
+    the versions of the rasters, so summaries of rasters which have since
+    been replaced aren't served.  The connection is shared by the threads
+    of a worker, one query at a time.
+    """
+    def __init__(self, path, create=False):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        if create:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS boundaries (
+                    dataset TEXT,
+                    id TEXT,
+                    geom BLOB,
+                    PRIMARY KEY (dataset, id));
+                CREATE TABLE IF NOT EXISTS summaries (
+                    dataset TEXT,
+                    id TEXT,
+                    analysis TEXT,
+                    rasters TEXT,
+                    versions TEXT,
+                    summary TEXT,
+                    PRIMARY KEY (dataset, id, analysis, rasters));
+            """)
+
+    def get_boundary(self, dataset, boundary_id):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT geom FROM boundaries WHERE dataset = ? AND id = ?',
+                (dataset, boundary_id)).fetchone()
+
+        return wkb.loads(bytes(row[0])) if row else None
+
+    def put_boundary(self, dataset, boundary_id, geom):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO boundaries VALUES (?, ?, ?)',
+                (dataset, boundary_id, sqlite3.Binary(geom.wkb)))
+
+    def get_summary(self, dataset, boundary_id, analysis, rasters,
+                    raster_paths):
+        """
+        The summary of an analysis over a boundary, or None if it wasn't
+        precomputed, or a raster at `raster_paths` has changed since
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT versions, summary FROM summaries WHERE dataset = ? '
+                'AND id = ? AND analysis = ? AND rasters = ?',
+                (dataset, boundary_id, analysis,
+                 ','.join(rasters))).fetchone()
+
+        if not row or row[0] != raster_versions(raster_paths):
+            return None
+
+        return json.loads(row[1])
+
+    def put_summary(self, dataset, boundary_id, analysis, rasters,
+                    raster_paths, summary):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?)',
+                (dataset, boundary_id, analysis, ','.join(rasters),
+                 raster_versions(raster_paths), json.dumps(summary)))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def raster_versions(raster_paths):
+    """
+    The versions of rasters given by `raster_io.raster_version`, as JSON
+    """
+    return json.dumps([raster_io.raster_version(raster_path)
+                       for raster_path in raster_paths])
+
+
+def count_summary(geom, raster_paths):
+    total, count_map = geoprocessing.count(geom, raster_paths[0])
+    return {
+        'cellCount': total,
+        'counts': count_map,
+    }
+
+
+def pair_count_summary(geom, raster_paths):
+    return {
+        'pairs': geoprocessing.count_pairs(geom, raster_paths),
+    }
+
+
+# Analyses which can be precomputed, named after the endpoints whose
+# responses they match
+ANALYSES = {
+    'counts': count_summary,
+    'pair-counts': pair_count_summary,
+}
+
+
+def get_store():
+    """
+    The zonal store at settings.ZONAL_STORE_PATH, or None if there isn't one
+    """
+    path = settings.ZONAL_STORE_PATH
+    store = STORES.get(path)
+    if store is None:
+        if not path or not os.path.isfile(path):
+            return None
+
+        with STORES_LOCK:
+            store = STORES.get(path)
+            if store is None:
+                store = STORES[path] = ZonalStore(path)
+
+    return store